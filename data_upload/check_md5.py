@@ -1,65 +1,101 @@
+import argparse
 import os
-import hashlib
-from multiprocessing import Pool
 import pathlib
 
-def read_md5sums(file_path):
-    """Read MD5 checksums from a file and return as a dictionary."""
-    md5_dict = {}
-    with open(file_path, 'r') as f:
+from checksum import available_algorithms, hash_files, open_for_append, read_sums
+
+
+def read_results(output_file):
+    """
+    The last status, MATCH or MISMATCH, of each file compared by an earlier,
+    interrupted run.
+    """
+    statuses = {}
+    if not os.path.exists(output_file):
+        return statuses
+    with open(output_file, "r") as f:
         for line in f:
-            parts = line.strip().split(': ')
-            if len(parts) == 2:
-                md5_dict[parts[0]] = parts[1]
-    return md5_dict
+            # Only complete lines end with the closing parenthesis
+            file_path, _, result = line.partition(": ")
+            if line.endswith(")\n") and result.startswith(("MATCH (", "MISMATCH (")):
+                statuses[file_path] = result.split(" ")[0]
+    return statuses
 
-def calculate_md5(file_path):
-    """Calculate MD5 checksum of a file."""
-    hash_md5 = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return file_path, hash_md5.hexdigest()
 
-def compare_md5(file_info):
-    """Compare MD5 checksum of a file with the expected checksum."""
-    file_path, expected_md5 = file_info
-    _, actual_md5 = calculate_md5(file_path)
-    return file_path, expected_md5 == actual_md5, actual_md5
+def main(md5sums_file, directory, output_file, num_workers=None, algorithm="md5"):
+    # Read expected checksums
+    expected_sums = read_sums(md5sums_file, algorithm)
 
-def main(md5sums_file, directory, output_file, num_processes=4):
-    # Read expected MD5 checksums
-    expected_md5s = read_md5sums(md5sums_file)
-    
-    # Create list of files to check with their expected checksums
+    # Create list of files to check, skipping those that matched before.
+    # Mismatches are compared again, e.g. after downloading them again.
+    statuses = read_results(output_file)
+    matched = {path for path, status in statuses.items() if status == "MATCH"}
     file_list = []
-    for file_name, expected_md5 in expected_md5s.items():
+    for file_name in expected_sums:
         file_path = os.path.join(directory, file_name)
-        if os.path.exists(file_path):
-            file_list.append((file_path, expected_md5))
+        if os.path.exists(file_path) and file_path not in matched:
+            file_list.append(file_path)
+    if matched:
+        print(f"Skipping {len(matched)} files that already matched")
+
+    # Earlier mismatches that are not compared again still count
+    to_check = set(file_list)
+    mismatches = sum(
+        status == "MISMATCH" and path not in to_check
+        for path, status in statuses.items()
+    )
+    rechecked = len(statuses) - len(matched) - mismatches
+    if rechecked:
+        print(f"Comparing {rechecked} files that mismatched before again")
 
-    # Compare MD5 checksums using multiprocessing
-    with Pool(processes=num_processes) as pool:
-        results = pool.map(compare_md5, file_list)
-    
-    # Write comparison results to the output file
-    with open(output_file, "w") as f:
-        for file_path, is_match, actual_md5 in results:
-            status = "MATCH" if is_match else "MISMATCH"
-            f.write(f"{file_path}: {status} (expected: {expected_md5s[os.path.basename(file_path)]}, actual: {actual_md5})\n")
+    # Compare checksums, writing each result as soon as it is known
+    with open_for_append(output_file) as f:
+        for file_path, digests in hash_files(file_list, (algorithm,), num_workers):
+            expected = expected_sums[os.path.basename(file_path)]
+            actual = digests[algorithm]
+            status = "MATCH" if expected == actual else "MISMATCH"
+            mismatches += status == "MISMATCH"
+            f.write(f"{file_path}: {status} (expected: {expected}, actual: {actual})\n")
+            f.flush()
+
+    return mismatches
 
 
 if __name__ == "__main__":
-    
     HERE = pathlib.Path(__file__).parent
-    # Path to the file containing the expected MD5 checksums
-    md5sums_file = str(HERE / "md5sums.txt")
-    # Directory containing the downloaded and extracted files
-    directory = "/pscratch/sd/s/swelborn/streaming-paper/counted_data/untarred"  # Update this path to your directory
-    # Output file to save the comparison results
-    output_file = "comparison_results.txt"
-    # Number of processes to use for multiprocessing
-    num_processes = 20
 
-    main(md5sums_file, directory, output_file, num_processes)
-    print(f"Comparison results saved to {output_file}")
+    parser = argparse.ArgumentParser(description="Check the raw data checksums.")
+    parser.add_argument(
+        "--sums_file",
+        default=str(HERE / "md5sums.txt"),
+        help="File containing the expected checksums.",
+    )
+    parser.add_argument(
+        "--directory",
+        # Update this path to your directory
+        default="/pscratch/sd/s/swelborn/streaming-paper/counted_data/untarred",
+        help="Directory containing the downloaded and extracted files.",
+    )
+    parser.add_argument(
+        "--output_file",
+        default="comparison_results.txt",
+        help="File to save the comparison results to.",
+    )
+    parser.add_argument(
+        "--algorithm",
+        default="md5",
+        choices=available_algorithms(),
+        help="Hash the sums file was made with.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Files hashed at once, picked from the file system type by default.",
+    )
+    args = parser.parse_args()
+
+    mismatches = main(
+        args.sums_file, args.directory, args.output_file, args.workers, args.algorithm
+    )
+    print(f"Comparison results saved to {args.output_file}, {mismatches} mismatches")
@@ -0,0 +1,229 @@
+"""
+Checksum engine shared by create_md5.py and check_md5.py.
+
+Files are read in large blocks into one reused buffer per thread and fed to
+every requested hash in a single pass. hashlib releases the GIL while
+hashing, so a thread pool keeps several reads in flight without the cost
+of worker processes. Results are handed back as each file finishes, so the
+callers can stream them to disk and resume after an interruption.
+"""
+
+import hashlib
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# 16 MiB reads keep parallel file systems such as Lustre streaming
+BLOCK_SIZE = 16 * 1024**2
+
+# Mounts where many outstanding reads hide the per-request latency
+NETWORK_FILESYSTEMS = {
+    "lustre",
+    "gpfs",
+    "nfs",
+    "nfs4",
+    "beegfs",
+    "ceph",
+    "cifs",
+    "smb3",
+    "fuse.sshfs",
+}
+
+HASHLIB_ALGORITHMS = ("md5", "sha1", "sha256", "blake2b")
+XXHASH_ALGORITHMS = ("xxh64", "xxh3_64", "xxh3_128")
+
+
+def available_algorithms():
+    if xxhash is None:
+        return HASHLIB_ALGORITHMS
+    return HASHLIB_ALGORITHMS + XXHASH_ALGORITHMS
+
+
+def new_hash(algorithm):
+    """Create a hash object with the hashlib interface."""
+    if algorithm in HASHLIB_ALGORITHMS:
+        return hashlib.new(algorithm)
+    if algorithm in XXHASH_ALGORITHMS:
+        if xxhash is None:
+            raise ValueError(f"{algorithm} needs the xxhash package")
+        return getattr(xxhash, algorithm)()
+    raise ValueError(f"Unknown hash algorithm {algorithm}")
+
+
+def get_digest_length(algorithm):
+    """Number of hex characters in a digest, to spot truncated lines."""
+    return new_hash(algorithm).digest_size * 2
+
+
+_buffers = threading.local()
+
+
+def hash_file(file_path, algorithms=("md5",), block_size=BLOCK_SIZE):
+    """
+    Hash a file with each of `algorithms` in one pass.
+
+    Returns a dictionary of hex digests by algorithm, and the number of
+    bytes read.
+    """
+    buffer = getattr(_buffers, "buffer", None)
+    if buffer is None or len(buffer) != block_size:
+        buffer = bytearray(block_size)
+        _buffers.buffer = buffer
+    view = memoryview(buffer)
+
+    hashes = [new_hash(algorithm) for algorithm in algorithms]
+    num_bytes = 0
+    with open(file_path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            n = f.readinto(view)
+            if not n:
+                break
+            for h in hashes:
+                h.update(view[:n])
+            num_bytes += n
+
+    digests = {algorithm: h.hexdigest() for algorithm, h in zip(algorithms, hashes)}
+    return digests, num_bytes
+
+
+def get_filesystem_type(path):
+    """File system type of the mount holding `path`, from /proc/mounts."""
+    path = os.path.realpath(path)
+    best, fs_type = "", None
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1]
+                if path == mount_point or path.startswith(
+                    mount_point.rstrip("/") + "/"
+                ):
+                    if len(mount_point) > len(best):
+                        best, fs_type = mount_point, fields[2]
+    except OSError:
+        pass
+    return fs_type
+
+
+def get_num_workers(path, num_files):
+    """
+    Pick how many files to hash at once. Network file systems get more
+    concurrent reads than CPUs, to hide latency; local disks get one per
+    CPU at most, as more would only make the reads seek.
+    """
+    num_cpus = os.cpu_count() or 1
+    if get_filesystem_type(path) in NETWORK_FILESYSTEMS:
+        workers = min(32, 2 * num_cpus)
+    else:
+        workers = min(8, num_cpus)
+    return max(1, min(workers, num_files))
+
+
+def read_sums(sums_file, algorithm=None):
+    """
+    Read `name: digest` lines into a dictionary. With `algorithm`, lines
+    whose digest has the wrong length, such as one cut off by an
+    interrupted run, are skipped.
+    """
+    sums = {}
+    if not os.path.exists(sums_file):
+        return sums
+
+    length = get_digest_length(algorithm) if algorithm else None
+    with open(sums_file, "r") as f:
+        for line in f:
+            parts = line.strip().split(": ")
+            if len(parts) != 2:
+                continue
+            if length is not None and len(parts[1]) != length:
+                continue
+            sums[parts[0]] = parts[1]
+    return sums
+
+
+def open_for_append(output_file):
+    """Open a results file for appending, starting on a fresh line."""
+    needs_newline = False
+    if os.path.exists(output_file) and os.path.getsize(output_file) > 0:
+        with open(output_file, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b"\n"
+
+    f = open(output_file, "a")
+    if needs_newline:
+        f.write("\n")
+    return f
+
+
+class Progress:
+    """Print files and bytes done, and throughput, at most every `interval` s."""
+
+    def __init__(self, num_files, total_bytes, interval=10.0, stream=sys.stderr):
+        self.num_files = num_files
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.stream = stream
+        self.files = 0
+        self.bytes = 0
+        self.start = time.monotonic()
+        self.last_report = self.start
+
+    def update(self, num_bytes):
+        self.files += 1
+        self.bytes += num_bytes
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report()
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        total = f"/{self.total_bytes / 1e9:.1f}" if self.total_bytes else ""
+        print(
+            f"{self.files}/{self.num_files} files, "
+            f"{self.bytes / 1e9:.1f}{total} GB, "
+            f"{self.bytes / 1e6 / elapsed:.0f} MB/s",
+            file=self.stream,
+            flush=True,
+        )
+
+
+def hash_files(file_list, algorithms=("md5",), num_workers=None):
+    """
+    Hash files concurrently and yield (file_path, digests) as each one
+    finishes, in completion order, reporting progress on stderr.
+    """
+    if not file_list:
+        return
+
+    if num_workers is None:
+        num_workers = get_num_workers(os.path.dirname(file_list[0]), len(file_list))
+    sizes = {path: os.path.getsize(path) for path in file_list}
+    progress = Progress(len(file_list), sum(sizes.values()))
+    print(
+        f"Hashing {len(file_list)} files with {', '.join(algorithms)} "
+        f"using {num_workers} threads",
+        file=sys.stderr,
+    )
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {
+            executor.submit(hash_file, path, algorithms): path for path in file_list
+        }
+        for future in as_completed(futures):
+            digests, num_bytes = future.result()
+            progress.update(num_bytes)
+            yield futures[future], digests
+
+    progress.report()
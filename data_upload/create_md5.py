@@ -1,16 +1,10 @@
+import argparse
 import os
 import pathlib
 import re
-import hashlib
-from multiprocessing import Pool
 
-def calculate_md5(file_path):
-    """Calculate MD5 checksum of a file."""
-    hash_md5 = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return file_path, hash_md5.hexdigest()
+from checksum import available_algorithms, hash_files, open_for_append, read_sums
+
 
 def find_files(directory, pattern):
     """Find all files in a directory matching the given pattern."""
@@ -22,29 +16,82 @@ def find_files(directory, pattern):
                 matching_files.append(os.path.join(root, file))
     return matching_files
 
-def save_md5sums(file_list, output_file, num_processes=4):
-    """Save MD5 checksums of files to a text file using multiprocessing."""
-    with Pool(processes=num_processes) as pool:
-        results = pool.map(calculate_md5, file_list)
-    
-    with open(output_file, "w") as f:
-        for file, md5sum in results:
+
+def get_output_file(output_file, algorithm):
+    """md5 goes to `output_file`, other algorithms to <algorithm>sums.txt next to it."""
+    if algorithm == "md5":
+        return output_file
+    return str(pathlib.Path(output_file).with_name(f"{algorithm}sums.txt"))
+
+
+def save_checksums(file_list, output_file, algorithms=("md5",), num_workers=None):
+    """
+    Save checksums of files as `name: digest` lines, one file per algorithm.
+
+    Lines are appended as each file is hashed, and files already listed in
+    every output are skipped, so an interrupted run picks up where it left off.
+    """
+    output_files = {a: get_output_file(output_file, a) for a in algorithms}
+    done = {a: read_sums(path, a) for a, path in output_files.items()}
+    todo = [
+        path
+        for path in file_list
+        if any(pathlib.Path(path).name not in done[a] for a in algorithms)
+    ]
+    if len(todo) < len(file_list):
+        print(f"Skipping {len(file_list) - len(todo)} files already hashed")
+
+    outputs = {a: open_for_append(path) for a, path in output_files.items()}
+    try:
+        for file, digests in hash_files(todo, algorithms, num_workers):
             filename = pathlib.Path(file).name
-            f.write(f"{filename}: {md5sum}\n")
+            for algorithm, digest in digests.items():
+                if filename not in done[algorithm]:
+                    outputs[algorithm].write(f"{filename}: {digest}\n")
+                    outputs[algorithm].flush()
+    finally:
+        for f in outputs.values():
+            f.close()
+
 
 if __name__ == "__main__":
-    # Directory containing the files
-    directory = "/pscratch/sd/s/swelborn/streaming-paper/counted_data"  # Update this path to your directory
-    # Pattern to match files
-    pattern = r'^FOURD_\d{6}_\d{4}_\d{5}_\d{5}\.h5$'
-    # Output file to save the MD5 checksums
-    output_file = "md5sums.txt"
-    # Number of processes to use for multiprocessing
-    num_processes = 20
+    parser = argparse.ArgumentParser(description="Checksum the raw data files.")
+    parser.add_argument(
+        "--directory",
+        # Update this path to your directory
+        default="/pscratch/sd/s/swelborn/streaming-paper/counted_data",
+        help="Directory containing the files.",
+    )
+    parser.add_argument(
+        "--pattern",
+        default=r"^FOURD_\d{6}_\d{4}_\d{5}_\d{5}\.h5$",
+        help="Regular expression the file names must match.",
+    )
+    parser.add_argument(
+        "--output_file",
+        default="md5sums.txt",
+        help="MD5 output; other algorithms go to <algorithm>sums.txt next to it.",
+    )
+    parser.add_argument(
+        "--algorithm",
+        dest="algorithms",
+        action="append",
+        choices=available_algorithms(),
+        help="Hash to compute, md5 by default. Can be given more than once.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Files hashed at once, picked from the file system type by default.",
+    )
+    args = parser.parse_args()
+    algorithms = tuple(dict.fromkeys(args.algorithms or ["md5"]))
 
     # Find matching files
-    matching_files = find_files(directory, pattern)
-    # Save MD5 checksums to the output file using multiprocessing
-    save_md5sums(matching_files, output_file, num_processes)
+    matching_files = find_files(args.directory, args.pattern)
+    # Save checksums to the output files, resuming an earlier run
+    save_checksums(matching_files, args.output_file, algorithms, args.workers)
 
-    print(f"MD5 checksums saved to {output_file}")
+    for algorithm in algorithms:
+        print(f"Checksums saved to {get_output_file(args.output_file, algorithm)}")
@@ -0,0 +1,138 @@
+"""
+Extract single scans from the parts written by package.py, reading only
+their bytes, from a local directory of parts or over HTTP range requests.
+
+    python extract_scans.py --index counted_data_index.json \
+        --source /path/to/parts --output_dir scans --scan 516 --scan 520-523
+"""
+
+import argparse
+import gzip
+import io
+import json
+import os
+import tarfile
+import urllib.request
+
+from checksum import BLOCK_SIZE, new_hash
+
+
+class RangeReader(io.RawIOBase):
+    """Read-only stream over `length` bytes at `offset` of a file or URL."""
+
+    def __init__(self, source, part, offset, length):
+        self.remaining = length
+        if source.startswith(("http://", "https://")):
+            request = urllib.request.Request(
+                f"{source.rstrip('/')}/{part}",
+                headers={"Range": f"bytes={offset}-{offset + length - 1}"},
+            )
+            self._stream = urllib.request.urlopen(request)
+            if self._stream.status != 206:
+                raise OSError(f"{request.full_url} does not support range requests")
+        else:
+            self._stream = open(os.path.join(source, part), "rb")
+            self._stream.seek(offset)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = min(len(buffer), self.remaining)
+        if n == 0:
+            return 0
+        data = self._stream.read(n)
+        buffer[: len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        self._stream.close()
+        super().close()
+
+
+def parse_scan_nums(values):
+    """Scan numbers from arguments like 516 or 520-523."""
+    scan_nums = []
+    for value in values:
+        first, _, last = value.partition("-")
+        scan_nums.extend(range(int(first), int(last or first) + 1))
+    return scan_nums
+
+
+def extract_member(member, source, output_dir):
+    """
+    Decompress one member and write its files to `output_dir`, checking
+    each against the md5 in the index while it is written.
+
+    Returns the names of files whose checksum does not match.
+    """
+    expected = {f["name"]: f["md5"] for f in member["files"]}
+    mismatches = []
+
+    reader = RangeReader(source, member["part"], member["offset"], member["length"])
+    with io.BufferedReader(reader, BLOCK_SIZE) as raw, gzip.GzipFile(
+        fileobj=raw
+    ) as gz, tarfile.open(fileobj=gz, mode="r|") as tar:
+        for info in tar:
+            if not info.isfile():
+                continue
+            name = os.path.basename(info.name)
+            output_path = os.path.join(output_dir, name)
+            tmp_path = output_path + ".part"
+
+            md5 = new_hash("md5")
+            with tar.extractfile(info) as src, open(tmp_path, "wb") as dst:
+                while block := src.read(BLOCK_SIZE):
+                    md5.update(block)
+                    dst.write(block)
+
+            if md5.hexdigest() != expected.get(name):
+                mismatches.append(name)
+                print(f"{name}: MISMATCH, kept as {tmp_path}")
+                continue
+            os.replace(tmp_path, output_path)
+            print(f"{name}: MATCH")
+
+    return mismatches
+
+
+def main(index_file, source, output_dir, scan_nums):
+    with open(index_file) as f:
+        index = json.load(f)
+    members = {member["scan_num"]: member for member in index["members"]}
+
+    missing = [n for n in scan_nums if n not in members]
+    if missing:
+        print(f"Scans not in the index: {missing}")
+
+    os.makedirs(output_dir, exist_ok=True)
+    mismatches = []
+    for scan_num in scan_nums:
+        if scan_num in members:
+            mismatches += extract_member(members[scan_num], source, output_dir)
+    return mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract scans from packaged parts.")
+    parser.add_argument("--index", required=True, help="Index written by package.py.")
+    parser.add_argument(
+        "--source",
+        required=True,
+        help="Directory holding the parts, or the base URL they can be fetched from.",
+    )
+    parser.add_argument("--output_dir", default=".", help="Where to write the files.")
+    parser.add_argument(
+        "--scan",
+        action="append",
+        required=True,
+        help="Scan number or range like 520-523. Can be given more than once.",
+    )
+    args = parser.parse_args()
+
+    mismatches = main(
+        args.index, args.source, args.output_dir, parse_scan_nums(args.scan)
+    )
+    if mismatches:
+        raise SystemExit(f"{len(mismatches)} files did not match their checksum")
@@ -0,0 +1,255 @@
+"""
+Package the data as independently compressed per-scan members, split into
+parts for Zenodo, with a JSON index of where each scan is.
+
+Each member is one gzip stream holding the tar entries of one scan (the
+4D Camera file and its DM4 image). Members are appended back to back and
+the last part ends with the tar end-of-archive blocks, so the parts
+concatenated are still one valid .tar.gz:
+
+    cat counted_data_part_*.tar.gz | pigz -d | tar xvf -
+
+while extract_scans.py can fetch and decompress single scans using the
+byte offsets in the index. Members are compressed in parallel; parts only
+split on member boundaries.
+
+    python package.py --directory /path/to/counted_data --output_dir parts
+"""
+
+import argparse
+import gzip
+import json
+import os
+import re
+import tarfile
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from checksum import BLOCK_SIZE, new_hash
+
+INDEX_VERSION = 1
+
+RAW_PATTERN = re.compile(r"^FOURD_\d{6}_\d{4}_\d{5,}_(\d{5,})\.h5$")
+# The binned datacube, and the parallax and ptycho results written next to it
+PROCESSED_PATTERN = re.compile(
+    r"^FOURD_\d{6}_\d{4}_\d{5,}_(\d{5,})_(?:binned_calibrated|results)\.h5$"
+)
+DM4_PATTERN = re.compile(r"^scan(\d+)\.dm4$")
+
+# Two empty records end a tar archive
+TAR_END = b"\0" * (2 * tarfile.BLOCKSIZE)
+
+
+def find_scans(directory, min_scan_num, max_scan_num, processed=False):
+    """Group the data files of each scan in a range, by scan number."""
+    patterns = [PROCESSED_PATTERN if processed else RAW_PATTERN, DM4_PATTERN]
+    scans = defaultdict(list)
+    for entry in os.scandir(directory):
+        for pattern in patterns:
+            match = pattern.match(entry.name)
+            if match and min_scan_num <= int(match.group(1)) <= max_scan_num:
+                scans[int(match.group(1))].append(entry.path)
+    return {scan_num: sorted(files) for scan_num, files in sorted(scans.items())}
+
+
+def write_member(file_paths, member_path, compresslevel):
+    """
+    Write the tar entries of `file_paths`, without the end-of-archive
+    blocks, as one gzip stream. The files are hashed while they are read.
+
+    Returns the md5 and size of each file, by name.
+    """
+    files = []
+    with open(member_path, "wb") as raw, gzip.GzipFile(
+        filename="", mode="wb", fileobj=raw, compresslevel=compresslevel, mtime=0
+    ) as gz:
+        for file_path in file_paths:
+            stat = os.stat(file_path)
+            info = tarfile.TarInfo(os.path.basename(file_path))
+            info.size = stat.st_size
+            info.mtime = int(stat.st_mtime)
+            info.mode = 0o644
+            gz.write(info.tobuf(tarfile.GNU_FORMAT, "utf-8", "surrogateescape"))
+
+            md5 = new_hash("md5")
+            with open(file_path, "rb") as f:
+                while block := f.read(BLOCK_SIZE):
+                    md5.update(block)
+                    gz.write(block)
+            gz.write(b"\0" * (-stat.st_size % tarfile.BLOCKSIZE))
+
+            files.append({"name": info.name, "size": info.size, "md5": md5.hexdigest()})
+    return files
+
+
+def write_end_member(member_path):
+    with open(member_path, "wb") as raw, gzip.GzipFile(
+        filename="", mode="wb", fileobj=raw, mtime=0
+    ) as gz:
+        gz.write(TAR_END)
+
+
+class PartWriter:
+    """Append members to numbered parts, starting a new part when one is full."""
+
+    def __init__(self, output_dir, prefix, max_part_size):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.max_part_size = max_part_size
+        self.parts = []
+        self._file = None
+        self._md5 = None
+
+    def _open_part(self):
+        self._close_part()
+        name = f"{self.prefix}_part_{len(self.parts):02d}.tar.gz"
+        self._file = open(os.path.join(self.output_dir, name), "wb")
+        self._md5 = new_hash("md5")
+        self.parts.append({"name": name, "size": 0})
+
+    def _close_part(self):
+        if self._file is not None:
+            self._file.close()
+            self.parts[-1]["md5"] = self._md5.hexdigest()
+            self._file = None
+
+    def append(self, member_path, split=True):
+        """
+        Append a member file and return (part name, offset, length, md5).
+        Without `split`, the member goes into the current part even if full.
+        """
+        length = os.path.getsize(member_path)
+        if self._file is None or (
+            split
+            and self.parts[-1]["size"] > 0
+            and self.parts[-1]["size"] + length > self.max_part_size
+        ):
+            self._open_part()
+
+        part = self.parts[-1]
+        offset = part["size"]
+        md5 = new_hash("md5")
+        with open(member_path, "rb") as f:
+            while block := f.read(BLOCK_SIZE):
+                md5.update(block)
+                self._md5.update(block)
+                self._file.write(block)
+        part["size"] += length
+        return part["name"], offset, length, md5.hexdigest()
+
+    def close(self):
+        self._close_part()
+
+
+def package(
+    scans, output_dir, prefix, max_part_size, num_workers=None, compresslevel=6
+):
+    """
+    Compress the members of `scans` in parallel and append them to parts in
+    scan order, as each finishes. Only about two members per worker wait on
+    disk at a time, so the staging space stays small.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    num_workers = num_workers or os.cpu_count() or 1
+    scan_nums = list(scans)
+    members = []
+    writer = PartWriter(output_dir, prefix, max_part_size)
+
+    with tempfile.TemporaryDirectory(dir=output_dir) as staging, ThreadPoolExecutor(
+        max_workers=num_workers
+    ) as executor:
+
+        def submit(scan_num):
+            member_path = os.path.join(staging, f"{scan_num}.tar.gz")
+            future = executor.submit(
+                write_member, scans[scan_num], member_path, compresslevel
+            )
+            return member_path, future
+
+        pending = [submit(n) for n in scan_nums[: 2 * num_workers]]
+        next_scan = len(pending)
+
+        for scan_num in scan_nums:
+            member_path, future = pending.pop(0)
+            files = future.result()
+            if next_scan < len(scan_nums):
+                pending.append(submit(scan_nums[next_scan]))
+                next_scan += 1
+
+            part, offset, length, md5 = writer.append(member_path)
+            os.remove(member_path)
+            members.append(
+                {
+                    "scan_num": scan_num,
+                    "part": part,
+                    "offset": offset,
+                    "length": length,
+                    "md5": md5,
+                    "files": files,
+                }
+            )
+            print(f"Packed scan {scan_num} into {part} ({length / 1e9:.2f} GB)")
+
+        end_path = os.path.join(staging, "end.tar.gz")
+        write_end_member(end_path)
+        writer.append(end_path, split=False)
+        writer.close()
+
+    index = {
+        "version": INDEX_VERSION,
+        "format": "concatenated per-scan tar.gz members",
+        "parts": writer.parts,
+        "members": members,
+    }
+    index_path = os.path.join(output_dir, f"{prefix}_index.json")
+    with open(index_path, "w") as f:
+        json.dump(index, f, indent=2)
+
+    # The checksums taken while packing, in the format check_md5.py reads
+    with open(os.path.join(output_dir, f"{prefix}_md5sums.txt"), "w") as f:
+        for member in members:
+            for file in member["files"]:
+                f.write(f"{file['name']}: {file['md5']}\n")
+
+    return index_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Package scans as per-scan tar.gz members split into parts."
+    )
+    parser.add_argument("--directory", required=True, help="Directory of the data.")
+    parser.add_argument("--output_dir", required=True, help="Where to write parts.")
+    parser.add_argument("--prefix", default="counted_data", help="Part name prefix.")
+    parser.add_argument("--min_scan_num", type=int, default=516)
+    parser.add_argument("--max_scan_num", type=int, default=575)
+    parser.add_argument(
+        "--processed",
+        action="store_true",
+        help="Package the _binned_calibrated.h5 and _results.h5 files instead of the raw data.",
+    )
+    parser.add_argument(
+        "--max_part_gb",
+        type=float,
+        default=30,
+        help="Largest part size in GB (1024**3 bytes), 30 as for the upload so far.",
+    )
+    parser.add_argument("--compresslevel", type=int, default=6)
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Members compressed at once."
+    )
+    args = parser.parse_args()
+
+    scans = find_scans(
+        args.directory, args.min_scan_num, args.max_scan_num, args.processed
+    )
+    index_path = package(
+        scans,
+        args.output_dir,
+        args.prefix,
+        int(args.max_part_gb * 1024**3),
+        args.workers,
+        args.compresslevel,
+    )
+    print(f"Index saved to {index_path}")
@@ -0,0 +1,211 @@
+"""
+Restore the data from its split parts in one pass: the parts are read in
+order as one stream, decompressed and untarred on the fly, and each file
+is hashed while it is written and checked against md5sums.txt.
+
+    python restore.py --source /path/to/downloaded/parts --output_dir untarred
+    python restore.py --output_dir untarred https://.../counted_data_part_00.tar.gz ...
+
+Each file is written as <name>.part and renamed once its checksum
+matches, and its result is appended to the results file right away, so
+verified scans can be analysed while the rest is restored. A restore
+that is interrupted can be run again: files already verified are skipped
+rather than rewritten, though the stream still has to be read up to
+where it stopped.
+"""
+
+import argparse
+import glob
+import gzip
+import io
+import os
+import pathlib
+import shutil
+import subprocess
+import tarfile
+import threading
+import urllib.request
+
+from checksum import BLOCK_SIZE, Progress, new_hash, open_for_append, read_sums
+
+
+def open_part(part):
+    if part.startswith(("http://", "https://")):
+        return urllib.request.urlopen(part)
+    return open(part, "rb")
+
+
+class ConcatReader(io.RawIOBase):
+    """Read a list of files or URLs as one stream, opening each in turn."""
+
+    def __init__(self, parts):
+        self.parts = list(parts)
+        self._stream = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while True:
+            if self._stream is None:
+                if not self.parts:
+                    return 0
+                part = self.parts.pop(0)
+                print(f"Reading {part}")
+                self._stream = open_part(part)
+
+            data = self._stream.read(len(buffer))
+            if data:
+                buffer[: len(data)] = data
+                return len(data)
+            self._stream.close()
+            self._stream = None
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+        super().close()
+
+
+def open_decompressed(parts):
+    """
+    Decompress the concatenated parts, with pigz on its own threads if it
+    is installed, else with the gzip module.
+    """
+    stream = io.BufferedReader(ConcatReader(parts), BLOCK_SIZE)
+    if shutil.which("pigz") is None:
+        return gzip.GzipFile(fileobj=stream), None
+
+    process = subprocess.Popen(
+        ["pigz", "-d", "-c"], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    )
+
+    def feed():
+        try:
+            while block := stream.read(BLOCK_SIZE):
+                process.stdin.write(block)
+        except BrokenPipeError:
+            pass
+        finally:
+            process.stdin.close()
+            stream.close()
+
+    feeder = threading.Thread(target=feed, name="feed_pigz", daemon=True)
+    feeder.start()
+    return process.stdout, process
+
+
+def read_verified(output_file):
+    """Files an earlier run restored and verified."""
+    verified = set()
+    if os.path.exists(output_file):
+        with open(output_file) as f:
+            for line in f:
+                file_path, _, result = line.partition(": ")
+                if result.startswith("MATCH (") and line.endswith(")\n"):
+                    verified.add(file_path)
+    return verified
+
+
+def restore(parts, output_dir, md5sums_file, output_file):
+    expected_sums = read_sums(md5sums_file, "md5")
+    done = read_verified(output_file)
+    os.makedirs(output_dir, exist_ok=True)
+    progress = Progress(len(expected_sums), 0)
+
+    counts = {"MATCH": 0, "MISMATCH": 0, "UNKNOWN": 0, "SKIPPED": 0}
+    data, process = open_decompressed(parts)
+    with open_for_append(output_file) as results, tarfile.open(
+        fileobj=data, mode="r|"
+    ) as tar:
+        for info in tar:
+            if not info.isfile():
+                continue
+            name = os.path.basename(info.name)
+            file_path = os.path.join(output_dir, name)
+
+            # Already verified by an earlier run; the stream skips its data
+            if file_path in done and os.path.exists(file_path):
+                counts["SKIPPED"] += 1
+                continue
+
+            md5 = new_hash("md5")
+            tmp_path = file_path + ".part"
+            with tar.extractfile(info) as src, open(tmp_path, "wb") as dst:
+                while block := src.read(BLOCK_SIZE):
+                    md5.update(block)
+                    dst.write(block)
+            actual = md5.hexdigest()
+
+            expected = expected_sums.get(name)
+            if expected is None:
+                status = "UNKNOWN"
+                os.replace(tmp_path, file_path)
+            elif expected == actual:
+                status = "MATCH"
+                os.replace(tmp_path, file_path)
+            else:
+                status = "MISMATCH"
+            counts[status] += 1
+
+            results.write(
+                f"{file_path}: {status} (expected: {expected}, actual: {actual})\n"
+            )
+            results.flush()
+            progress.update(info.size)
+
+    data.close()
+    if process is not None and process.wait() != 0:
+        raise RuntimeError(f"pigz exited with status {process.returncode}")
+    progress.report()
+    return counts
+
+
+if __name__ == "__main__":
+    HERE = pathlib.Path(__file__).parent
+
+    parser = argparse.ArgumentParser(
+        description="Concatenate, decompress, untar and verify the parts in one pass."
+    )
+    parser.add_argument(
+        "parts",
+        nargs="*",
+        help="Part files or URLs, in order. Defaults to the parts in --source.",
+    )
+    parser.add_argument(
+        "--source",
+        default=None,
+        help="Directory with the downloaded <prefix>_part_*.tar.gz files.",
+    )
+    parser.add_argument("--prefix", default="counted_data", help="Part name prefix.")
+    parser.add_argument(
+        "--output_dir", required=True, help="Directory to restore the files to."
+    )
+    parser.add_argument(
+        "--sums_file",
+        default=str(HERE / "md5sums.txt"),
+        help="File containing the expected checksums.",
+    )
+    parser.add_argument(
+        "--output_file",
+        default="comparison_results.txt",
+        help="File to append the verification results to.",
+    )
+    args = parser.parse_args()
+
+    parts = args.parts
+    if not parts:
+        if args.source is None:
+            parser.error("give the parts or --source")
+        parts = sorted(
+            glob.glob(os.path.join(args.source, f"{args.prefix}_part_*.tar.gz"))
+        )
+    if not parts:
+        parser.error("no parts found")
+    if not os.path.exists(args.sums_file):
+        parser.error(f"{args.sums_file} does not exist")
+
+    counts = restore(parts, args.output_dir, args.sums_file, args.output_file)
+    print(f"Results saved to {args.output_file}: {counts}")
+    if counts["MISMATCH"]:
+        raise SystemExit(1)
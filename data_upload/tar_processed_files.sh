@@ -6,7 +6,7 @@ files_to_tar=""
 # Loop over the range of scan numbers
 for scan_number in $(seq 516 575); do
     # Use a wildcard to match any file that fits the pattern
-    for file in FOURD_*_*_*_00${scan_number}_binned_calibrated.h5; do
+    for file in FOURD_*_*_*_00${scan_number}_binned_calibrated.h5 FOURD_*_*_*_00${scan_number}_results.h5; do
         # Check if the file exists
         if [[ -f $file ]]; then
             echo "Adding $file to the tar archive."
@@ -1,14 +1,50 @@
+"""
+Build the acquisition timeline of each session in inputs.json: match each
+DM4 image to the 4D Camera file of the same scan and write both creation
+times, and the time between them, to matched_files.csv.
+
+    python extract_timestamps.py
+    python extract_timestamps.py --append --parquet matched_files.parquet
+
+Each directory is listed once, however many sessions share it, and each
+file is stat'ed once, on a thread pool shared by all sessions so the
+network file system sees many requests at a time. The CSV is rewritten
+from scratch by default. With --append, scans already in it are not
+stat'ed again and only the rows of new scans are added, so adding a
+session only costs the stats of its own files.
+"""
+
+import argparse
 import csv
 import json
+import os
+import sys
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple, Union
-
-import stempy.contrib as contrib
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
 
 # Assuming the location of the current script is the same as 'inputs.json'
 HERE = Path(__file__).parent
 
+# The ptycho package is not installed; put the copy in this repository
+# first so that another package of the same name cannot shadow it
+sys.path.insert(0, str(HERE.parent / "ptycho"))
+from ptycho.scan_index import ScanIndex, get_index_path
+
+HEADERS = [
+    "Description",
+    "Date",
+    "ScanNo",
+    "DM4 Path",
+    "H5 Path",
+    "Streaming",
+    "DM4 DateTime",
+    "HDF5 DateTime",
+    "Duration (s)",
+]
+
 
 def posix_to_datetime(file_path: Path) -> Optional[datetime]:
     """
@@ -32,129 +68,309 @@ def posix_to_datetime(file_path: Path) -> Optional[datetime]:
         return None
 
 
-def list_files(directory: Path, extension: str) -> List[Path]:
-    """
-    Lists all files in a given directory with a specific extension.
+def list_files(directory: Path, extension: str) -> Dict[int, Path]:
     """
-    return [
-        file for file in directory.glob(f"*{extension}") if "_centered" not in str(file)
-    ]
-
-
-def match_files(
-    dm4_dir: Path,
-    hdf5_dir: Path,
-    image_ext: str,
-    data_ext: str,
-    scan_range: Tuple[int, int],
-) -> List[tuple[Path, Path]]:
+    Lists the scanN<extension> files in a directory, in one pass, by scan number.
     """
-    Matches files in two directories based on sequence numbers in their names and filters them by a given scan range.
-    """
-    dm4_files = list_files(dm4_dir, image_ext)
-    # files2 = list_files(hdf5_dir, data_ext)
-    matched_files = []
-
-    for dm4_file in dm4_files:
-        scan_num = int(dm4_file.stem.split("scan")[-1])
-        if scan_range[0] <= scan_num <= scan_range[1]:
-            try:
-                hdf5_file, _, _ = contrib.get_scan_path(hdf5_dir, scan_num=scan_num)
-                matched_files.append((scan_num, dm4_file, hdf5_file))
-            except FileNotFoundError:
+    files = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            name = entry.name
+            if not name.endswith(extension) or "_centered" in name:
                 continue
+            try:
+                scan_num = int(name[: -len(extension)].split("scan")[-1])
             except ValueError:
                 continue
-
-    matched_files.sort(key=lambda x: int(x[0]))
-    return matched_files
+            files[scan_num] = Path(entry.path)
+    return files
 
 
-def write_to_csv(matched_data: List[Dict], csv_filename: Union[Path, str]):
-    """
-    Writes matched files information to a CSV, including new columns for creation dates and duration.
-    """
-    headers = [
-        "Description",
-        "Date",
-        "ScanNo",
-        "DM4 Path",
-        "H5 Path",
-        "Streaming",
-        "DM4 DateTime",
-        "HDF5 DateTime",
-        "Duration (s)",
-    ]
-
-    with open(csv_filename, "w", newline="") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=headers)
-        writer.writeheader()
-        for item in matched_data:
-            writer.writerows(item["rows"])
-
-
-def calculate_duration(dm4_path: Path, h5_path: Path) -> Optional[float]:
+def calculate_duration(
+    dm4_datetime: Optional[datetime], hdf5_datetime: Optional[datetime]
+) -> Optional[float]:
     """
     Calculate the duration in seconds between the creation times of a .dm4 file and its corresponding .h5 file.
     """
-    dm4_datetime = posix_to_datetime(dm4_path)
-    hdf5_datetime = posix_to_datetime(h5_path)
-
     if dm4_datetime and hdf5_datetime:
-        duration_seconds = (hdf5_datetime - dm4_datetime).total_seconds()
-        return duration_seconds
+        return (hdf5_datetime - dm4_datetime).total_seconds()
     return None
 
 
-def process_datasets(datasets):
+def read_done(csv_filename: Union[Path, str]) -> Set[Tuple[str, int]]:
     """
-    Processes datasets to match files, calculate durations, and write results to a CSV.
+    The (description, scan number) of each row already in the CSV.
     """
-    all_data = []
+    done = set()
+    if not os.path.exists(csv_filename):
+        return done
+    with open(csv_filename, newline="") as csvfile:
+        reader = csv.DictReader(csvfile)
+        if reader.fieldnames != HEADERS:
+            raise ValueError(
+                f"{csv_filename} has columns {reader.fieldnames}, expected {HEADERS}"
+            )
+        for row in reader:
+            done.add((row["Description"], int(row["ScanNo"])))
+    return done
+
+
+class TimelineExtractor:
+    """
+    Match and time the files of many datasets, sharing directory listings
+    and stat results between them.
+
+    Args:
+        index_dir (Path): Where the scan indexes of the data directories are cached.
+        max_workers (int): Number of stats in flight at once.
+    """
+
+    def __init__(self, index_dir: Path, max_workers: int = 32):
+        self.index_dir = Path(index_dir)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = Lock()
+        self._listings: Dict[Tuple[Path, str], Future] = {}
+        self._indexes: Dict[Path, Future] = {}
+        self._ctimes: Dict[Path, Future] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.executor.shutdown()
+
+    def _cached(self, cache: Dict, key, fn, *args) -> Future:
+        with self._lock:
+            if key not in cache:
+                cache[key] = self.executor.submit(fn, *args)
+            return cache[key]
+
+    def _refresh_index(self, hdf5_dir: Path) -> ScanIndex:
+        index_path = get_index_path(hdf5_dir, self.index_dir, legacy=True)
+        scan_index = ScanIndex(hdf5_dir, index_path, legacy=True)
+        scan_index.refresh()
+        return scan_index
 
-    for dataset in datasets:
-        dm4_dir = Path(dataset["dm4_dir"])
-        data_dir = Path(dataset["data_dir"])
-        scan_range = tuple(dataset["scan_range"])
+    def creation_time(self, file_path: Path) -> Future:
+        """The creation time of a file, stat'ed once however often it is asked for."""
+        return self._cached(self._ctimes, file_path, posix_to_datetime, file_path)
 
-        data_extension: str = ".h5"
-        if "data_extension" in dataset:
-            data_extension = dataset["data_extension"]
+    def match_files(
+        self,
+        dm4_dir: Path,
+        hdf5_dir: Path,
+        image_ext: str,
+        data_ext: str,
+        scan_range: Tuple[int, int],
+    ) -> List[Tuple[int, Path, Path]]:
+        """
+        Matches files in two directories based on sequence numbers in their names and filters them by a given scan range.
 
-        matched_files = match_files(
-            dm4_dir, data_dir, ".dm4", data_extension, scan_range
+        Scans with more than one data file are left out.
+        """
+        listing = self._cached(
+            self._listings, (dm4_dir, image_ext), list_files, dm4_dir, image_ext
         )
+        scan_index = self._cached(
+            self._indexes, hdf5_dir, self._refresh_index, hdf5_dir
+        ).result()
+        hdf5_files = {
+            scan_num: entries[0].path
+            for scan_num, entries in scan_index.by_scan_num(*scan_range).items()
+            if len(entries) == 1 and entries[0].path.name.endswith(data_ext)
+        }
+
+        return [
+            (scan_num, dm4_file, hdf5_files[scan_num])
+            for scan_num, dm4_file in sorted(listing.result().items())
+            if scan_range[0] <= scan_num <= scan_range[1] and scan_num in hdf5_files
+        ]
+
+    def process_dataset(self, dataset: Dict, done: Set[Tuple[str, int]]) -> List[Dict]:
+        """
+        The CSV rows of one dataset's scans that are not in `done`.
+        """
+        data_extension: str = dataset.get("data_extension", ".h5")
+        all_matched = self.match_files(
+            Path(dataset["dm4_dir"]),
+            Path(dataset["data_dir"]),
+            ".dm4",
+            data_extension,
+            tuple(dataset["scan_range"]),
+        )
+        # A session that matches nothing is more likely a wrong extension or
+        # path than an empty session, and would drop its rows on a rewrite
+        if not all_matched:
+            print(
+                f"Warning: {dataset['description']} matched no files with "
+                f"extension {data_extension} in {dataset['data_dir']}"
+            )
+        matched_files = [
+            match
+            for match in all_matched
+            if (dataset["description"], match[0]) not in done
+        ]
+
+        # Submit every stat before waiting on any
+        times = [
+            (self.creation_time(dm4_path), self.creation_time(h5_path))
+            for _, dm4_path, h5_path in matched_files
+        ]
 
         rows = []
-        for scan_num, dm4_path, h5_path in matched_files:
-            duration_seconds = calculate_duration(dm4_path, h5_path)
-            row = {
-                "Description": dataset["description"],
-                "Date": dataset["date"],
-                "ScanNo": scan_num,
-                "DM4 Path": dm4_path.as_posix(),
-                "H5 Path": h5_path.as_posix(),
-                "Streaming": dataset.get("streaming", False),
-                "DM4 DateTime": (
-                    posix_to_datetime(dm4_path).isoformat() if dm4_path else "N/A"
-                ),
-                "HDF5 DateTime": (
-                    posix_to_datetime(h5_path).isoformat() if h5_path else "N/A"
-                ),
-                "Duration (s)": (
-                    duration_seconds if duration_seconds is not None else "N/A"
-                ),
-            }
-            rows.append(row)
-
-        all_data.append({"rows": rows})
-
-    write_to_csv(all_data, HERE / "matched_files.csv")
-
-
-# Load datasets from 'inputs.json'
-with open(HERE / "inputs.json", "r") as file:
-    datasets = json.load(file)
-
-# Process datasets
-process_datasets(datasets)
+        for (scan_num, dm4_path, h5_path), (dm4_time, h5_time) in zip(
+            matched_files, times
+        ):
+            dm4_datetime = dm4_time.result()
+            hdf5_datetime = h5_time.result()
+            duration_seconds = calculate_duration(dm4_datetime, hdf5_datetime)
+            rows.append(
+                {
+                    "Description": dataset["description"],
+                    "Date": dataset["date"],
+                    "ScanNo": scan_num,
+                    "DM4 Path": dm4_path.as_posix(),
+                    "H5 Path": h5_path.as_posix(),
+                    "Streaming": dataset.get("streaming", False),
+                    "DM4 DateTime": (
+                        dm4_datetime.isoformat() if dm4_datetime else "N/A"
+                    ),
+                    "HDF5 DateTime": (
+                        hdf5_datetime.isoformat() if hdf5_datetime else "N/A"
+                    ),
+                    "Duration (s)": (
+                        duration_seconds if duration_seconds is not None else "N/A"
+                    ),
+                }
+            )
+        return rows
+
+
+def process_datasets(
+    datasets: Iterable[Dict],
+    csv_filename: Union[Path, str] = HERE / "matched_files.csv",
+    append: bool = False,
+    max_workers: int = 32,
+    index_dir: Optional[Path] = None,
+) -> int:
+    """
+    Processes datasets to match files, calculate durations, and write results
+    to a CSV, in dataset order, as each dataset finishes.
+
+    Args:
+        datasets (Iterable[Dict]): Entries as in inputs.json.
+        csv_filename (Union[Path, str]): The CSV to write.
+        append (bool): Only add the rows of scans not already in the CSV.
+        max_workers (int): Number of stats in flight at once.
+        index_dir (Path): Where the scan indexes are cached, by default
+                          scan_index/ next to the CSV.
+
+    Returns:
+        int: The number of rows written.
+    """
+    if index_dir is None:
+        index_dir = Path(csv_filename).parent / "scan_index"
+
+    # A rewrite is written next to the CSV and only replaces it if every
+    # session in `datasets` that had rows still has some
+    previous: Set[Tuple[str, int]] = set()
+    output = csv_filename
+    if not append:
+        previous = read_done(csv_filename)
+        output = f"{csv_filename}.rebuild"
+        if os.path.exists(output):
+            os.remove(output)
+    done = read_done(output)
+    write_header = not os.path.exists(output)
+
+    num_rows = 0
+    with TimelineExtractor(index_dir, max_workers) as extractor, open(
+        output, "a", newline=""
+    ) as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=HEADERS)
+        if write_header:
+            writer.writeheader()
+
+        # Datasets run side by side on their own threads, so the stats of
+        # all of them share the extractor's pool
+        with ThreadPoolExecutor(max_workers=4) as dataset_executor:
+            futures = [
+                dataset_executor.submit(extractor.process_dataset, dataset, done)
+                for dataset in datasets
+            ]
+            for dataset, future in zip(datasets, futures):
+                rows = future.result()
+                writer.writerows(rows)
+                csvfile.flush()
+                num_rows += len(rows)
+                print(f"{dataset['description']}: {len(rows)} new scans")
+
+    if not append:
+        rebuilt = {description for description, _ in read_done(output)}
+        lost = sorted(
+            {description for description, _ in previous}
+            & {dataset["description"] for dataset in datasets} - rebuilt
+        )
+        if lost:
+            raise ValueError(
+                f"Sessions {lost} have rows in {csv_filename} but matched no "
+                f"files; keeping it, the rebuild is in {output}"
+            )
+        os.replace(output, csv_filename)
+    return num_rows
+
+
+def write_parquet(csv_filename: Union[Path, str], parquet_filename: Union[Path, str]):
+    """
+    Writes the CSV to Parquet, parsing the dates as the notebook does.
+    """
+    import pandas as pd
+
+    df = pd.read_csv(csv_filename, parse_dates=["DM4 DateTime", "HDF5 DateTime"])
+    df.to_parquet(parquet_filename, index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Match DM4 and 4D Camera files and extract their timestamps."
+    )
+    parser.add_argument(
+        "--inputs", default=str(HERE / "inputs.json"), help="Datasets to process."
+    )
+    parser.add_argument(
+        "--output", default=str(HERE / "matched_files.csv"), help="CSV to write."
+    )
+    parser.add_argument(
+        "--parquet",
+        default=None,
+        help="Also write the whole table to this Parquet file (needs pyarrow).",
+    )
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        help="Only add the scans not already in the CSV, instead of rewriting it.",
+    )
+    parser.add_argument(
+        "--index_dir",
+        type=Path,
+        default=None,
+        help="Where to cache the scan index of each data directory "
+        "(default: scan_index/ next to the CSV).",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=32, help="Number of stats in flight at once."
+    )
+    args = parser.parse_args()
+
+    # Load datasets from 'inputs.json'
+    with open(args.inputs, "r") as file:
+        datasets = json.load(file)
+
+    num_rows = process_datasets(
+        datasets, args.output, args.append, args.workers, args.index_dir
+    )
+    print(
+        f"{num_rows} rows {'added to' if args.append else 'written to'} {args.output}"
+    )
+    if args.parquet:
+        write_parquet(args.output, args.parquet)
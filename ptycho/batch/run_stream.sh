@@ -0,0 +1,7 @@
+#!/bin/bash
+
+cd $(dirname "$0")
+source ./set_environment.sh
+
+# Submit the job
+sbatch ./stream.sh
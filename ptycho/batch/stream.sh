@@ -0,0 +1,20 @@
+#!/bin/bash
+
+#SBATCH --qos=regular
+#SBATCH --constraint=gpu
+#SBATCH --nodes=1
+#SBATCH --time=01:30:00
+#SBATCH --job-name=stream_dpc_parallax_ptycho
+#SBATCH --exclusive
+#SBATCH --account=m3795
+
+srun -n 1 -c 32 -G 1 --gpus-per-task=1 \
+    podman-hpc run --gpu \
+        -v ${WORKING_DIR}/../ptycho:/analysis/ptycho \
+        -v ${COUNTED_DATA_DIR}:/mnt/counted_data \
+        -v ${SCRIPTS_DIR}:/analysis/scripts \
+        -v ${CONFIG_DIR}:/analysis/config \
+        samwelborn/streaming-paper-ptycho:latest \
+            python /analysis/scripts/stream.py \
+            --config_file="/analysis/config/general_config.json" \
+            --analysis_config_file="/analysis/config/dpc_parallax_ptycho_params.json"
@@ -0,0 +1,96 @@
+"""
+Check DriftTracker against ncempy.eval.stack_align on the shipped stack of
+rotated ptycho objects, and time both.
+
+    python benchmarks/drift.py --npy_dir outputs/ptycho_npy
+
+The drift must agree, sign included, with the `align_type="dynamic"`
+alignment the drift plots were made with before the tracker replaced it.
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+import ncempy.eval
+import numpy as np
+from scipy import ndimage
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from ptycho.drift import DriftTracker
+
+# The parameters plots.py uses
+UPSAMPLE_FACTOR = 50
+SIGMA = 2
+BORDER = 20
+
+
+def load_frames(npy_dir: Path) -> List[np.ndarray]:
+    """Phase of each rotated object, in scan number order."""
+    paths = sorted(
+        npy_dir.glob("*_rotated_object.npy"),
+        key=lambda path: int(path.stem.split("_")[4]),
+    )
+    return [np.angle(np.load(path)) for path in paths]
+
+
+def stack_align_shifts(frames: List[np.ndarray]) -> np.ndarray:
+    """The drift as plots.py measured it with ncempy."""
+    smooth = np.stack([ndimage.gaussian_filter(frame, SIGMA) for frame in frames])
+    _, shifts = ncempy.eval.stack_align(
+        smooth[:, BORDER:-BORDER, BORDER:-BORDER],
+        upsample_factor=UPSAMPLE_FACTOR,
+        align_type="dynamic",
+        method="cross",
+    )
+    return shifts
+
+
+def tracker_shifts(frames: List[np.ndarray]) -> np.ndarray:
+    tracker = DriftTracker(upsample_factor=UPSAMPLE_FACTOR, sigma=SIGMA, border=BORDER)
+    return tracker.add_frames(frames)
+
+
+def timed(func, *args) -> Tuple[float, np.ndarray]:
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--npy_dir",
+        type=Path,
+        default=Path(__file__).resolve().parents[1] / "outputs" / "ptycho_npy",
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=1e-6, help="Largest difference in pixels."
+    )
+    args = parser.parse_args()
+
+    frames = load_frames(args.npy_dir)
+    if len(frames) < 2:
+        sys.exit(f"Need at least 2 rotated objects in {args.npy_dir}")
+    print(f"{len(frames)} frames of {frames[0].shape} from {args.npy_dir}")
+
+    t_ncempy, expected = timed(stack_align_shifts, frames)
+    t_tracker, shifts = timed(tracker_shifts, frames)
+
+    difference = np.abs(shifts - expected).max()
+    print(f"{'':<14}{'time [s]':>10}")
+    print(f"{'stack_align':<14}{t_ncempy:>10.3f}")
+    print(f"{'DriftTracker':<14}{t_tracker:>10.3f}")
+    print(
+        f"Largest drift {np.abs(expected).max():.2f} px, "
+        f"largest difference {difference:.2e} px"
+    )
+    if difference > args.tolerance:
+        sys.exit(f"DriftTracker differs from stack_align by {difference:.2e} px")
+
+
+if __name__ == "__main__":
+    main()
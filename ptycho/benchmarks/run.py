@@ -0,0 +1,361 @@
+"""
+Benchmark binning, validation and repair, and HDF5 I/O on synthetic data,
+on CPU and without the real dataset.
+
+    python benchmarks/run.py --scan_size 256 --frame_size 576 --num_scans 4
+
+Prints one table per suite and optionally writes every result to a JSON
+file, to compare runs across machines or commits.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import h5py
+import numpy as np
+import stempy.io as stio
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+sys.path.append(str(Path(__file__).resolve().parent))
+
+from synthetic import make_dense_cube, make_ptycho_cube, write_sparse_scans
+
+from ptycho.backend import configure_backend
+from ptycho.binning import bin_sparse_to_dense
+from ptycho.schemas import CropData, OutputLayout
+from ptycho.utils import load_and_validate_analysis_json, load_and_validate_config_json
+from ptycho.storage import get_dataset_options, hdf5plugin
+from ptycho.utils import find_bad_patterns, repair_invalid_values, replace_zero_slices
+
+
+def best_of(func: Callable[[], object], repeat: int) -> float:
+    """Best wall time of `repeat` calls, in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def result(suite: str, name: str, seconds: float, num_bytes: int, **extra) -> Dict:
+    return dict(
+        suite=suite,
+        name=name,
+        seconds=seconds,
+        gb_per_s=num_bytes / seconds / 1e9,
+        **extra,
+    )
+
+
+def bench_binning(args, workdir: Path) -> List[Dict]:
+    paths = write_sparse_scans(
+        workdir / "sparse",
+        args.num_scans,
+        (args.scan_size, args.scan_size),
+        (args.frame_size, args.frame_size),
+        args.dose,
+    )
+    num_bytes = sum(p.stat().st_size for p in paths)
+    crop = CropData(
+        x_min=0, x_max=args.scan_size - 1, y_min=0, y_max=args.scan_size - 1
+    )
+
+    start = time.perf_counter()
+    sparse_arrays = [stio.SparseArray.from_hdf5(str(p)) for p in paths]
+    read = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for sparse_array in sparse_arrays:
+        bin_sparse_to_dense(sparse_array, crop, args.bin_factor)
+    binned = time.perf_counter() - start
+
+    return [
+        result(
+            "binning", "read_sparse", read, num_bytes, scans_per_s=len(paths) / read
+        ),
+        result(
+            "binning",
+            "bin_sparse_to_dense",
+            binned,
+            num_bytes,
+            scans_per_s=len(paths) / binned,
+        ),
+    ]
+
+
+def bench_validation(args, cube: np.ndarray) -> List[Dict]:
+    invalid, zero = find_bad_patterns(cube)
+    repaired = cube.copy()
+    repair_invalid_values(repaired, invalid)
+
+    def repair_invalid():
+        repair_invalid_values(cube.copy(), invalid)
+
+    def repair_zero():
+        replace_zero_slices(repaired.copy(), zero & ~invalid)
+
+    # The repairs include copying the cube, so time the copy on its own too
+    return [
+        result(
+            "validation",
+            "find_bad_patterns",
+            best_of(lambda: find_bad_patterns(cube), args.repeat),
+            cube.nbytes,
+            invalid_patterns=int(invalid.sum()),
+            zero_patterns=int(zero.sum()),
+        ),
+        result("validation", "copy", best_of(cube.copy, args.repeat), cube.nbytes),
+        result(
+            "validation",
+            "copy+repair_invalid_values",
+            best_of(repair_invalid, args.repeat),
+            cube.nbytes,
+        ),
+        result(
+            "validation",
+            "copy+replace_zero_slices",
+            best_of(repair_zero, args.repeat),
+            cube.nbytes,
+        ),
+    ]
+
+
+def bench_io(args, cube: np.ndarray, workdir: Path) -> List[Dict]:
+    layouts: Dict[str, Optional[OutputLayout]] = {
+        "contiguous": None,
+        "chunked": OutputLayout(compression=None),
+        "gzip": OutputLayout(compression="gzip"),
+    }
+    if hdf5plugin is not None:
+        layouts["lz4"] = OutputLayout(compression="lz4")
+        layouts["blosc"] = OutputLayout(compression="blosc")
+
+    # A quarter of the scan in each direction, like a parallax crop_R window
+    ny, nx = cube.shape[:2]
+    window = (slice(ny // 4, ny // 2), slice(nx // 4, nx // 2))
+    window_bytes = cube[window].nbytes
+
+    results = []
+    for name, layout in layouts.items():
+        path = workdir / f"cube_{name}.h5"
+        options = get_dataset_options(layout, cube.shape)
+
+        def write():
+            with h5py.File(path, "w") as f:
+                f.create_dataset("data", data=cube, **options)
+
+        def read():
+            with h5py.File(path, "r") as f:
+                f["data"][:]
+
+        def read_window():
+            with h5py.File(path, "r") as f:
+                f["data"][window]
+
+        # Reads are from the page cache, so they measure decoding more than disk
+        t_write = best_of(write, args.repeat)
+        ratio = cube.nbytes / path.stat().st_size
+        results += [
+            result("io", f"write_{name}", t_write, cube.nbytes, ratio=ratio),
+            result("io", f"read_{name}", best_of(read, args.repeat), cube.nbytes),
+            result(
+                "io",
+                f"read_window_{name}",
+                best_of(read_window, args.repeat),
+                window_bytes,
+            ),
+        ]
+    return results
+
+
+def bench_reconstruct(args, workdir: Path) -> List[Dict]:
+    """
+    Run DPC, parallax and ptycho on a simulated scan on the CPU, through
+    the same code as the pipeline, including the CPU backend setup, and
+    save the results. Each result is checked to be finite, and the results
+    file to read back with py4DSTEM, so this doubles as a smoke test.
+    """
+    import py4DSTEM
+
+    from ptycho.reconstruction import run_dpc, run_parallax, run_ptycho, save_results
+    from ptycho.results import get_results_group, get_results_path
+
+    config_dir = Path(__file__).resolve().parents[1] / "config"
+    config = load_and_validate_config_json(config_dir / "general_config.json")
+    analysis_config = load_and_validate_analysis_json(
+        config_dir / "dpc_parallax_ptycho_params.json"
+    )
+    analysis_config.compute.device = "cpu"
+    analysis_config.ptycho.reconstruct.max_iter = args.ptycho_iter
+    crop = analysis_config.parallax.crop_R
+    crop.x_min, crop.x_max = 0, args.recon_scan_size
+    crop.y_min, crop.y_max = 0, args.recon_scan_size
+    configure_backend(analysis_config.compute)
+
+    wavelength = py4DSTEM.process.utils.electron_wavelength_angstrom(
+        config.microscope.beam_energy
+    )
+    cube, r_pixel, q_pixel = make_ptycho_cube(
+        (args.recon_scan_size, args.recon_scan_size),
+        args.recon_frame_size,
+        config.microscope.convergence_semiangle,
+        wavelength,
+    )
+
+    def make_datacube():
+        datacube = py4DSTEM.DataCube(data=cube.copy(), name="synthetic")
+        datacube.calibration.set_R_pixel_size(r_pixel)
+        datacube.calibration.set_R_pixel_units("A")
+        datacube.calibration.set_Q_pixel_size(q_pixel)
+        datacube.calibration.set_Q_pixel_units("mrad")
+        return datacube
+
+    def check(name, values):
+        if not np.all(np.isfinite(values)):
+            raise RuntimeError(f"{name} gave non-finite values on the CPU")
+
+    def dpc():
+        check("DPC", run_dpc(make_datacube(), config, analysis_config).object_phase)
+
+    recons = {}
+
+    def parallax():
+        recons["parallax"] = run_parallax(make_datacube(), config, analysis_config)
+        check("parallax", recons["parallax"].recon_phase_corrected)
+
+    def ptycho():
+        recons["ptycho"] = run_ptycho(make_datacube(), config, analysis_config)
+        check("ptycho", recons["ptycho"].object)
+        check("ptycho error", recons["ptycho"].error_iterations)
+
+    scan_path = workdir / "synthetic.h5"
+
+    def save():
+        save_results(scan_path, config, recons["parallax"], recons["ptycho"])
+        # The whole tree, and the ptycho object as rotate_ptychos reads it
+        results_path = get_results_path(scan_path)
+        py4DSTEM.read(results_path)
+        group = get_results_group(scan_path, config.binning.bin_diffraction_factor)
+        saved = py4DSTEM.read(
+            results_path, datapath=f"{group}/ptycho/ptychographic_reconstruction"
+        )
+        check("saved ptycho", saved.object)
+
+    return [
+        result("reconstruct", name, best_of(func, args.repeat), cube.nbytes)
+        for name, func in (
+            ("dpc", dpc),
+            ("parallax", parallax),
+            ("ptycho", ptycho),
+            ("save", save),
+        )
+    ]
+
+
+def print_results(results: List[Dict]) -> None:
+    print(f"{'suite':<12}{'benchmark':<30}{'time [s]':>10}{'GB/s':>8}  extra")
+    for r in results:
+        extra = {
+            k: round(v, 2) if isinstance(v, float) else v
+            for k, v in r.items()
+            if k not in ("suite", "name", "seconds", "gb_per_s")
+        }
+        print(
+            f"{r['suite']:<12}{r['name']:<30}{r['seconds']:>10.3f}"
+            f"{r['gb_per_s']:>8.2f}  {extra if extra else ''}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--suite",
+        choices=["binning", "validation", "io", "reconstruct"],
+        action="append",
+        help="Suites to run, all by default. Can be given more than once.",
+    )
+    parser.add_argument("--scan_size", type=int, default=128)
+    parser.add_argument("--frame_size", type=int, default=576)
+    parser.add_argument("--bin_factor", type=int, default=16)
+    parser.add_argument(
+        "--dose", type=float, default=200, help="Electrons per probe position."
+    )
+    parser.add_argument("--num_scans", type=int, default=2)
+    parser.add_argument(
+        "--nan_rate", type=float, default=1e-5, help="Fraction of NaN/Inf values."
+    )
+    parser.add_argument(
+        "--zero_rate", type=float, default=1e-3, help="Fraction of all-zero patterns."
+    )
+    parser.add_argument(
+        "--recon_scan_size", type=int, default=24, help="Scan size to reconstruct."
+    )
+    parser.add_argument(
+        "--recon_frame_size",
+        type=int,
+        default=48,
+        help="Binned frame size to reconstruct.",
+    )
+    parser.add_argument("--ptycho_iter", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--workdir",
+        type=Path,
+        default=None,
+        help="Directory for the synthetic files, a temporary one by default.",
+    )
+    parser.add_argument(
+        "--output", type=Path, default=None, help="Write the results as JSON."
+    )
+    args = parser.parse_args()
+    suites = args.suite or ["binning", "validation", "io", "reconstruct"]
+
+    binned_size = args.frame_size // args.bin_factor
+    cube = None
+    if "validation" in suites or "io" in suites:
+        cube = make_dense_cube(
+            (args.scan_size, args.scan_size),
+            (binned_size, binned_size),
+            args.dose,
+            nan_rate=args.nan_rate,
+            zero_rate=args.zero_rate,
+        )
+
+    results: List[Dict] = []
+    with tempfile.TemporaryDirectory(dir=args.workdir) as tmp:
+        workdir = Path(tmp)
+        if "binning" in suites:
+            results += bench_binning(args, workdir)
+        if "validation" in suites:
+            results += bench_validation(args, cube)
+        if "io" in suites:
+            results += bench_io(args, cube, workdir)
+        if "reconstruct" in suites:
+            results += bench_reconstruct(args, workdir)
+
+    print_results(results)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "machine": platform.node(),
+                    "python": platform.python_version(),
+                    "numpy": np.__version__,
+                    "args": {k: str(v) for k, v in vars(args).items()},
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Synthetic stand-ins for the 4D Camera data, for benchmarking without the
+real dataset.
+"""
+
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+import stempy.io as stio
+
+
+def get_scan_filename(scan_num: int, distiller_id: int) -> str:
+    """Name a synthetic scan like the counted data, FOURD_<date>_<time>_<id>_<num>.h5"""
+    return f"FOURD_230815_0547_{distiller_id:05d}_{scan_num:05d}.h5"
+
+
+def make_sparse_array(
+    scan_shape: Tuple[int, int],
+    frame_shape: Tuple[int, int],
+    dose: float,
+    seed: int = 0,
+) -> stio.SparseArray:
+    """
+    Make an electron-counted scan with, on average, `dose` electrons per
+    probe position, landing in a bright-field disk in the middle of the
+    detector plus a uniform background, one frame per position.
+    """
+    rng = np.random.default_rng(seed)
+    num_positions = scan_shape[0] * scan_shape[1]
+    counts = rng.poisson(dose, num_positions)
+    total = int(counts.sum())
+
+    # 90% of the electrons in a disk of a sixth of the detector, the rest anywhere
+    in_disk = rng.random(total) < 0.9
+    radius = min(frame_shape) / 6 * np.sqrt(rng.random(total))
+    angle = rng.random(total) * 2 * np.pi
+    rows = np.where(
+        in_disk,
+        frame_shape[0] / 2 + radius * np.sin(angle),
+        rng.random(total) * frame_shape[0],
+    ).astype(np.int64)
+    cols = np.where(
+        in_disk,
+        frame_shape[1] / 2 + radius * np.cos(angle),
+        rng.random(total) * frame_shape[1],
+    ).astype(np.int64)
+    events = (
+        np.clip(rows, 0, frame_shape[0] - 1) * frame_shape[1]
+        + np.clip(cols, 0, frame_shape[1] - 1)
+    ).astype(np.uint32)
+
+    data = np.empty((num_positions, 1), dtype=object)
+    for i, frame in enumerate(np.split(events, np.cumsum(counts)[:-1])):
+        data[i, 0] = frame
+
+    return stio.SparseArray(
+        data, scan_shape=scan_shape, frame_shape=frame_shape, dtype=np.uint32
+    )
+
+
+def write_sparse_scans(
+    directory: Path,
+    num_scans: int,
+    scan_shape: Tuple[int, int],
+    frame_shape: Tuple[int, int],
+    dose: float,
+    first_scan_num: int = 1,
+) -> List[Path]:
+    """Write `num_scans` synthetic scans in stempy's HDF5 format."""
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i in range(num_scans):
+        scan_num = first_scan_num + i
+        path = directory / get_scan_filename(scan_num, 1000 + scan_num)
+        path.unlink(missing_ok=True)
+        make_sparse_array(scan_shape, frame_shape, dose, seed=scan_num).write_to_hdf5(
+            str(path)
+        )
+        paths.append(path)
+    return paths
+
+
+def make_dense_cube(
+    scan_shape: Tuple[int, int],
+    frame_shape: Tuple[int, int],
+    dose: float,
+    nan_rate: float = 0.0,
+    zero_rate: float = 0.0,
+    seed: int = 0,
+) -> np.ndarray:
+    """
+    Make a float32 binned cube of Poisson counts with `dose` electrons per
+    pattern on average. A `zero_rate` fraction of the patterns is all
+    zero, and a `nan_rate` fraction of all values is NaN or Inf.
+    """
+    rng = np.random.default_rng(seed)
+    shape = tuple(scan_shape) + tuple(frame_shape)
+    cube = rng.poisson(dose / (frame_shape[0] * frame_shape[1]), shape).astype(
+        np.float32
+    )
+
+    cube[rng.random(scan_shape) < zero_rate] = 0
+
+    if nan_rate > 0:
+        num_invalid = rng.binomial(cube.size, nan_rate)
+        flat = cube.reshape(-1)
+        invalid = rng.integers(0, flat.size, num_invalid)
+        flat[invalid] = np.where(rng.random(num_invalid) < 0.5, np.nan, np.inf)
+
+    return cube
+
+
+def make_ptycho_cube(
+    scan_shape: Tuple[int, int],
+    frame_size: int,
+    semiangle_mrad: float,
+    wavelength_A: float,
+    defocus_A: float = 50.0,
+    step_px: int = 2,
+    dose: float = 1e4,
+    seed: int = 0,
+) -> Tuple[np.ndarray, float, float]:
+    """
+    Simulate a 4D-STEM scan of a weak phase object: a defocused probe with
+    a `semiangle_mrad` aperture filling a third of the frame, stepped by
+    `step_px` probe-window pixels, with Poisson noise.
+
+    Returns the float32 cube, the real-space step in A and the
+    diffraction-space pixel size in mrad.
+    """
+    rng = np.random.default_rng(seed)
+
+    # Aperture radius of frame_size / 6 pixels
+    q_pixel_mrad = semiangle_mrad / (frame_size / 6)
+    dq = q_pixel_mrad * 1e-3 / wavelength_A
+    kx = np.fft.fftfreq(frame_size, 1 / (frame_size * dq))
+    k2 = kx[:, None] ** 2 + kx[None, :] ** 2
+    aperture = np.sqrt(k2) * wavelength_A * 1e3 <= semiangle_mrad
+    probe = np.fft.ifft2(aperture * np.exp(-1j * np.pi * wavelength_A * defocus_A * k2))
+
+    # Smooth random phase, large enough for every probe position
+    object_shape = [n * step_px + frame_size for n in scan_shape]
+    phase = np.fft.ifft2(
+        np.fft.fft2(rng.standard_normal(object_shape))
+        * np.exp(-np.add.outer(*[np.fft.fftfreq(n) ** 2 * 400 for n in object_shape]))
+    ).real
+    obj = np.exp(1j * 0.5 * phase / np.abs(phase).max())
+
+    cube = np.empty(tuple(scan_shape) + (frame_size, frame_size), np.float32)
+    for i in range(scan_shape[0]):
+        for j in range(scan_shape[1]):
+            patch = obj[
+                i * step_px : i * step_px + frame_size,
+                j * step_px : j * step_px + frame_size,
+            ]
+            cube[i, j] = np.fft.fftshift(np.abs(np.fft.fft2(probe * patch)) ** 2)
+    cube *= dose / cube[0, 0].sum()
+
+    r_pixel_A = step_px / (frame_size * dq)
+    return rng.poisson(cube).astype(np.float32), r_pixel_A, q_pixel_mrad
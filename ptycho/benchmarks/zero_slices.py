@@ -0,0 +1,96 @@
+"""
+Time the all-zero pattern check and repair on a synthetic binned datacube,
+against the per-pattern loops they replaced.
+
+    python benchmarks/zero_slices.py --scan_size 400 --frame_size 48
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from ptycho.utils import find_bad_patterns, replace_zero_slices
+
+
+def check_for_zero_slices_loop(array: np.ndarray) -> List[Tuple[int, int]]:
+    zero_slices = []
+    ny, nx, _, _ = array.shape
+    for i in range(ny):
+        for j in range(nx):
+            if np.all(array[i, j, :, :] == 0):
+                zero_slices.append((i, j))
+    return zero_slices
+
+
+def replace_zero_slices_loop(
+    array: np.ndarray, zero_slices: List[Tuple[int, int]]
+) -> np.ndarray:
+    ny, nx, _, _ = array.shape
+    for i, j in zero_slices:
+        neighbors = []
+        if i > 0:
+            neighbors.append(array[i - 1, j, :, :])
+        if i < ny - 1:
+            neighbors.append(array[i + 1, j, :, :])
+        if j > 0:
+            neighbors.append(array[i, j - 1, :, :])
+        if j < nx - 1:
+            neighbors.append(array[i, j + 1, :, :])
+        array[i, j, :, :] = np.mean(neighbors, axis=0)
+    return array
+
+
+def make_datacube(
+    scan_size: int, frame_size: int, zero_fraction: float, seed: int = 0
+) -> np.ndarray:
+    """Sparse counts like a binned cube, with some patterns dropped entirely."""
+    rng = np.random.default_rng(seed)
+    shape = (scan_size, scan_size, frame_size, frame_size)
+    array = rng.poisson(0.2, shape).astype(np.float32)
+    zero = rng.random((scan_size, scan_size)) < zero_fraction
+    array[zero] = 0
+    return array
+
+
+def timed(func, *args) -> Tuple[float, object]:
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scan_size", type=int, default=400)
+    parser.add_argument("--frame_size", type=int, default=48)
+    parser.add_argument("--zero_fraction", type=float, default=0.001)
+    args = parser.parse_args()
+
+    array = make_datacube(args.scan_size, args.frame_size, args.zero_fraction)
+    print(
+        f"Datacube {array.shape} {array.dtype}, {array.nbytes / 1e9:.2f} GB, "
+        f"{args.zero_fraction:.2%} zero patterns"
+    )
+
+    t_loop_check, zero_slices = timed(check_for_zero_slices_loop, array)
+    t_check, (_, zero) = timed(find_bad_patterns, array)
+    assert [tuple(idx) for idx in np.argwhere(zero).tolist()] == zero_slices
+
+    t_loop_replace, _ = timed(replace_zero_slices_loop, array.copy(), zero_slices)
+    t_replace, _ = timed(replace_zero_slices, array.copy(), zero)
+
+    print(f"{'':<8}{'loop [s]':>10}{'vectorized [s]':>16}{'speedup':>10}")
+    for name, t_loop, t_new in (
+        ("check", t_loop_check, t_check),
+        ("replace", t_loop_replace, t_replace),
+    ):
+        print(f"{name:<8}{t_loop:>10.3f}{t_new:>16.3f}{t_loop / t_new:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+import logging
+import os
+from contextlib import ExitStack, contextmanager
+from typing import Iterator, Optional
+
+import psutil
+import scipy.fft
+
+from .schemas import Compute
+
+try:
+    import threadpoolctl
+except ImportError:
+    threadpoolctl = None
+
+try:
+    import pyfftw
+    import pyfftw.interfaces.scipy_fft
+except ImportError:
+    pyfftw = None
+
+# Variables read by the BLAS and OpenMP runtimes when they start, for
+# libraries loaded after `configure_backend` and for child processes
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "BLIS_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+)
+
+_device: Optional[str] = None
+_threads: int = 1
+_fft_workers: int = 1
+_ranks_per_device: int = 1
+
+
+def get_gpu_count() -> int:
+    """Number of CUDA devices cupy can see, 0 if cupy is not installed."""
+    try:
+        import cupy as cp
+
+        return cp.cuda.runtime.getDeviceCount()
+    except Exception:
+        return 0
+
+
+def get_usable_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def count_ranks_sharing_cpus(local_comm) -> int:
+    """
+    Number of ranks on this node, this one included, whose CPU affinity is
+    the same set of cores as this rank's. Collective over `local_comm`.
+    """
+    try:
+        affinity = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        affinity = None
+    return local_comm.allgather(affinity).count(affinity)
+
+
+def get_threads_per_rank(
+    compute: Compute, local_size: int, sharing: Optional[int] = None
+) -> int:
+    """
+    CPU threads for each of the `local_size` ranks on this node.
+
+    The cores this rank may run on are split between the `sharing` ranks
+    that may run on the same cores. Without `sharing`, a rank the launcher
+    pinned to a subset of the cores is assumed to have them to itself, and
+    otherwise all the ranks on the node share all of its cores.
+    """
+    if compute.threads_per_rank is not None:
+        return compute.threads_per_rank
+    usable = get_usable_cpus()
+    if sharing is None:
+        sharing = 1 if usable < (os.cpu_count() or usable) else local_size
+    return max(1, usable // max(1, sharing))
+
+
+def set_thread_limits(threads: int) -> None:
+    """Limit the BLAS and OpenMP pools of this process to `threads`."""
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(threads)
+    if threadpoolctl is None:
+        # The variables are only read when a library starts, and numpy's
+        # BLAS has already been loaded by now
+        logging.warning(
+            "threadpoolctl is not installed, so BLAS and OpenMP threads "
+            f"are not limited to {threads}"
+        )
+        return
+    threadpoolctl.threadpool_limits(limits=threads)
+
+
+def configure_backend(
+    compute: Compute, local_rank: int = 0, local_size: int = 1, local_comm=None
+) -> str:
+    """
+    Pick the device for this process and set up its thread pools.
+
+    With `device` "auto", ranks use a GPU if cupy finds one and the CPU
+    otherwise; "gpu" falls back to the CPU with a warning. GPU ranks on a
+    node are spread over its devices. CPU ranks limit their BLAS, OpenMP
+    and FFT threads so that the ranks on a node do not oversubscribe it.
+    With the node's `local_comm`, ranks that share a set of cores split it
+    between them, whether or not the launcher pinned them.
+
+    Call once per process, before any reconstruction, on every rank of
+    `local_comm` if given. Returns the device.
+    """
+    global _device, _threads, _fft_workers, _ranks_per_device
+
+    num_gpus = get_gpu_count() if compute.device != "cpu" else 0
+    if compute.device == "gpu" and num_gpus == 0:
+        logging.warning("No GPU available, falling back to the CPU")
+
+    sharing = count_ranks_sharing_cpus(local_comm) if local_comm is not None else None
+    _threads = get_threads_per_rank(compute, local_size, sharing)
+    set_thread_limits(_threads)
+
+    if num_gpus > 0:
+        import cupy as cp
+
+        gpu = local_rank % num_gpus
+        _ranks_per_device = -(-local_size // num_gpus)
+        cp.cuda.Device(gpu).use()
+        _device = "gpu"
+        logging.info(f"Rank {local_rank} on node: GPU {gpu} of {num_gpus}")
+        return _device
+
+    _device = "cpu"
+    _ranks_per_device = max(1, local_size)
+    _fft_workers = compute.fft_workers or _threads
+    if pyfftw is not None:
+        pyfftw.interfaces.cache.enable()
+    logging.info(
+        f"Rank {local_rank} on node: CPU with {_threads} threads, "
+        f"{_fft_workers} FFT workers ({'pyFFTW' if pyfftw else 'pocketfft'})"
+    )
+    return _device
+
+
+def get_device(compute: Compute) -> str:
+    """
+    The device picked by `configure_backend`, which is called for a single
+    rank first if this process has not called it yet.
+    """
+    if _device is None:
+        return configure_backend(compute)
+    return _device
+
+
+def get_free_memory(device: str) -> int:
+    """
+    This rank's share of the bytes free for new arrays on `device`: the
+    GPU's free memory plus the blocks cupy's pool holds but does not use,
+    or the host's available RAM, split evenly between the ranks on the
+    node that share the device, since they allocate at the same time.
+    """
+    if device == "gpu":
+        import cupy as cp
+
+        free, _ = cp.cuda.Device().mem_info
+        free += cp.get_default_memory_pool().free_bytes()
+    else:
+        free = psutil.virtual_memory().available
+    return free // _ranks_per_device
+
+
+def synchronize() -> None:
+    """Wait for the work queued on this process's GPU, if it uses one."""
+    if _device == "gpu":
+        import cupy as cp
+
+        cp.cuda.Device().synchronize()
+
+
+@contextmanager
+def fft_workers(workers: Optional[int] = None) -> Iterator[None]:
+    """
+    Compute the `scipy.fft` transforms in the block on `workers` threads,
+    the FFT workers from `configure_backend` by default, with pyFFTW if it
+    is installed. On the GPU, the block runs as is.
+
+    py4DSTEM computes its own FFTs with the reconstruction's array module,
+    which is numpy on the CPU, so they are not affected; this covers the
+    scipy transforms called on the way.
+    """
+    if _device == "gpu":
+        yield
+        return
+
+    with ExitStack() as stack:
+        if pyfftw is not None:
+            stack.enter_context(scipy.fft.set_backend(pyfftw.interfaces.scipy_fft))
+        stack.enter_context(scipy.fft.set_workers(workers or _fft_workers))
+        yield
@@ -0,0 +1,376 @@
+import datetime
+import os
+from multiprocessing import shared_memory
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import emdfile as emd
+import numpy as np
+import py4DSTEM
+import stempy.io as stio
+
+from .profiling import configure_profiling, profile_stage
+from .schemas import Config, CropData
+from .storage import with_layout
+from .writer import BackgroundWriter
+
+
+def get_binned_shape(
+    scan_shape: Tuple[int, int],
+    frame_shape: Tuple[int, int],
+    crop: Optional[CropData],
+    bin_factor: int,
+) -> Tuple[int, int, int, int]:
+    """
+    Get the shape of the dense datacube produced by `bin_sparse_to_dense`.
+
+    Parameters:
+        scan_shape (tuple): (rows, columns) of the raw scan, flyback included.
+        frame_shape (tuple): (rows, columns) of the raw detector frame.
+        crop (CropData or None): Real-space crop applied after removing the
+                                 flyback row and column.
+        bin_factor (int): Diffraction-space bin factor.
+
+    Returns:
+        shape (tuple): (Ry, Rx, Qy, Qx) of the binned datacube.
+    """
+    rows, cols = _scan_window(scan_shape, crop)
+    return (
+        len(range(*rows)),
+        len(range(*cols)),
+        frame_shape[0] // bin_factor,
+        frame_shape[1] // bin_factor,
+    )
+
+
+def _scan_window(
+    scan_shape: Tuple[int, int], crop: Optional[CropData]
+) -> Tuple[Tuple[int, int], Tuple[int, int]]:
+    # Mirrors `array[:, :-1][1:][y_min:y_max, x_min:x_max]` on the raw scan, i.e.
+    # drop the first row and the last column, then crop.
+    row_start, row_stop = slice(1, None).indices(scan_shape[0])[:2]
+    col_start, col_stop = slice(None, -1).indices(scan_shape[1])[:2]
+
+    if crop is not None:
+        row_start, row_stop = _sub_window(row_start, row_stop, crop.y_min, crop.y_max)
+        col_start, col_stop = _sub_window(col_start, col_stop, crop.x_min, crop.x_max)
+
+    return (row_start, row_stop), (col_start, col_stop)
+
+
+def _sub_window(start: int, stop: int, sub_start: int, sub_stop: int):
+    sub = slice(sub_start, sub_stop).indices(max(stop - start, 0))
+    return start + sub[0], start + max(sub[1], sub[0])
+
+
+def bin_sparse_to_dense(
+    sparse_array,
+    crop: Optional[CropData],
+    bin_factor: int,
+    dtype: Optional[np.dtype] = None,
+) -> np.ndarray:
+    """
+    Remove the flyback row/column, crop and bin a stempy SparseArray straight
+    into a dense array of the final shape.
+
+    This gives the same result as slicing the SparseArray, calling
+    `bin_frames` and then `to_dense`, without materialising the full
+    resolution cube or an intermediate binned SparseArray. Events are
+    scatter-added one scan row at a time, so the only large allocation is
+    the output itself.
+
+    Parameters:
+        sparse_array (stempy.io.SparseArray): The raw electron-counted scan.
+        crop (CropData or None): Real-space crop, as in `crop_full_data`.
+        bin_factor (int): Diffraction-space bin factor.
+        dtype (numpy.dtype): Output dtype, defaults to the SparseArray dtype.
+
+    Returns:
+        binned (numpy.ndarray): A (Ry, Rx, Qy, Qx) array of electron counts.
+    """
+    scan_shape = tuple(sparse_array.scan_shape)
+    frame_shape = tuple(sparse_array.frame_shape)
+
+    if any(x % bin_factor for x in frame_shape):
+        raise ValueError(
+            f"frame_shape {frame_shape} must be equally divisible by "
+            f"bin_factor {bin_factor}"
+        )
+
+    if dtype is None:
+        dtype = sparse_array.dtype
+
+    (row_start, row_stop), (col_start, col_stop) = _scan_window(scan_shape, crop)
+    shape = get_binned_shape(scan_shape, frame_shape, crop, bin_factor)
+    binned = np.zeros(shape, dtype=dtype)
+
+    n_cols = shape[1]
+    n_q = shape[2] * shape[3]
+    if n_cols == 0 or n_q == 0:
+        return binned
+
+    # Lookup from raw flat detector index to binned flat detector index
+    frame_rows, frame_cols = np.divmod(
+        np.arange(frame_shape[0] * frame_shape[1], dtype=np.int64), frame_shape[1]
+    )
+    binned_index = (frame_rows // bin_factor) * shape[3] + frame_cols // bin_factor
+
+    # (num_scan_positions, frames_per_scan) object array of event arrays
+    events = sparse_array.data
+    frames_per_scan = events.shape[1]
+    out_rows = binned.reshape(shape[0], n_cols * n_q)
+
+    for out_row, scan_row in enumerate(range(row_start, row_stop)):
+        first = scan_row * scan_shape[1]
+        row_events = events[first + col_start : first + col_stop].ravel()
+
+        sizes = np.fromiter((e.size for e in row_events), dtype=np.int64)
+        if not sizes.any():
+            continue
+
+        # Offset each event by the output position of its probe position
+        positions = np.repeat(
+            np.repeat(np.arange(n_cols, dtype=np.int64) * n_q, frames_per_scan),
+            sizes,
+        )
+        flat = binned_index[np.concatenate(row_events)] + positions
+        out_rows[out_row] += np.bincount(flat, minlength=n_cols * n_q).astype(
+            dtype, copy=False
+        )
+
+    return binned
+
+
+def get_relative_acquisition_time(config: Config, scan_num: int) -> datetime.timedelta:
+    seconds_offset = (
+        scan_num - config.experiment.min_scan_num
+    ) * config.experiment.seconds_between_scans
+    return datetime.timedelta(seconds=seconds_offset)
+
+
+def bin_and_calibrate(
+    scan_path: Path,
+    scan_id: int,
+    scan_num: int,
+    config: Config,
+    relative_acquisition_time: datetime.timedelta,
+    probe_size: Tuple[float, float, float],
+) -> py4DSTEM.DataCube:
+    """
+    Load a raw scan, bin it and attach the calibration and metadata.
+
+    `probe_size` is the (radius, qx0, qy0) measured once on the vacuum probe.
+    """
+    # Load the sparse 4D Camera dataset
+    with profile_stage("read_raw", scan_path.stem):
+        stempy_sparse_array: stio.SparseArray = stio.SparseArray.from_hdf5(scan_path)
+
+    # Remove flyback row and first column, crop real space and bin straight
+    # into the dense output, without expanding the full cube
+    x_min = config.crop_full_data.x_min
+    x_max = config.crop_full_data.x_max
+    y_min = config.crop_full_data.y_min
+    y_max = config.crop_full_data.y_max
+    with profile_stage("bin", scan_path.stem):
+        datacube: py4DSTEM.DataCube = py4DSTEM.DataCube(
+            bin_sparse_to_dense(
+                stempy_sparse_array,
+                config.crop_full_data,
+                config.binning.bin_diffraction_factor,
+            ),
+            name=scan_path.stem,
+        )
+    del stempy_sparse_array
+
+    # Calibration
+    probe_radius_pixels, probe_qx0, probe_qy0 = probe_size
+    datacube.calibration.set_probe_param(probe_size)
+    r_pixel_size: float = config.microscope.r_pixel_size
+    r_pixel_units: str = config.microscope.r_pixel_units
+    convergence_semiangle: float = config.microscope.convergence_semiangle
+    q_pixel_size: float = convergence_semiangle / probe_radius_pixels
+    q_pixel_units: str = config.microscope.q_pixel_units
+
+    file_metadata = {
+        "scan_num": scan_num,
+        "distiller_id": scan_id,
+        "relative_acquisition_time": relative_acquisition_time.seconds,
+    }
+    preprocessing_metadata = {
+        "stempy_frame_bin_factor": config.binning.bin_diffraction_factor,
+        "removed_first_column": True,
+        "removed_flyback_row": True,
+        "crop_Rx_start": x_min,
+        "crop_Rx_end": x_max,
+        "crop_Ry_start": y_min,
+        "crop_Ry_end": y_max,
+        "probe_qx0": probe_qx0,
+        "probe_qy0": probe_qy0,
+        "probe_radius_pixels": probe_radius_pixels,
+    }
+
+    datacube.metadata = emd.Metadata(name="file_metadata", data=file_metadata)
+    datacube.metadata = emd.Metadata(
+        name="preprocessing_metadata", data=preprocessing_metadata
+    )
+
+    datacube.calibration.set_R_pixel_size(r_pixel_size)
+    datacube.calibration.set_R_pixel_units(r_pixel_units)
+    datacube.calibration.set_Q_pixel_size(q_pixel_size)
+    datacube.calibration.set_Q_pixel_units(q_pixel_units)
+
+    return datacube
+
+
+def save_binned(
+    datacube: py4DSTEM.DataCube,
+    vacuum_probe: py4DSTEM.Array,
+    scan_path: Path,
+    config: Config,
+    writer: Optional[BackgroundWriter] = None,
+) -> Path:
+    """
+    Write the binned datacube and vacuum probe to `<scan>_binned_calibrated.h5`.
+
+    The emd tree is built here; with a `writer` only the file write itself
+    is queued on its background thread, so the datacube can be used for
+    reconstruction while it is saved, as long as its data is not modified.
+    """
+    # Create emd root
+    root = emd.Root(name=scan_path.stem)
+
+    # Add node
+    node = emd.Node(name=f"bin_{config.binning.bin_diffraction_factor}")
+    root.tree(node)
+    node.tree(graft=with_layout(datacube, config.binned_layout))
+    node.tree(graft=vacuum_probe)
+    output_filename: Path = scan_path.with_stem(scan_path.stem + "_binned_calibrated")
+
+    if writer is not None:
+        writer.submit(_write_binned, output_filename, root)
+    else:
+        _write_binned(output_filename, root)
+    return output_filename
+
+
+def _write_binned(output_filename: Path, root: emd.Root) -> None:
+    with profile_stage("save_binned", root.name):
+        py4DSTEM.save(output_filename, root, mode="o")
+
+
+def load_vacuum_probe(
+    config: Config,
+) -> Tuple[py4DSTEM.Array, Tuple[float, float, float]]:
+    """Read the vacuum probe and measure its (radius, qx0, qy0) once."""
+    fp_probe: Path = config.calibration.vacuum_probe_emd_path
+    probe: py4DSTEM.Array = py4DSTEM.read(fp_probe)
+    probe_size = tuple(
+        py4DSTEM.process.calibration.get_probe_size(probe.data, thresh_upper=0.95)
+    )
+    return probe, probe_size
+
+
+def wrap_vacuum_probe(
+    data: np.ndarray, name: str, metadata: List[emd.Metadata]
+) -> py4DSTEM.Array:
+    """Wrap probe data in a new rooted Array, ready to be grafted into a tree."""
+    probe = py4DSTEM.Array(data, name=name)
+    for md in metadata:
+        probe.metadata = md
+    emd.Root(name=f"{name}_root").add_to_tree(probe)
+    return probe
+
+
+def share_vacuum_probe(
+    config: Config,
+) -> Tuple[shared_memory.SharedMemory, tuple]:
+    """
+    Read the vacuum probe, measure its size once and copy it into shared
+    memory for the binning workers.
+
+    Returns:
+        probe_shm (SharedMemory): The segment, to be closed and unlinked by
+                                  the caller once the workers are done.
+        init_args (tuple): Arguments for `init_worker`.
+    """
+    probe, probe_size = load_vacuum_probe(config)
+
+    probe_shm = shared_memory.SharedMemory(create=True, size=max(probe.data.nbytes, 1))
+    probe_data = np.ndarray(
+        probe.data.shape, dtype=probe.data.dtype, buffer=probe_shm.buf
+    )
+    probe_data[:] = probe.data
+
+    init_args = (
+        config,
+        probe_shm.name,
+        probe.data.shape,
+        probe.data.dtype.str,
+        probe.name,
+        list(probe.metadata.values()),
+        probe_size,
+    )
+    return probe_shm, init_args
+
+
+# Per-process state, set once per worker by init_worker
+_worker_config: Optional[Config] = None
+_worker_probe_shm: Optional[shared_memory.SharedMemory] = None
+_worker_probe_data: Optional[np.ndarray] = None
+_worker_probe_name: Optional[str] = None
+_worker_probe_metadata: List[emd.Metadata] = []
+_worker_probe_size: Optional[Tuple[float, float, float]] = None
+
+
+def init_worker(
+    config: Config,
+    probe_shm_name: str,
+    probe_shape: Tuple[int, ...],
+    probe_dtype: str,
+    probe_name: str,
+    probe_metadata: List[emd.Metadata],
+    probe_size: Tuple[float, float, float],
+    profile_dir: Optional[Path] = None,
+) -> None:
+    """
+    Attach to the shared vacuum probe and keep it, the config and the probe
+    size calibration for every scan this worker processes.
+    """
+    configure_profiling(profile_dir, f"bin_{os.getpid()}")
+
+    global _worker_config, _worker_probe_shm, _worker_probe_data
+    global _worker_probe_name, _worker_probe_metadata, _worker_probe_size
+
+    _worker_probe_shm = shared_memory.SharedMemory(name=probe_shm_name)
+    _worker_probe_data = np.ndarray(
+        probe_shape, dtype=probe_dtype, buffer=_worker_probe_shm.buf
+    )
+    _worker_probe_name = probe_name
+    _worker_probe_metadata = probe_metadata
+    _worker_config = config
+    _worker_probe_size = probe_size
+
+
+def get_vacuum_probe() -> py4DSTEM.Array:
+    """Wrap the shared probe data of this worker in a new rooted Array."""
+    return wrap_vacuum_probe(
+        _worker_probe_data, _worker_probe_name, _worker_probe_metadata
+    )
+
+
+def process_scan(
+    scan_path: Path,
+    scan_id: int,
+    scan_num: int,
+    relative_acquisition_time: datetime.timedelta,
+) -> Path:
+    """Bin one scan in a worker set up by `init_worker` and save it."""
+    datacube = bin_and_calibrate(
+        scan_path,
+        scan_id,
+        scan_num,
+        _worker_config,
+        relative_acquisition_time,
+        _worker_probe_size,
+    )
+    return save_binned(datacube, get_vacuum_probe(), scan_path, _worker_config)
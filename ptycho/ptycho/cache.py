@@ -0,0 +1,101 @@
+import datetime
+import hashlib
+import json
+from pathlib import Path
+from typing import Dict, List
+
+import h5py
+
+from .results import get_results_group, get_results_path
+from .schemas import AnalysisConfig, Config
+
+# Reconstruction stages whose results are saved, in the order they run.
+# DPC is not saved, so it has no key and cannot be up to date.
+STAGES = ("parallax", "ptycho")
+
+# Results file attribute holding the key each stage was last computed with
+CACHE_KEYS_ATTR = "cache_keys"
+
+
+def get_file_identity(path: Path) -> Dict:
+    """Identify a file by path, size and modification time, without reading it."""
+    stat = path.stat()
+    return {"path": str(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def get_stage_keys(
+    input_path: Path, config: Config, analysis_config: AnalysisConfig
+) -> Dict[str, str]:
+    """
+    Get a key per reconstruction stage from the identity of the file the
+    datacube is built from and the parameters that stage depends on.
+
+    Each stage only hashes its own section of the analysis config, so
+    changing the ptycho parameters does not invalidate DPC or parallax.
+    """
+    shared = {
+        "input": get_file_identity(input_path),
+        "microscope": config.microscope.model_dump(mode="json"),
+        "crop_full_data": config.crop_full_data.model_dump(mode="json"),
+        "bin_diffraction_factor": config.binning.bin_diffraction_factor,
+    }
+    keys = {}
+    for stage in STAGES:
+        params = getattr(analysis_config, stage).model_dump(mode="json")
+        blob = json.dumps({"stage": stage, "params": params, **shared}, sort_keys=True)
+        keys[stage] = hashlib.sha256(blob.encode()).hexdigest()
+    return keys
+
+
+def get_bin_key(
+    scan_path: Path, config: Config, relative_acquisition_time: datetime.timedelta
+) -> str:
+    """
+    Get a key for the binned file of a scan from the identity of its raw
+    file and vacuum probe, and every config value written into it.
+    """
+    blob = json.dumps(
+        {
+            "input": get_file_identity(scan_path),
+            "vacuum_probe": get_file_identity(config.calibration.vacuum_probe_emd_path),
+            "microscope": config.microscope.model_dump(mode="json"),
+            "crop_full_data": config.crop_full_data.model_dump(mode="json"),
+            "bin_diffraction_factor": config.binning.bin_diffraction_factor,
+            "binned_layout": (
+                None
+                if config.binned_layout is None
+                else config.binned_layout.model_dump(mode="json")
+            ),
+            "relative_acquisition_time": relative_acquisition_time.total_seconds(),
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+def read_cache_keys(scan_path: Path, config: Config) -> Dict[str, str]:
+    """Get the stage keys stored with the results of a scan, if there are any."""
+    results_path = get_results_path(scan_path)
+    if not results_path.exists():
+        return {}
+
+    try:
+        with h5py.File(results_path, "r") as f:
+            group = f.get(
+                get_results_group(scan_path, config.binning.bin_diffraction_factor)
+            )
+            if group is None or CACHE_KEYS_ATTR not in group.attrs:
+                return {}
+            return json.loads(group.attrs[CACHE_KEYS_ATTR])
+    except (OSError, ValueError):
+        return {}
+
+
+def get_pending_stages(
+    scan_path: Path,
+    keys: Dict[str, str],
+    config: Config,
+) -> List[str]:
+    """Stages whose results are missing or were computed with a different key."""
+    cached = read_cache_keys(scan_path, config)
+    return [stage for stage in STAGES if cached.get(stage) != keys[stage]]
@@ -0,0 +1,255 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# Message tags between the master (rank 0) and the workers
+TAG_REQUEST = 1
+TAG_TASK = 2
+
+# How often the master checks for requests; short next to any task
+POLL_SECONDS = 0.01
+
+
+@dataclass
+class TaskReport:
+    task: Any
+    ok: bool
+    load_wait_seconds: float
+    compute_seconds: float
+
+
+@dataclass
+class WorkerStats:
+    rank: int
+    num_tasks: int = 0
+    num_failed: int = 0
+    load_wait_seconds: float = 0.0
+    compute_seconds: float = 0.0
+    wall_seconds: float = 0.0
+    failed_tasks: List[Any] = field(default_factory=list)
+
+    @property
+    def utilization(self) -> float:
+        if self.wall_seconds == 0:
+            return 0.0
+        return self.compute_seconds / self.wall_seconds
+
+    def add(self, report: TaskReport) -> None:
+        self.num_tasks += 1
+        self.load_wait_seconds += report.load_wait_seconds
+        self.compute_seconds += report.compute_seconds
+        if not report.ok:
+            self.num_failed += 1
+            self.failed_tasks.append(report.task)
+
+
+def _run_task(
+    task: Any,
+    loaded: Future,
+    process: Callable[[Any, Any], None],
+) -> TaskReport:
+    ok = True
+    start = time.perf_counter()
+    loaded_at = start
+    try:
+        data = loaded.result()
+        loaded_at = time.perf_counter()
+        process(task, data)
+    except Exception as e:
+        logging.error(f"Task {task} failed: {e}")
+        ok = False
+    end = time.perf_counter()
+
+    return TaskReport(
+        task=task,
+        ok=ok,
+        load_wait_seconds=loaded_at - start,
+        compute_seconds=end - loaded_at,
+    )
+
+
+def _work(
+    rank: int,
+    request: Callable[[List[TaskReport]], Any],
+    load: Callable[[Any], Any],
+    process: Callable[[Any, Any], None],
+    prefetch: bool,
+) -> Tuple[WorkerStats, List[TaskReport]]:
+    """
+    Run `process(task, load(task))` for each task `request` gives, until it
+    gives None. `request` is passed the reports of the tasks finished since
+    the last request. Returns the stats and the reports not yet passed on.
+    """
+    stats = WorkerStats(rank=rank)
+    reports: List[TaskReport] = []
+    start = time.perf_counter()
+
+    def ask() -> Any:
+        nonlocal reports
+        task = request(reports)
+        reports = []
+        return task
+
+    with ThreadPoolExecutor(max_workers=1) as loader:
+        # Without prefetching, load on the loader thread and wait straight away
+        task = ask()
+        future = loader.submit(load, task) if task is not None else None
+        while task is not None:
+            next_task = ask() if prefetch else None
+            next_future = (
+                loader.submit(load, next_task) if next_task is not None else None
+            )
+
+            logging.info(f"Rank {rank} processing task: {task}")
+            report = _run_task(task, future, process)
+            stats.add(report)
+            reports.append(report)
+
+            if not prefetch:
+                next_task = ask()
+                next_future = (
+                    loader.submit(load, next_task) if next_task is not None else None
+                )
+            task, future = next_task, next_future
+
+    stats.wall_seconds = time.perf_counter() - start
+    return stats, reports
+
+
+def _log_reports(rank: int, reports: List[TaskReport]) -> None:
+    for report in reports:
+        state = "finished" if report.ok else "failed"
+        logging.info(
+            f"Rank {rank} {state} task {report.task} in "
+            f"{report.load_wait_seconds + report.compute_seconds:.1f} s"
+        )
+
+
+def run_worker(
+    comm,
+    load: Callable[[Any], Any],
+    process: Callable[[Any, Any], None],
+    prefetch: bool = False,
+) -> None:
+    """
+    Ask rank 0 for tasks until it has none left, running
+    `process(task, load(task))` for each.
+
+    With `prefetch`, the next task is requested and loaded on a background
+    thread while the current one is processed, so reading (or binning) the
+    next datacube overlaps with the reconstruction. Reports for finished
+    tasks are sent along with the next request.
+    """
+
+    def request(reports: List[TaskReport]) -> Any:
+        comm.send((reports, True), dest=0, tag=TAG_REQUEST)
+        return comm.recv(source=0, tag=TAG_TASK)
+
+    stats, reports = _work(comm.Get_rank(), request, load, process, prefetch)
+
+    # Tell the master this worker is done, with its remaining reports
+    comm.send((reports, False, stats), dest=0, tag=TAG_REQUEST)
+
+
+def run_master(
+    comm,
+    tasks: Sequence[Any],
+    load: Optional[Callable[[Any], Any]] = None,
+    process: Optional[Callable[[Any, Any], None]] = None,
+    prefetch: bool = False,
+) -> List[WorkerStats]:
+    """
+    Hand out `tasks` in order to whichever worker asks next, until every
+    worker has been told to stop. Returns the per-rank statistics the
+    workers send back when they finish.
+
+    With `load` and `process`, rank 0 also works through the tasks, as
+    `run_worker` does, on a thread of its own. Only the calling thread
+    uses MPI, and it polls for requests instead of blocking in a receive, so it
+    leaves the CPU to the local worker.
+    """
+    from mpi4py import MPI
+
+    remaining = deque(tasks)
+    lock = threading.Lock()
+    num_active = comm.Get_size() - 1
+    stats: Dict[int, WorkerStats] = {}
+    status = MPI.Status()
+
+    def take() -> Any:
+        with lock:
+            return remaining.popleft() if remaining else None
+
+    local: Optional[Future] = None
+    executor = ThreadPoolExecutor(max_workers=1)
+    if process is not None:
+
+        def request(reports: List[TaskReport]) -> Any:
+            _log_reports(0, reports)
+            return take()
+
+        local = executor.submit(_work, 0, request, load, process, prefetch)
+
+    try:
+        while num_active > 0:
+            if not comm.Iprobe(source=MPI.ANY_SOURCE, tag=TAG_REQUEST, status=status):
+                time.sleep(POLL_SECONDS)
+                continue
+            source = status.Get_source()
+            message = comm.recv(source=source, tag=TAG_REQUEST)
+
+            reports, wants_task = message[:2]
+            _log_reports(source, reports)
+
+            if not wants_task:
+                stats[source] = message[2]
+                num_active -= 1
+                continue
+
+            comm.send(take(), dest=source, tag=TAG_TASK)
+
+        if local is not None:
+            stats[0], reports = local.result()
+            _log_reports(0, reports)
+    finally:
+        executor.shutdown()
+
+    return [stats[rank] for rank in sorted(stats)]
+
+
+def log_utilization(
+    stats: List[WorkerStats], report_file: Optional[Path] = None
+) -> None:
+    """Log a per-rank utilization table and optionally write it as JSON."""
+    logging.info(
+        "rank  tasks  failed  compute [s]  load wait [s]  wall [s]  utilization"
+    )
+    for s in stats:
+        logging.info(
+            f"{s.rank:>4}  {s.num_tasks:>5}  {s.num_failed:>6}  "
+            f"{s.compute_seconds:>11.1f}  {s.load_wait_seconds:>13.1f}  "
+            f"{s.wall_seconds:>8.1f}  {s.utilization:>11.1%}"
+        )
+
+    if stats:
+        total_compute = sum(s.compute_seconds for s in stats)
+        total_wall = sum(s.wall_seconds for s in stats)
+        logging.info(
+            f"Overall utilization: {total_compute / max(total_wall, 1e-9):.1%}, "
+            f"makespan {max(s.wall_seconds for s in stats):.1f} s"
+        )
+
+    if report_file is not None:
+        with open(report_file, "w") as f:
+            json.dump(
+                [dict(asdict(s), utilization=s.utilization) for s in stats],
+                f,
+                indent=2,
+                default=str,
+            )
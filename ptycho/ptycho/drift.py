@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from scipy import ndimage
+
+
+def _digest(frame: np.ndarray) -> str:
+    return hashlib.blake2b(
+        np.ascontiguousarray(frame).tobytes(), digest_size=16
+    ).hexdigest()
+
+
+class DriftTracker:
+    """
+    Track sample drift through a time series of images, one frame at a time.
+
+    Each frame is smoothed, cropped and Fourier transformed once, then
+    registered to the previous frame by cross-correlation with DFT
+    upsampling. The drift of a frame is the sum of the shifts between
+    consecutive frames up to it, like `ncempy.eval.stack_align` with
+    `align_type="dynamic"`, so adding a frame costs one registration
+    instead of realigning the whole series.
+
+    Transforms and registrations of a batch of frames run on a thread pool.
+    Shifts between consecutive frames are cached by frame content, and can
+    be saved and loaded to skip frames already registered in an earlier run.
+    """
+
+    def __init__(
+        self,
+        upsample_factor: int = 50,
+        sigma: float = 2.0,
+        border: int = 20,
+        workers: Optional[int] = None,
+    ):
+        self.upsample_factor = upsample_factor
+        self.sigma = sigma
+        self.border = border
+        self.workers = workers or os.cpu_count()
+
+        # "<previous digest>:<digest>" -> (row, col) shift
+        self._pair_shifts: Dict[str, List[float]] = {}
+        self._drift: List[np.ndarray] = []
+        self._last_frame: Optional[np.ndarray] = None
+        self._last_digest: Optional[str] = None
+        self._last_fft: Optional[np.ndarray] = None
+
+    @property
+    def params(self) -> Dict:
+        return {
+            "upsample_factor": self.upsample_factor,
+            "sigma": self.sigma,
+            "border": self.border,
+        }
+
+    @property
+    def shifts(self) -> np.ndarray:
+        """Drift of every frame so far relative to the first, as (row, col)."""
+        return np.array(self._drift).reshape(-1, 2)
+
+    def _transform(self, frame: np.ndarray) -> np.ndarray:
+        smooth = ndimage.gaussian_filter(frame, self.sigma)
+        if self.border > 0:
+            smooth = smooth[self.border : -self.border, self.border : -self.border]
+        return np.fft.fft2(smooth)
+
+    def _register(self, reference_fft: np.ndarray, moving_fft: np.ndarray):
+        """Shift that moves the second frame onto the first, as (row, col)."""
+        from py4DSTEM.process.utils.cross_correlate import align_images_fourier
+
+        shift = np.asarray(
+            align_images_fourier(reference_fft, moving_fft, self.upsample_factor)
+        )
+        # Shifts past half the frame wrap around to negative ones
+        shape = np.array(reference_fft.shape)
+        return np.mod(shift + shape / 2, shape) - shape / 2
+
+    def add_frames(self, frames: Sequence[np.ndarray]) -> np.ndarray:
+        """Register `frames`, the next frames in time, and return all drifts."""
+        frames = list(frames)
+        digests = [_digest(frame) for frame in frames]
+
+        # Consecutive pairs as indices into [last frame] + frames
+        all_frames = [self._last_frame] + frames
+        all_digests = [self._last_digest] + digests
+        pairs = [
+            i
+            for i in range(1, len(all_frames))
+            if all_frames[i - 1] is not None
+            and f"{all_digests[i - 1]}:{all_digests[i]}" not in self._pair_shifts
+        ]
+        needed = sorted({i for pair in pairs for i in (pair - 1, pair)})
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            ffts = {}
+            if 0 in needed and self._last_fft is not None:
+                ffts[0] = self._last_fft
+            missing = [i for i in needed if i not in ffts]
+            ffts.update(
+                zip(
+                    missing,
+                    executor.map(self._transform, [all_frames[i] for i in missing]),
+                )
+            )
+            registered = executor.map(
+                lambda i: self._register(ffts[i - 1], ffts[i]), pairs
+            )
+            for i, shift in zip(pairs, registered):
+                key = f"{all_digests[i - 1]}:{all_digests[i]}"
+                self._pair_shifts[key] = [float(s) for s in shift]
+
+        for i in range(1, len(all_frames)):
+            if all_frames[i - 1] is None:
+                self._drift.append(np.zeros(2))
+                continue
+            key = f"{all_digests[i - 1]}:{all_digests[i]}"
+            self._drift.append(self._drift[-1] + np.array(self._pair_shifts[key]))
+
+        if frames:
+            last = len(all_frames) - 1
+            self._last_frame = frames[-1]
+            self._last_digest = digests[-1]
+            self._last_fft = ffts.get(last)
+
+        return self.shifts
+
+    def save(self, path: Path) -> None:
+        """Save the cached shifts between frames, and the parameters they used."""
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"params": self.params, "pair_shifts": self._pair_shifts}, f)
+        os.replace(tmp_path, path)
+
+    def load(self, path: Path) -> None:
+        """Reuse the shifts saved by `save`, if they used the same parameters."""
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        if saved.get("params") == self.params:
+            self._pair_shifts.update(saved["pair_shifts"])
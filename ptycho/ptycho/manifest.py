@@ -0,0 +1,164 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+MANIFEST_VERSION = 1
+
+# Read size for checksums; large reads keep parallel file systems streaming
+CHECKSUM_BLOCK_SIZE = 16 * 1024**2
+
+# Outputs checked at once on resume, since a checksum re-reads the file
+CHECK_WORKERS = 8
+
+
+def get_checksum(path: Path) -> str:
+    """sha256 of a file, read in large blocks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(CHECKSUM_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_output_record(path: Path) -> Dict[str, Any]:
+    stat = path.stat()
+    return {
+        "path": str(path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": get_checksum(path),
+    }
+
+
+def check_output(output: Dict[str, Any]) -> bool:
+    """
+    Whether an output is still the file that was recorded. Unchanged size and
+    mtime are trusted; if only the mtime changed, the checksum decides.
+    """
+    path = Path(output["path"])
+    try:
+        stat = path.stat()
+    except OSError:
+        return False
+
+    if stat.st_size != output["size"]:
+        return False
+    if stat.st_mtime_ns == output["mtime_ns"]:
+        return True
+    return get_checksum(path) == output["sha256"]
+
+
+def _read_shard(path: Path) -> Dict[str, Dict[str, Any]]:
+    try:
+        with open(path) as f:
+            shard = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable manifest {path}: {e}")
+        return {}
+
+    if shard.get("version") != MANIFEST_VERSION:
+        logging.warning(f"Ignoring manifest {path} with unknown version")
+        return {}
+    return shard.get("scans", {})
+
+
+class RunManifest:
+    """
+    Record which stages of which scans finished, with a checksum of each
+    output, so an interrupted run can be resumed with `load_completed`.
+
+    Each process writes its own shard, `<directory>/<label>.json`, so ranks
+    never overwrite each other's records. The shard is rewritten to a
+    temporary file and renamed over the old one after every record, so a
+    job killed mid-write leaves the previous shard intact.
+    """
+
+    def __init__(self, directory: Path, label: str):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.path = self.directory / f"{label}.json"
+        self._lock = threading.Lock()
+
+        # Keep the records of earlier runs with the same label
+        self._scans: Dict[str, Dict[str, Any]] = (
+            _read_shard(self.path) if self.path.exists() else {}
+        )
+
+    def record(self, scan: str, stage: str, outputs: List[Path], **info) -> None:
+        """Mark `stage` of `scan` complete, with its output files."""
+        self.record_stages(scan, {stage: info}, outputs)
+
+    def record_stages(
+        self, scan: str, stages: Dict[str, Dict[str, Any]], outputs: List[Path]
+    ) -> None:
+        """
+        Mark several stages of `scan` complete, each with its own info, that
+        wrote the same output files. The outputs are checksummed once.
+        """
+        completed = datetime.datetime.now().isoformat()
+        records = [get_output_record(Path(p)) for p in outputs]
+        with self._lock:
+            for stage, info in stages.items():
+                self._scans.setdefault(scan, {})[stage] = {
+                    "completed": completed,
+                    "outputs": records,
+                    **info,
+                }
+            self._write()
+
+    def _write(self) -> None:
+        tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"version": MANIFEST_VERSION, "scans": self._scans}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+
+def load_completed(directory: Optional[Path], stage: str) -> Dict[str, Dict]:
+    """
+    Get the records of `stage` from every shard in `directory`, by scan,
+    keeping only those whose outputs are unchanged. The latest record wins
+    if several shards have the same scan.
+
+    Each output is checked once, and outputs are checked in parallel, so
+    the checksums of outputs whose mtime changed are read side by side.
+    """
+    completed: Dict[str, Dict] = {}
+    if directory is None or not Path(directory).is_dir():
+        return completed
+
+    for path in sorted(Path(directory).glob("*.json")):
+        for scan, stages in _read_shard(path).items():
+            entry = stages.get(stage)
+            if entry is None:
+                continue
+            if scan in completed and completed[scan]["completed"] > entry["completed"]:
+                continue
+            completed[scan] = entry
+
+    outputs = {
+        json.dumps(output, sort_keys=True): output
+        for entry in completed.values()
+        for output in entry["outputs"]
+    }
+    with ThreadPoolExecutor(max_workers=CHECK_WORKERS) as executor:
+        unchanged = dict(zip(outputs, executor.map(check_output, outputs.values())))
+
+    return {
+        scan: entry
+        for scan, entry in completed.items()
+        if all(
+            unchanged[json.dumps(output, sort_keys=True)] for output in entry["outputs"]
+        )
+    }
@@ -0,0 +1,67 @@
+import logging
+import queue
+import threading
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+
+# Sentinel passed down the queues once the source is exhausted
+_STOP = object()
+
+
+def _run_stage(
+    name: str,
+    func: Callable[[Any], Any],
+    in_queue: queue.Queue,
+    out_queue: Optional[queue.Queue],
+) -> None:
+    while True:
+        item = in_queue.get()
+        if item is _STOP:
+            if out_queue is not None:
+                out_queue.put(_STOP)
+            return
+
+        try:
+            result = func(item)
+        except Exception as e:
+            logging.error(f"Stage {name} failed: {e}")
+            continue
+
+        if out_queue is not None and result is not None:
+            out_queue.put(result)
+
+
+def run_pipeline(
+    source: Iterable[Any],
+    stages: List[Tuple[str, Callable[[Any], Any]]],
+    queue_size: int = 1,
+) -> None:
+    """
+    Push every item of `source` through `stages`, each running in its own
+    thread and connected by bounded queues, so different items can be in
+    different stages at the same time.
+
+    A stage is a (name, function) pair. Each function receives the result of
+    the previous stage; returning None, or raising, drops the item. Because
+    the queues hold at most `queue_size` items, a slow stage applies
+    back-pressure upstream instead of letting work (and memory) pile up.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    threads = []
+    for i, (name, func) in enumerate(stages):
+        out_queue = queues[i + 1] if i + 1 < len(stages) else None
+        thread = threading.Thread(
+            target=_run_stage,
+            args=(name, func, queues[i], out_queue),
+            name=name,
+            daemon=True,
+        )
+        thread.start()
+        threads.append(thread)
+
+    try:
+        for item in source:
+            queues[0].put(item)
+    finally:
+        queues[0].put(_STOP)
+        for thread in threads:
+            thread.join()
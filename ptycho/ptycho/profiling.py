@@ -0,0 +1,177 @@
+import datetime
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+from . import backend
+
+_profile_path: Optional[Path] = None
+_label: str = ""
+_lock = threading.Lock()
+# Peak RSS seen so far by each running stage, since resetting the kernel's
+# peak for a new stage would otherwise lose the peaks of the others
+_stage_peaks: Dict[int, Optional[int]] = {}
+_stage_ids = itertools.count()
+
+
+def configure_profiling(profile_dir: Optional[Path], label: str) -> None:
+    """
+    Record every `profile_stage` of this process to
+    `<profile_dir>/<label>.jsonl`. With no `profile_dir`, profiling is off.
+
+    Call once per process, with a label that is unique across the processes
+    of a run, such as the MPI rank.
+
+    While profiling is on, every stage resets the kernel's peak RSS of the
+    whole process (VmHWM, via /proc/self/clear_refs). The peak that
+    getrusage, `/usr/bin/time -v` or the process's own status report at
+    exit is then only the peak since the last stage started. Profiling is
+    off by default, and nothing is reset then.
+    """
+    global _profile_path, _label
+
+    if profile_dir is None:
+        _profile_path = None
+        return
+
+    profile_dir = Path(profile_dir)
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    _profile_path = profile_dir / f"{label}.jsonl"
+    _label = label
+
+
+def _read_io_counters() -> Dict[str, int]:
+    """Bytes this process has read and written, as counted by the kernel."""
+    counters = {}
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, value = line.split(":")
+                counters[key] = int(value)
+    except OSError:
+        pass
+    return counters
+
+
+def _read_rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+
+def _read_peak_rss_bytes() -> Optional[int]:
+    """The process's peak RSS since it was last reset (VmHWM)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss() -> bool:
+    """
+    Reset the process's peak RSS to its current RSS, if the kernel allows.
+    This is process-wide, so only profiled stages call it.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _max(a: Optional[int], b: Optional[int]) -> Optional[int]:
+    if a is None or b is None:
+        return a if b is None else b
+    return max(a, b)
+
+
+def _start_peak() -> int:
+    """Start tracking the peak RSS of a stage, and return its id."""
+    with _lock:
+        # Fold the peak so far into the running stages before resetting it
+        peak = _read_peak_rss_bytes()
+        for stage_id in _stage_peaks:
+            _stage_peaks[stage_id] = _max(_stage_peaks[stage_id], peak)
+        stage_id = next(_stage_ids)
+        _stage_peaks[stage_id] = _read_rss_bytes() if _reset_peak_rss() else None
+        return stage_id
+
+
+def _end_peak(stage_id: int) -> Optional[int]:
+    """The peak RSS since `_start_peak` returned `stage_id`, None if unknown."""
+    with _lock:
+        peak = _stage_peaks.pop(stage_id)
+        if peak is None:
+            return None
+        return _max(peak, _read_peak_rss_bytes())
+
+
+@contextmanager
+def profile_stage(stage: str, scan: str) -> Iterator[None]:
+    """
+    Time a pipeline stage of a scan and append one JSON record for it.
+
+    Each record has the wall and process CPU seconds, the bytes read and
+    written (`rchar`/`wchar`, so including page cache hits), and the
+    resident set size before and after the stage and at its peak. The peak
+    is read from the kernel after resetting it at the start of the stage
+    (see `configure_profiling`), and is None where /proc/self/clear_refs is
+    not writable. CPU time, I/O
+    and memory are process-wide, so they include other threads, such as a
+    background writer, running at the same time.
+
+    On the GPU, the device is synchronized before and after the stage, so
+    its wall time includes the kernels it queued.
+    """
+    if _profile_path is None:
+        yield
+        return
+
+    backend.synchronize()
+    stage_id = _start_peak()
+    rss_start = _read_rss_bytes()
+    io_start = _read_io_counters()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        backend.synchronize()
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        io_end = _read_io_counters()
+        peak_rss = _end_peak(stage_id)
+
+        record = {
+            "time": datetime.datetime.now().isoformat(),
+            "label": _label,
+            "pid": os.getpid(),
+            "thread": threading.current_thread().name,
+            "scan": scan,
+            "stage": stage,
+            "ok": ok,
+            "wall_s": wall,
+            "cpu_s": cpu,
+            "read_bytes": io_end.get("rchar", 0) - io_start.get("rchar", 0),
+            "write_bytes": io_end.get("wchar", 0) - io_start.get("wchar", 0),
+            "rss_start_bytes": rss_start,
+            "rss_bytes": _read_rss_bytes(),
+            "peak_rss_bytes": peak_rss,
+        }
+        with _lock:
+            with open(_profile_path, "a") as f:
+                f.write(json.dumps(record) + "\n")
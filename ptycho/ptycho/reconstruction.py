@@ -0,0 +1,553 @@
+import json
+import logging
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import h5py
+import numpy as np
+import py4DSTEM
+from py4DSTEM.data import Calibration
+
+from .backend import fft_workers, get_device, get_free_memory
+from .binning import (
+    bin_and_calibrate,
+    get_relative_acquisition_time,
+    save_binned,
+    wrap_vacuum_probe,
+)
+from .cache import CACHE_KEYS_ATTR, STAGES, get_pending_stages, get_stage_keys
+from .profiling import profile_stage
+from .results import ResultWriter, get_results_group, get_results_path
+from .schemas import AnalysisConfig, Config, CropData, PtychoReconstruct
+from .storage import read_error_hint
+from .utils import (
+    find_bad_patterns,
+    repair_invalid_values,
+    replace_zero_slices,
+)
+from .writer import BackgroundWriter
+
+
+def get_binned_path(scan_path: Path) -> Path:
+    return scan_path.with_stem(scan_path.stem + "_binned_calibrated")
+
+
+def load_datacube(scan_path: Path) -> py4DSTEM.DataCube:
+    """Read the binned, calibrated datacube written by `bin.py` for a scan."""
+    output_filename: Path = get_binned_path(scan_path)
+
+    logging.info(f"Reading datacube file: {output_filename}")
+    with profile_stage("read", scan_path.stem):
+        try:
+            return py4DSTEM.read(output_filename).tree(scan_path.stem)
+        except OSError as e:
+            raise read_error_hint(e) from e
+
+
+def crop_datacube_R(datacube: py4DSTEM.DataCube, crop: CropData) -> py4DSTEM.DataCube:
+    """
+    Get a new datacube over a real-space window of `datacube`, sharing its
+    data rather than copying it like `datacube.copy().crop_R(...)`.
+
+    The calibration is copied, so calibrating the window leaves the full
+    datacube alone, but its data must be treated as read-only.
+    """
+    cropped = py4DSTEM.DataCube(
+        data=datacube.data,
+        name=datacube.name,
+        calibration=datacube.calibration.copy(),
+    )
+    return cropped.crop_R((crop.x_min, crop.x_max, crop.y_min, crop.y_max))
+
+
+def load_datacube_region(
+    scan_path: Path, config: Config, crop: CropData
+) -> py4DSTEM.DataCube:
+    """
+    Read only a real-space window of the binned datacube written by `bin.py`.
+
+    The window is read as an HDF5 hyperslab, so with the chunked layout
+    only the real-space tiles it overlaps are read and decompressed.
+    """
+    output_filename: Path = get_binned_path(scan_path)
+    logging.info(f"Reading datacube region {crop} of file: {output_filename}")
+
+    with profile_stage("read", scan_path.stem):
+        try:
+            with h5py.File(output_filename, "r") as f:
+                root = f[scan_path.stem]
+                group = root[
+                    f"bin_{config.binning.bin_diffraction_factor}/{scan_path.stem}"
+                ]
+                data = group["data"][crop.x_min : crop.x_max, crop.y_min : crop.y_max]
+                calibration = Calibration.from_h5(root["metadatabundle/calibration"])
+        except OSError as e:
+            raise read_error_hint(e) from e
+
+    datacube = py4DSTEM.DataCube(
+        data=data, name=scan_path.stem, calibration=calibration
+    )
+    # Set the real-space dim vectors from the calibration, as crop_R does
+    return datacube.crop_R((0, data.shape[0], 0, data.shape[1]))
+
+
+def clean_datacube(name: str, datacube: py4DSTEM.DataCube) -> py4DSTEM.DataCube:
+    """Replace invalid values and all-zero diffraction patterns in place."""
+    # One pass over the data finds both kinds of bad patterns
+    with profile_stage("check", name):
+        invalid_patterns, zero_patterns = find_bad_patterns(datacube.data)
+
+    # invalid values and zero slices from datacube
+    if invalid_patterns.any():
+        with profile_stage("repair_invalid", name):
+            stats = repair_invalid_values(datacube.data, invalid_patterns)
+        logging.info(
+            f"invalid values file: {name}, replaced {stats.num_values} NaN or Inf "
+            f"values in {stats.num_patterns} diffraction patterns"
+        )
+
+    if zero_patterns.any():
+        logging.info(
+            f"all zeros file: {name}, real-space indices: "
+            f"{[tuple(idx) for idx in np.argwhere(zero_patterns).tolist()]}"
+        )
+        with profile_stage("repair_zero", name):
+            datacube.data = replace_zero_slices(datacube.data, zero_patterns)
+
+    return datacube
+
+
+def run_dpc(
+    datacube: py4DSTEM.DataCube,
+    config: Config,
+    analysis_config: AnalysisConfig,
+):
+    logging.info(f"Performing DPC file: {datacube.name}")
+    with profile_stage("dpc", datacube.name), fft_workers():
+        dpc = py4DSTEM.process.phase.DPCReconstruction(
+            datacube=datacube,
+            energy=config.microscope.beam_energy,
+            device=get_device(analysis_config.compute),
+        )
+        dpc = dpc.preprocess(
+            force_com_rotation=analysis_config.dpc.preprocess.force_com_rotation
+        )
+
+        dpc = dpc.reconstruct(
+            reset=analysis_config.dpc.reconstruct.reset,
+            q_highpass=analysis_config.dpc.reconstruct.q_highpass,
+            store_iterations=analysis_config.dpc.reconstruct.store_iterations,
+        )
+    return dpc
+
+
+def run_parallax(
+    datacube: py4DSTEM.DataCube,
+    config: Config,
+    analysis_config: AnalysisConfig,
+    cropped: bool = False,
+):
+    """
+    Run parallax on the `parallax.crop_R` window of `datacube`, or on all of
+    it if it is `cropped` already, e.g. read with `load_datacube_region`.
+    """
+    logging.info(f"Performing parallax file: {datacube.name}")
+    # Parallax only reads the data, so crop a view instead of a full copy
+    datacube_cropped = (
+        datacube
+        if cropped
+        else crop_datacube_R(datacube, analysis_config.parallax.crop_R)
+    )
+    with profile_stage("parallax", datacube.name), fft_workers():
+        parallax = py4DSTEM.process.phase.ParallaxReconstruction(
+            datacube=datacube_cropped,
+            energy=config.microscope.beam_energy,
+            device=get_device(analysis_config.compute),
+            object_padding_px=analysis_config.parallax.instantiation.object_padding_px,
+        )
+        parallax = parallax.preprocess(
+            threshold_intensity=analysis_config.parallax.preprocess.threshold_intensity,
+            edge_blend=analysis_config.parallax.preprocess.edge_blend,
+            defocus_guess=analysis_config.parallax.preprocess.defocus_guess,
+            rotation_guess=analysis_config.parallax.preprocess.rotation_guess,
+        )
+
+        parallax = parallax.reconstruct(
+            reset=analysis_config.parallax.reconstruct.reset,
+            min_alignment_bin=analysis_config.parallax.reconstruct.min_alignment_bin,
+            max_iter_at_min_bin=analysis_config.parallax.reconstruct.max_iter_at_min_bin,
+            running_average=analysis_config.parallax.reconstruct.running_average,
+            plot_aligned_bf=False,
+            plot_convergence=False,
+        )
+
+    with profile_stage("aberration_fit", datacube.name), fft_workers():
+        parallax.aberration_fit()
+        parallax.aberration_correct()
+    return parallax
+
+
+# Bytes of batch arrays per probe-window pixel of each pattern in a ptycho
+# batch: about eight complex64 arrays (shifted probes, object patches,
+# overlaps, exit waves and their transforms, gradients), two int64 patch
+# index arrays and the float32 amplitudes
+PTYCHO_BATCH_BYTES_PER_PIXEL = 8 * 8 + 2 * 8 + 4
+
+
+def get_ptycho_batch_size(ptycho, params: PtychoReconstruct) -> int:
+    """
+    Patterns per ptycho batch: `params.max_batch_size` if set, else half the
+    scan as before, capped by what fits in `batch_memory_fraction` of this
+    rank's share of the memory free on its device (see `get_free_memory`).
+    Call after `preprocess`.
+    """
+    num_patterns = ptycho._num_diffraction_patterns
+    if params.max_batch_size is not None:
+        return max(1, min(params.max_batch_size, num_patterns))
+
+    bytes_per_pattern = (
+        int(np.prod(ptycho._region_of_interest_shape)) * PTYCHO_BATCH_BYTES_PER_PIXEL
+    )
+    free_bytes = get_free_memory(ptycho._device) * params.batch_memory_fraction
+    fits = int(free_bytes // bytes_per_pattern)
+    return max(1, min(num_patterns // 2, fits))
+
+
+def has_converged(errors: Sequence[float], window: int, tolerance: float) -> bool:
+    """
+    Whether the error changed by less than `tolerance`, relative to its
+    value `window` iterations ago, over the last `window` iterations.
+    """
+    if len(errors) <= window:
+        return False
+    previous = errors[-window - 1]
+    return abs(previous - errors[-1]) <= tolerance * abs(previous)
+
+
+def run_ptycho(
+    datacube: py4DSTEM.DataCube,
+    config: Config,
+    analysis_config: AnalysisConfig,
+):
+    logging.info(f"Performing ptycho file: {datacube.name}")
+    params = analysis_config.ptycho.reconstruct
+    with profile_stage("ptycho", datacube.name), fft_workers():
+        ptycho = py4DSTEM.process.phase.SingleslicePtychographicReconstruction(
+            datacube=datacube,
+            device=get_device(analysis_config.compute),
+            energy=config.microscope.beam_energy,
+            semiangle_cutoff=17.1,
+            defocus=0,
+        )
+        ptycho = ptycho.preprocess(
+            force_com_transpose=analysis_config.ptycho.preprocess.force_com_transpose,
+            force_com_rotation=analysis_config.ptycho.preprocess.force_com_rotation,
+            fit_function=analysis_config.ptycho.preprocess.fit_function,
+            plot_center_of_mass=False,
+        )
+
+        max_batch_size = get_ptycho_batch_size(ptycho, params)
+        logging.info(
+            f"Ptycho batches of {max_batch_size} of "
+            f"{ptycho._num_diffraction_patterns} patterns file: {datacube.name}"
+        )
+
+        def reconstruct(max_iter: int, reset: bool, progress_bar: bool = True):
+            return ptycho.reconstruct(
+                reset=reset,
+                max_iter=max_iter,
+                step_size=params.step_size,
+                max_batch_size=max_batch_size,
+                q_lowpass=params.q_lowpass,
+                store_iterations=params.store_iterations,
+                progress_bar=progress_bar,
+            )
+
+        if params.convergence_tolerance is None:
+            return reconstruct(params.max_iter, params.reset)
+
+        # Chunks of convergence_window iterations, each continuing from the
+        # previous state, so the error can be checked in between. Each call
+        # copies the object to the host and frees the GPU pool, hence chunks
+        # rather than single iterations. py4DSTEM counts iterations from 0
+        # in every call, so iteration schedules (fix_probe_iter,
+        # fix_positions_iter, *_filter_iter, ...) would restart each chunk;
+        # `reconstruct` passes none, and must not while chunking.
+        window = params.convergence_window
+        ptycho = reconstruct(min(window, params.max_iter), params.reset, False)
+        ptycho._verbose = False  # py4DSTEM prints a summary on every call
+        while len(ptycho.error_iterations) < params.max_iter:
+            if has_converged(
+                ptycho.error_iterations, window, params.convergence_tolerance
+            ):
+                logging.info(
+                    f"Ptycho converged after {len(ptycho.error_iterations)} "
+                    f"iterations file: {datacube.name}"
+                )
+                break
+            remaining = params.max_iter - len(ptycho.error_iterations)
+            ptycho = reconstruct(min(window, remaining), False, False)
+    return ptycho
+
+
+def get_parallax_items(parallax) -> dict:
+    return {
+        "recon_phase_corrected": parallax.recon_phase_corrected,
+        "_scan_sampling": parallax._scan_sampling,
+        "rotation_Q_to_R_rads": parallax.rotation_Q_to_R_rads,
+        "aberration_A1x": parallax.aberration_A1x,
+        "aberration_A1y": parallax.aberration_A1y,
+        "aberration_C1": parallax.aberration_C1,
+    }
+
+
+def save_data(
+    scan_path,
+    config,
+    output_filename,
+    save_parallax_items,
+    save_matrix,
+    cache_keys: Optional[Dict[str, str]] = None,
+    reuse: Sequence[str] = (),
+    on_saved: Optional[Callable[[], None]] = None,
+):
+    try:
+        group_path = get_results_group(scan_path, config.binning.bin_diffraction_factor)
+        writer = ResultWriter(output_filename, config.binned_layout)
+
+        # Save items in save_matrix
+        for k, v in save_matrix.items():
+            logging.info(f"Saving {k} for {scan_path.stem}.")
+            writer.add_node(f"{group_path}/{k}", v)
+
+        # Save items in save_parallax_items
+        if save_parallax_items is not None:
+            writer.add_arrays(f"{group_path}/parallax", save_parallax_items)
+
+        # Carry over cached results from the previous file
+        for k in reuse:
+            logging.info(f"Keeping cached {k} for {scan_path.stem}.")
+            writer.add_copy(output_filename, f"{group_path}/{k}")
+
+        if cache_keys is not None:
+            writer.set_attrs(group_path, {CACHE_KEYS_ATTR: json.dumps(cache_keys)})
+
+        with profile_stage("save", scan_path.stem):
+            writer.write()
+        logging.info(f"Data saved successfully for {scan_path.stem}.")
+        if on_saved is not None:
+            on_saved()
+
+    except Exception as e:
+        logging.error(f"An error occurred while saving data for {scan_path}: {e}")
+
+
+def save_results(
+    scan_path: Path,
+    config: Config,
+    parallax,
+    ptycho,
+    writer: Optional[BackgroundWriter] = None,
+    cache_keys: Optional[Dict[str, str]] = None,
+    on_saved: Optional[Callable[[], None]] = None,
+) -> None:
+    """
+    Save the parallax and ptycho results of a scan. Either can be None if
+    its stage was skipped because it is cached, in which case the previous
+    result is kept. `on_saved` is called once the file is written.
+    """
+    # No need to save dpc
+    save_matrix: dict = {"ptycho": ptycho} if ptycho is not None else {}
+    reuse = [k for k, v in (("parallax", parallax), ("ptycho", ptycho)) if v is None]
+    args = (
+        scan_path,
+        config,
+        get_results_path(scan_path),
+        get_parallax_items(parallax) if parallax is not None else None,
+        save_matrix,
+        cache_keys,
+        reuse,
+        on_saved,
+    )
+
+    if writer is not None:
+        writer.submit(save_data, *args)
+    else:
+        save_data(*args)
+
+
+def reconstruct_datacube(
+    scan_path: Path,
+    datacube: py4DSTEM.DataCube,
+    config: Config,
+    analysis_config: AnalysisConfig,
+    writer: Optional[BackgroundWriter] = None,
+    stages: Sequence[str] = STAGES,
+    cache_keys: Optional[Dict[str, str]] = None,
+    on_saved: Optional[Callable[[], None]] = None,
+    cropped: bool = False,
+) -> None:
+    """
+    Run DPC, parallax and ptycho on a cleaned datacube and save the results.
+
+    Only `stages` are run; the results of the others are kept from the
+    previous results file. `cache_keys` are stored with the results, so a
+    later run can tell which stages are up to date. DPC's result is not
+    saved, so it only runs when every stage does, on a full reconstruction.
+
+    With `cropped`, `datacube` is only the parallax window, as
+    `load_binned_scan` reads it when parallax is the only stage to run.
+    """
+    if set(STAGES) <= set(stages):
+        run_dpc(datacube, config, analysis_config)
+    parallax = (
+        run_parallax(datacube, config, analysis_config, cropped=cropped)
+        if "parallax" in stages
+        else None
+    )
+    ptycho = (
+        run_ptycho(datacube, config, analysis_config) if "ptycho" in stages else None
+    )
+
+    save_results(
+        scan_path,
+        config,
+        parallax,
+        ptycho,
+        writer=writer,
+        cache_keys=cache_keys,
+        on_saved=on_saved,
+    )
+
+
+def get_cache_plan(
+    scan_path: Path,
+    input_path: Path,
+    config: Config,
+    analysis_config: AnalysisConfig,
+    use_cache: bool = True,
+) -> Tuple[Dict[str, str], List[str]]:
+    """
+    Get the stage keys for a scan whose datacube is built from `input_path`,
+    and the stages that need to run. Without `use_cache` all stages run,
+    but the keys are still stored for the next run.
+    """
+    keys = get_stage_keys(input_path, config, analysis_config)
+    if not use_cache:
+        return keys, list(STAGES)
+    return keys, get_pending_stages(scan_path, keys, config)
+
+
+def prepare_raw_scan(
+    scan_path: Path,
+    scan_id: int,
+    scan_num: int,
+    config: Config,
+    vacuum_probe: py4DSTEM.Array,
+    probe_size: Tuple[float, float, float],
+    writer: BackgroundWriter,
+) -> py4DSTEM.DataCube:
+    """
+    Bin and clean a raw scan in memory.
+
+    The binned cube is only persisted if `binning.save_binned` is set, and
+    then on the writer thread. It is cleaned before it is queued for saving,
+    since the write reads the data while the reconstruction runs.
+    """
+    datacube = bin_and_calibrate(
+        scan_path,
+        scan_id,
+        scan_num,
+        config,
+        get_relative_acquisition_time(config, scan_num),
+        probe_size,
+    )
+    datacube = clean_datacube(scan_path.stem, datacube)
+
+    if config.binning.save_binned:
+        probe = wrap_vacuum_probe(
+            vacuum_probe.data, vacuum_probe.name, list(vacuum_probe.metadata.values())
+        )
+        save_binned(datacube, probe, scan_path, config, writer=writer)
+
+    return datacube
+
+
+def process_raw_scan(
+    scan_path: Path,
+    scan_id: int,
+    scan_num: int,
+    config: Config,
+    analysis_config: AnalysisConfig,
+    vacuum_probe: py4DSTEM.Array,
+    probe_size: Tuple[float, float, float],
+    writer: BackgroundWriter,
+) -> None:
+    """
+    Bin a raw scan and hand the datacube straight to phase retrieval, without
+    the `_binned_calibrated.h5` round trip. Results go through the same
+    writer as the binned cube, so they are appended after it is written.
+    """
+    datacube = prepare_raw_scan(
+        scan_path, scan_id, scan_num, config, vacuum_probe, probe_size, writer
+    )
+    reconstruct_datacube(scan_path, datacube, config, analysis_config, writer=writer)
+
+
+def needs_parallax_window_only(stages: Sequence[str]) -> bool:
+    """Whether the stages to run only read the parallax crop_R window."""
+    return list(stages) == ["parallax"]
+
+
+def load_binned_scan(
+    scan_path: Path,
+    config: Optional[Config] = None,
+    analysis_config: Optional[AnalysisConfig] = None,
+    stages: Sequence[str] = STAGES,
+) -> py4DSTEM.DataCube:
+    """
+    Read and clean the binned datacube written by `bin.py` for a scan. When
+    parallax is the only stage to run, only its crop_R window is read.
+    """
+    if needs_parallax_window_only(stages):
+        datacube = load_datacube_region(
+            scan_path, config, analysis_config.parallax.crop_R
+        )
+    else:
+        datacube = load_datacube(scan_path)
+    return clean_datacube(scan_path.stem, datacube)
+
+
+def process_scan(
+    scan_path: Path,
+    config: Config,
+    analysis_config: AnalysisConfig,
+) -> None:
+    # Load the binned dataset
+    datacube: py4DSTEM.DataCube = load_binned_scan(scan_path)
+
+    # BF/DF can be done, but no need for purpose of this paper.
+    # expand_BF = analysis_config.bf_df.expand_BF
+    # probe_radius_pixels = datacube.metadata["preprocessing_metadata"][
+    #     "probe_radius_pixels"
+    # ]
+    # probe_qx0 = datacube.metadata["preprocessing_metadata"]["probe_qx0"]
+    # probe_qy0 = datacube.metadata["preprocessing_metadata"]["probe_qy0"]
+    # center = (probe_qx0, probe_qy0)
+    # radius_BF = probe_radius_pixels + expand_BF
+    # radii_DF = (probe_radius_pixels + expand_BF, analysis_config.bf_df.extra_radius)
+
+    # datacube.get_virtual_image(
+    #     mode="circle",
+    #     geometry=(center, radius_BF),
+    #     name="bright_field",
+    #     shift_center=False,
+    # )
+    # datacube.get_virtual_image(
+    #     mode="annulus",
+    #     geometry=(center, radii_DF),
+    #     name="dark_field",
+    #     shift_center=False,
+    # )
+
+    reconstruct_datacube(scan_path, datacube, config, analysis_config)
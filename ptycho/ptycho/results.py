@@ -0,0 +1,131 @@
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import emdfile as emd
+import h5py
+import numpy as np
+
+from .schemas import OutputLayout
+from .storage import get_filter_options
+
+
+def get_results_path(scan_path: Path) -> Path:
+    return scan_path.with_stem(scan_path.stem + "_results")
+
+
+def get_results_group(scan_path: Path, bin_factor: int) -> str:
+    """Group the results of a scan are written under, in the results file."""
+    return f"{scan_path.stem}/bin_{bin_factor}/{scan_path.stem}"
+
+
+def find_results_path(scan_path: Path, bin_factor: int) -> Optional[Path]:
+    """
+    Get the file holding the results of a scan: `<scan>_results.h5`, or for
+    data processed before results had a file of their own, the
+    `_binned_calibrated.h5` they were appended to, under the same group.
+    None if neither has them.
+    """
+    results_path = get_results_path(scan_path)
+    if results_path.exists():
+        return results_path
+
+    legacy_path = scan_path.with_stem(scan_path.stem + "_binned_calibrated")
+    try:
+        with h5py.File(legacy_path, "r") as f:
+            if get_results_group(scan_path, bin_factor) in f:
+                return legacy_path
+    except OSError:
+        pass
+    return None
+
+
+def _require_node(f: h5py.File, group_path: str) -> h5py.Group:
+    """
+    Get the group at `group_path`, creating any missing groups below its
+    root as emdfile nodes, so `py4DSTEM.read` can walk the tree to them.
+    """
+    group = f
+    for name in group_path.split("/"):
+        if name not in group:
+            emd.Node(name=name).to_h5(group)
+        group = group[name]
+    return group
+
+
+class ResultWriter:
+    """
+    Collect everything a scan produces and write it to a fresh file in one
+    open, then rename it over the previous results.
+
+    Rewriting a whole file, instead of deleting and recreating groups in an
+    existing one, keeps repeated reprocessing from growing the file, and
+    readers never see a half-written file.
+    """
+
+    def __init__(self, path: Path, layout: Optional[OutputLayout] = None):
+        self.path = path
+        self.layout = layout
+        self._nodes: List[Tuple[str, Any]] = []
+        self._arrays: List[Tuple[str, Dict[str, Any]]] = []
+        self._copies: List[Tuple[Path, str]] = []
+        self._attrs: List[Tuple[str, Dict[str, Any]]] = []
+
+    def add_node(self, group_path: str, node: Any) -> None:
+        """Add an emd/py4DSTEM object, written with its own `to_h5`."""
+        self._nodes.append((group_path, node))
+
+    def add_arrays(self, group_path: str, items: Dict[str, Any]) -> None:
+        """Add arrays and scalars, written as datasets of one group."""
+        self._arrays.append((group_path, items))
+
+    def add_copy(self, source: Path, group_path: str) -> None:
+        """Copy a group from another file as is, e.g. from the previous results."""
+        self._copies.append((source, group_path))
+
+    def set_attrs(self, group_path: str, attrs: Dict[str, Any]) -> None:
+        self._attrs.append((group_path, attrs))
+
+    def write(self) -> Path:
+        tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        options = get_filter_options(self.layout)
+
+        group_paths = [path for path, _ in self._nodes + self._arrays] + [
+            path for _, path in self._copies
+        ]
+        roots = list(dict.fromkeys(path.split("/")[0] for path in group_paths))
+
+        try:
+            # emdfile writes the file header and the roots, so the file is
+            # tagged exactly as py4DSTEM.save would tag it
+            for i, root in enumerate(roots):
+                emd.save(tmp_path, emd.Root(name=root), mode="o" if i == 0 else "a")
+
+            with h5py.File(tmp_path, "a") as f:
+                for group_path, node in self._nodes:
+                    node.to_h5(_require_node(f, group_path))
+
+                for group_path, items in self._arrays:
+                    group = _require_node(f, group_path)
+                    for k, v in items.items():
+                        v = np.asarray(v)
+                        # Scalars cannot be chunked, so cannot be compressed
+                        if v.ndim > 0 and v.size > 1:
+                            group.create_dataset(k, data=v, chunks=True, **options)
+                        else:
+                            group.create_dataset(k, data=v)
+
+                for source, group_path in self._copies:
+                    with h5py.File(source, "r") as src:
+                        parent, name = group_path.rsplit("/", 1)
+                        src.copy(src[group_path], _require_node(f, parent), name=name)
+
+                for group_path, attrs in self._attrs:
+                    _require_node(f, group_path).attrs.update(attrs)
+
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+        return self.path
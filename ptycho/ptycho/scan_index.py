@@ -0,0 +1,236 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# Raw counted scans, e.g. FOURD_230815_0547_01432_00516.h5
+SCAN_FILENAME_PATTERN = re.compile(r"^FOURD_\d{6}_\d{4}_(\d{5,})_(\d{5,})\.h5$")
+
+# Older sessions, e.g. data_scan1959_id12696_electrons.h5, or
+# data_scan1959_th4.0_electrons.h5 with no distiller id
+LEGACY_SCAN_FILENAME_PATTERN = re.compile(
+    r"^data_scan(\d+)(?:_id(\d+))?(?:_th[\d.]+)?_electrons\.h5$"
+)
+
+INDEX_VERSION = 2
+
+# Files modified this long before the last listing are taken as final and
+# not stat'ed again; newer ones may still have been written to
+SETTLED_AFTER_S = 60.0
+
+
+def parse_scan_filename(filename: str) -> Optional[Tuple[int, int]]:
+    """Return (scan_num, distiller_id) for a raw scan file name, else None."""
+    match = SCAN_FILENAME_PATTERN.match(filename)
+    if match is None:
+        return None
+    return int(match.group(2)), int(match.group(1))
+
+
+def parse_legacy_scan_filename(
+    filename: str,
+) -> Optional[Tuple[int, Optional[int]]]:
+    """
+    Like `parse_scan_filename`, for the data_scan..._electrons.h5 names.
+    The distiller id is None for names without one.
+    """
+    match = LEGACY_SCAN_FILENAME_PATTERN.match(filename)
+    if match is None:
+        return None
+    distiller_id = match.group(2)
+    return int(match.group(1)), None if distiller_id is None else int(distiller_id)
+
+
+def get_index_path(
+    base_path: Path, index_dir: Optional[Path] = None, legacy: bool = False
+) -> Path:
+    """
+    Where the index of `base_path` is cached: a file named after the data
+    directory in `index_dir`, by default ~/.cache/ptycho/scan_index. An
+    index that includes legacy names is kept in a file of its own.
+
+    The index is kept out of the data directory itself, since writing it
+    there would change the directory mtime that tells whether to list it.
+    """
+    if index_dir is None:
+        cache_home = os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")
+        index_dir = Path(cache_home) / "ptycho" / "scan_index"
+    resolved = str(Path(base_path).resolve())
+    digest = hashlib.sha1(resolved.encode()).hexdigest()[:16]
+    suffix = "_legacy" if legacy else ""
+    return Path(index_dir) / f"{Path(resolved).name}_{digest}{suffix}.json"
+
+
+@dataclass
+class ScanEntry:
+    path: Path
+    scan_num: int
+    distiller_id: Optional[int]
+    size: int
+    mtime_ns: int
+
+
+class ScanIndex:
+    """
+    Raw `FOURD_...` scans in a directory, from a single listing that is
+    cached in `index_path` (see `get_index_path`). With `legacy`, the older
+    data_scan..._electrons.h5 names are indexed too.
+
+    `refresh` only lists the directory again if files were added, removed or
+    renamed since the last listing (its mtime changed), or if some files
+    were still recently modified then. Only those files and new ones are
+    stat'ed again.
+    """
+
+    def __init__(
+        self,
+        base_path: Path,
+        index_path: Optional[Path] = None,
+        legacy: bool = False,
+    ):
+        self.base_path = Path(base_path)
+        self.legacy = legacy
+        self.index_path = Path(
+            index_path or get_index_path(self.base_path, legacy=legacy)
+        )
+        self._dir_mtime_ns: Optional[int] = None
+        self._listed_at: float = 0.0
+        self._entries: Dict[str, ScanEntry] = {}
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if index.get("version") != INDEX_VERSION:
+            return
+        if index.get("legacy") != self.legacy:
+            return
+        self._dir_mtime_ns = index["dir_mtime_ns"]
+        self._listed_at = index["listed_at"]
+        self._entries = {
+            name: ScanEntry(**{**entry, "path": Path(entry["path"])})
+            for name, entry in index["entries"].items()
+        }
+
+    def _save(self) -> None:
+        index = {
+            "version": INDEX_VERSION,
+            "legacy": self.legacy,
+            "dir_mtime_ns": self._dir_mtime_ns,
+            "listed_at": self._listed_at,
+            "entries": {
+                name: {**asdict(entry), "path": str(entry.path)}
+                for name, entry in self._entries.items()
+            },
+        }
+        tmp_path = self.index_path.with_name(
+            f".{self.index_path.name}.{os.getpid()}.tmp"
+        )
+        try:
+            self.index_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            # An unwritable index directory still works, just without the cache
+            tmp_path.unlink(missing_ok=True)
+            logging.warning(f"Could not save scan index {self.index_path}: {e}")
+
+    def refresh(self) -> None:
+        dir_mtime_ns = self.base_path.stat().st_mtime_ns
+        settled_before = self._listed_at - SETTLED_AFTER_S
+        unsettled = any(
+            entry.mtime_ns / 1e9 >= settled_before for entry in self._entries.values()
+        )
+        if dir_mtime_ns == self._dir_mtime_ns and not unsettled:
+            return
+
+        listed_at = time.time()
+        entries: Dict[str, ScanEntry] = {}
+        with os.scandir(self.base_path) as it:
+            for dir_entry in it:
+                name = dir_entry.name
+                parsed = parse_scan_filename(name)
+                if parsed is None and self.legacy:
+                    parsed = parse_legacy_scan_filename(name)
+                if parsed is None:
+                    continue
+
+                cached = self._entries.get(dir_entry.name)
+                if cached is not None and cached.mtime_ns / 1e9 < settled_before:
+                    entries[dir_entry.name] = cached
+                    continue
+
+                stat = dir_entry.stat()
+                entries[dir_entry.name] = ScanEntry(
+                    Path(dir_entry.path),
+                    *parsed,
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                )
+
+        self._entries = entries
+        self._dir_mtime_ns = dir_mtime_ns
+        self._listed_at = listed_at
+        self._save()
+
+    def by_scan_num(
+        self, min_scan_num: int = 0, max_scan_num: Optional[int] = None
+    ) -> Dict[int, List[ScanEntry]]:
+        """All files of each scan number in [min_scan_num, max_scan_num]."""
+        by_num: Dict[int, List[ScanEntry]] = {}
+        for entry in self._entries.values():
+            if entry.scan_num < min_scan_num:
+                continue
+            if max_scan_num is not None and entry.scan_num > max_scan_num:
+                continue
+            by_num.setdefault(entry.scan_num, []).append(entry)
+        return by_num
+
+    def scans(
+        self, min_scan_num: int = 0, max_scan_num: Optional[int] = None
+    ) -> List[ScanEntry]:
+        """
+        Scans with numbers in [min_scan_num, max_scan_num], by scan number.
+
+        Raises a ValueError if a scan number has more than one file, as
+        `stempy.contrib.get_scan_path` does. In a legacy index this includes
+        a scan saved under both naming schemes, or at several thresholds.
+        """
+        by_num = self.by_scan_num(min_scan_num, max_scan_num)
+        for scan_num, entries in by_num.items():
+            if len(entries) > 1:
+                raise ValueError(
+                    f"More than one file for scan {scan_num}: "
+                    f"{', '.join(str(entry.path) for entry in entries)}"
+                )
+        return [by_num[n][0] for n in sorted(by_num)]
+
+    def get(self, scan_num: int) -> ScanEntry:
+        """The scan with this number, like `stempy.contrib.get_scan_path`."""
+        scans = self.scans(scan_num, scan_num)
+        if not scans:
+            raise FileNotFoundError(f"No file for scan {scan_num} in {self.base_path}")
+        return scans[0]
+
+
+def find_scans(
+    base_path: Path,
+    min_scan_num: int = 0,
+    max_scan_num: Optional[int] = None,
+    index_dir: Optional[Path] = None,
+    legacy: bool = False,
+) -> List[ScanEntry]:
+    """Refresh the scan index of `base_path` and get the scans in a range."""
+    index = ScanIndex(base_path, get_index_path(base_path, index_dir, legacy), legacy)
+    index.refresh()
+    return index.scans(min_scan_num, max_scan_num)
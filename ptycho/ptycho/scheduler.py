@@ -0,0 +1,109 @@
+import os
+import threading
+from pathlib import Path
+from typing import List, Optional
+
+import h5py
+import numpy as np
+import psutil
+
+from .binning import get_binned_shape
+from .schemas import Binning, CropData
+
+# Resident memory of an idle worker once numpy/stempy/py4DSTEM are imported
+WORKER_BASELINE_BYTES = 512 * 1024**2
+
+# Python object overhead of each per-frame event array held by a SparseArray
+EVENT_ARRAY_OVERHEAD_BYTES = 112
+
+# Fraction of the available memory used when no budget is configured
+DEFAULT_BUDGET_FRACTION = 0.8
+
+
+def estimate_scan_memory(
+    scan_path: Path, crop: CropData, bin_factor: int, itemsize: int = 4
+) -> int:
+    """
+    Estimate the peak resident memory of binning one scan.
+
+    The estimate is the loaded electron events (approximated by the file
+    size plus the per-frame array overhead), the dense binned output and
+    the per-row scatter-add temporaries, on top of the worker baseline.
+
+    Parameters:
+        scan_path (Path): The stempy HDF5 file.
+        crop (CropData): Real-space crop applied while binning.
+        bin_factor (int): Diffraction-space bin factor.
+        itemsize (int): Bytes per element of the binned output.
+
+    Returns:
+        num_bytes (int): Estimated peak footprint in bytes.
+    """
+    with h5py.File(scan_path, "r") as f:
+        frames = f["electron_events/frames"]
+        scan_positions = f["electron_events/scan_positions"]
+        scan_shape = (int(scan_positions.attrs["Ny"]), int(scan_positions.attrs["Nx"]))
+        frame_shape = (int(frames.attrs["Nx"]), int(frames.attrs["Ny"]))
+        num_frames = frames.shape[0]
+
+    sparse_bytes = os.path.getsize(scan_path) + num_frames * EVENT_ARRAY_OVERHEAD_BYTES
+
+    shape = get_binned_shape(scan_shape, frame_shape, crop, bin_factor)
+    dense_bytes = int(np.prod(shape)) * itemsize
+    row_bytes = 2 * shape[1] * shape[2] * shape[3] * np.dtype(np.int64).itemsize
+
+    return WORKER_BASELINE_BYTES + sparse_bytes + dense_bytes + row_bytes
+
+
+def get_memory_budget(binning: Binning) -> int:
+    """Get the binning memory budget in bytes from the config, or from the
+    memory available right now if none is configured."""
+    if binning.memory_budget_gb is not None:
+        return int(binning.memory_budget_gb * 1024**3)
+    return int(psutil.virtual_memory().available * DEFAULT_BUDGET_FRACTION)
+
+
+def get_num_workers(
+    estimates: List[int], budget: int, max_workers: Optional[int] = None
+) -> int:
+    """Size the worker pool so that a typical scan fits the budget concurrently."""
+    if not estimates:
+        return 1
+
+    num_workers = max(1, budget // int(np.median(estimates)))
+    num_workers = min(num_workers, len(estimates), os.cpu_count() or 1)
+    if max_workers is not None:
+        num_workers = min(num_workers, max_workers)
+
+    return max(1, num_workers)
+
+
+class MemoryBudget:
+    """
+    Token pool of bytes. Work is admitted only once its estimated footprint
+    can be reserved, and returns the reservation when it completes.
+    """
+
+    def __init__(self, total_bytes: int):
+        self.total_bytes = total_bytes
+        self._available = total_bytes
+        self._condition = threading.Condition()
+
+    def acquire(self, num_bytes: int) -> int:
+        """
+        Block until `num_bytes` can be reserved and reserve them. Requests
+        larger than the whole budget are clamped, so they run on their own.
+
+        Returns:
+            reserved (int): The number of bytes to pass back to `release`.
+        """
+        reserved = min(num_bytes, self.total_bytes)
+        with self._condition:
+            self._condition.wait_for(lambda: self._available >= reserved)
+            self._available -= reserved
+        return reserved
+
+    def release(self, num_bytes: int) -> None:
+        with self._condition:
+            self._available += num_bytes
+            self._condition.notify_all()
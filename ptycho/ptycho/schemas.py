@@ -1,4 +1,5 @@
 from pathlib import Path
+from typing import Literal, Optional, Tuple
 
 from pydantic import BaseModel
 
@@ -39,6 +40,18 @@ class Experiment(BaseModel):
 
 class Binning(BaseModel):
     bin_diffraction_factor: int
+    memory_budget_gb: Optional[float] = None
+    max_workers: Optional[int] = None
+    save_binned: bool = True
+
+
+class OutputLayout(BaseModel):
+    # Real-space (rows, columns) per chunk; each chunk holds whole patterns
+    scan_tile: Tuple[int, int] = (16, 16)
+    # gzip is built into h5py, so the files read without hdf5plugin
+    compression: Optional[Literal["lz4", "blosc", "gzip"]] = "gzip"
+    level: Optional[int] = None
+    shuffle: bool = True
 
 
 class Calibration(BaseModel):
@@ -49,6 +62,8 @@ class Calibration(BaseModel):
 class Outputs(BaseModel):
     plots_dir: Path
     ptycho_npy_dir: Path
+    # Scan index and run manifests; by default the parent of plots_dir
+    state_dir: Optional[Path] = None
 
 
 class Config(BaseModel):
@@ -57,6 +72,7 @@ class Config(BaseModel):
     crop_vacuum_probe: CropData
     experiment: Experiment
     binning: Binning
+    binned_layout: Optional[OutputLayout] = None
     calibration: Calibration
     plot: Plot
     outputs: Outputs
@@ -119,6 +135,14 @@ class PtychoReconstruct(BaseModel):
     max_iter: int
     step_size: float
     q_lowpass: float
+    # Patterns per batch; by default half the scan, or what fits in memory
+    max_batch_size: Optional[int] = None
+    # Fraction of the free device (or host) memory the batches may use
+    batch_memory_fraction: float = 0.5
+    # Stop once the error changed by less than this fraction over the last
+    # convergence_window iterations; None always runs max_iter
+    convergence_tolerance: Optional[float] = None
+    convergence_window: int = 3
 
 
 class Ptycho(BaseModel):
@@ -127,7 +151,12 @@ class Ptycho(BaseModel):
 
 
 class Compute(BaseModel):
-    device: str
+    # "auto" uses a GPU if there is one, and the CPU otherwise
+    device: Literal["auto", "cpu", "gpu"] = "auto"
+    # CPU threads per MPI rank, by default the node's cores over its ranks
+    threads_per_rank: Optional[int] = None
+    # Threads per FFT on the CPU, by default threads_per_rank
+    fft_workers: Optional[int] = None
 
 
 class AnalysisConfig(BaseModel):
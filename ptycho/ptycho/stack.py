@@ -0,0 +1,85 @@
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+STACK_FILENAME = "rotated_objects.npy"
+STACK_INDEX_FILENAME = "rotated_objects_index.json"
+
+
+def get_rotated_object_path(npy_dir: Path, scan_path: Path) -> Path:
+    return npy_dir / f"{scan_path.stem}_rotated_object.npy"
+
+
+def write_stack(npy_dir: Path, scans: Sequence[Tuple[int, Path]]) -> Path:
+    """
+    Gather the rotated objects of `scans`, (scan_num, scan_path) pairs, into
+    one complex64 `[n_scans, H, W]` .npy file in `npy_dir`, with an index of
+    the scans next to it.
+
+    Objects smaller than the largest one are zero-padded at the bottom and
+    right; the index keeps each object's shape to crop the padding off.
+    Objects are copied one at a time, so memory use does not grow with the
+    number of scans.
+    """
+    objects = [
+        np.load(get_rotated_object_path(npy_dir, scan_path), mmap_mode="r")
+        for _, scan_path in scans
+    ]
+    shapes = [obj.shape for obj in objects]
+    height = max(shape[0] for shape in shapes)
+    width = max(shape[1] for shape in shapes)
+
+    stack_path = npy_dir / STACK_FILENAME
+    tmp_path = npy_dir / f".{STACK_FILENAME}.{os.getpid()}.tmp.npy"
+    try:
+        stack = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.complex64, shape=(len(objects), height, width)
+        )
+        for i, obj in enumerate(objects):
+            stack[i, : obj.shape[0], : obj.shape[1]] = obj
+            stack[i, obj.shape[0] :, :] = 0
+            stack[i, : obj.shape[0], obj.shape[1] :] = 0
+        stack.flush()
+        del stack
+        os.replace(tmp_path, stack_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+    index = {
+        "scan_nums": [scan_num for scan_num, _ in scans],
+        "scan_names": [scan_path.stem for _, scan_path in scans],
+        "shapes": [list(shape) for shape in shapes],
+    }
+    index_path = npy_dir / STACK_INDEX_FILENAME
+    tmp_index_path = index_path.with_name(f".{index_path.name}.{os.getpid()}.tmp")
+    with open(tmp_index_path, "w") as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_index_path, index_path)
+
+    return stack_path
+
+
+def load_stack(npy_dir: Path, mmap_mode: str = "r") -> Tuple[np.ndarray, Dict]:
+    """
+    Open the stack written by `write_stack`, memory-mapped by default, and
+    its index, with "scan_nums", "scan_names" and "shapes" lists.
+    """
+    with open(npy_dir / STACK_INDEX_FILENAME) as f:
+        index = json.load(f)
+    return np.load(npy_dir / STACK_FILENAME, mmap_mode=mmap_mode), index
+
+
+def get_stack_object(stack: np.ndarray, index: Dict, i: int) -> np.ndarray:
+    """The i-th object of a stack, without its padding."""
+    height, width = index["shapes"][i]
+    return stack[i, :height, :width]
+
+
+def get_stack_positions(index: Dict, scan_names: List[str]) -> List[int]:
+    """Positions of `scan_names` in the stack; raises KeyError if one is missing."""
+    positions = {name: i for i, name in enumerate(index["scan_names"])}
+    return [positions[name] for name in scan_names]
@@ -0,0 +1,160 @@
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+import h5py
+import py4DSTEM
+
+from .schemas import OutputLayout
+
+# Registers the LZ4 and Blosc filters with h5py, so any reader that imports
+# this module can decompress files written with them
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+
+def get_chunk_shape(
+    shape: Tuple[int, ...], scan_tile: Tuple[int, int]
+) -> Tuple[int, ...]:
+    """
+    Chunk a 4D datacube into real-space tiles of full diffraction patterns,
+    so reading a real-space window touches only the tiles it overlaps.
+    """
+    return (
+        min(scan_tile[0], shape[0]),
+        min(scan_tile[1], shape[1]),
+    ) + tuple(shape[2:])
+
+
+def get_filter_options(layout: Optional[OutputLayout]) -> Dict[str, Any]:
+    """
+    Get the `h5py.Group.create_dataset` keyword arguments for the compressor
+    in `layout`, without the chunk shape.
+    """
+    if layout is None:
+        return {}
+
+    options: Dict[str, Any] = {}
+    compression = layout.compression
+
+    if compression in ("lz4", "blosc") and hdf5plugin is None:
+        logging.warning(
+            f"hdf5plugin is not installed, writing with gzip instead of {compression}"
+        )
+        compression = "gzip"
+
+    if compression == "lz4":
+        options.update(hdf5plugin.LZ4())
+        if layout.shuffle:
+            options["shuffle"] = True
+    elif compression == "blosc":
+        options.update(
+            hdf5plugin.Blosc(
+                cname="lz4",
+                clevel=5 if layout.level is None else layout.level,
+                shuffle=(
+                    hdf5plugin.Blosc.SHUFFLE
+                    if layout.shuffle
+                    else hdf5plugin.Blosc.NOSHUFFLE
+                ),
+            )
+        )
+    elif compression == "gzip":
+        options["compression"] = "gzip"
+        options["compression_opts"] = 1 if layout.level is None else layout.level
+        options["shuffle"] = layout.shuffle
+
+    return options
+
+
+def get_dataset_options(
+    layout: Optional[OutputLayout], shape: Tuple[int, ...]
+) -> Dict[str, Any]:
+    """
+    Get the `h5py.Group.create_dataset` keyword arguments for a datacube of
+    `shape` written with `layout`. No layout gives h5py's defaults: one
+    contiguous, uncompressed dataset.
+    """
+    if layout is None:
+        return {}
+
+    options: Dict[str, Any] = {"chunks": get_chunk_shape(shape, layout.scan_tile)}
+    options.update(get_filter_options(layout))
+    return options
+
+
+class _DatasetOptionsGroup(h5py.Group):
+    """
+    An h5py group whose child groups create their "data" dataset with
+    `options`, so emdfile's own `to_h5` writes it with a layout.
+    """
+
+    def __init__(self, group: h5py.Group, options: Dict[str, Any]):
+        super().__init__(group.id)
+        self._options = options
+
+    def create_group(self, name, *args, **kwargs):
+        return _DataGroup(super().create_group(name, *args, **kwargs), self._options)
+
+
+class _DataGroup(h5py.Group):
+    def __init__(self, group: h5py.Group, options: Dict[str, Any]):
+        super().__init__(group.id)
+        self._options = options
+
+    def create_dataset(self, name, *args, **kwargs):
+        if name == "data":
+            kwargs.update(self._options)
+        return super().create_dataset(name, *args, **kwargs)
+
+
+class ChunkedDataCube(py4DSTEM.DataCube):
+    """
+    A DataCube that writes its data with the chunking and compression of
+    `get_dataset_options`, where emdfile would use h5py's defaults.
+
+    It shares the data, calibration and metadata of `datacube`, and is
+    saved under the class name DataCube, so it reads back as a plain one.
+    """
+
+    def __init__(self, datacube: py4DSTEM.DataCube, layout: OutputLayout):
+        super().__init__(
+            data=datacube.data,
+            name=datacube.name,
+            calibration=datacube.calibration,
+        )
+        for metadata in datacube.metadata.values():
+            self.metadata = metadata
+        self.layout = layout
+
+    def to_h5(self, group):
+        options = get_dataset_options(self.layout, self.data.shape)
+        grp = super().to_h5(_DatasetOptionsGroup(group, options))
+        grp.attrs["python_class"] = py4DSTEM.DataCube.__name__
+        return h5py.Group(grp.id)
+
+
+def with_layout(
+    datacube: py4DSTEM.DataCube, layout: Optional[OutputLayout]
+) -> py4DSTEM.DataCube:
+    """
+    Get a datacube to save in place of `datacube` that is written with
+    `layout`. No layout gives back `datacube`, written with h5py's defaults.
+    """
+    if layout is None:
+        return datacube
+    return ChunkedDataCube(datacube, layout)
+
+
+def read_error_hint(error: OSError) -> OSError:
+    """
+    Add what to install to an h5py read error, when the file may use a
+    filter from hdf5plugin that is not installed.
+    """
+    if hdf5plugin is None:
+        return OSError(
+            f"{error}. The file may be compressed with LZ4 or Blosc, which "
+            "needs hdf5plugin installed"
+        )
+    return error
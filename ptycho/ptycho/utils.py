@@ -1,13 +1,12 @@
 import json
-from collections import defaultdict
+from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Tuple, Union
+from typing import List, Optional, Tuple, Union
 
 import numpy as np
-import psutil
 from pydantic import ValidationError
 
-from .schemas import AnalysisConfig, Config
+from .schemas import AnalysisConfig, Config, Outputs
 
 
 # Load and validate JSON configuration
@@ -44,84 +43,181 @@ def load_and_validate_analysis_json(file_path: Path) -> AnalysisConfig:
         exit(1)
 
 
-def check_memory_usage(threshold=0.9):
-    """Check if the memory usage exceeds the given threshold."""
-    mem = psutil.virtual_memory()
-    return mem.percent >= threshold * 100
+def get_state_dir(outputs: Outputs) -> Path:
+    """Directory for the scan index and run manifests."""
+    return outputs.state_dir or outputs.plots_dir.parent
 
 
-def check_for_invalid_values(
-    name: str, array: np.ndarray
-) -> List[Tuple[int, int, int, int]]:
-    invalid_values: List[Tuple[int, int, int, int]] = []
-    invalid_indices = np.argwhere(np.isnan(array) | np.isinf(array))
-
-    if invalid_indices.size > 0:
-        print(f"{name} contains NaN or Inf values.")
-        invalid_values = [tuple(idx) for idx in invalid_indices]
-
-    return invalid_values
-
-
-def check_for_zero_slices(name: str, array: np.ndarray) -> List[Tuple]:
+def find_bad_patterns(
+    array: np.ndarray, chunk_rows: int = 16
+) -> Tuple[np.ndarray, np.ndarray]:
     """
-    Check if any 2D slice in the reciprocal space of a 4D data cube contains all zeroes.
+    Find the diffraction patterns that contain NaN or Inf values and those
+    that are all zero, in one pass over the data.
+
+    Patterns are zero if every entry is zero or non-finite, i.e. if they
+    would be all zero once the invalid values are replaced.
 
     Parameters:
-        arr (numpy.ndarray): A 4D array where the first two dimensions are real space
+        array (numpy.ndarray): A 4D array where the first two dimensions are real space
                                   and the last two dimensions are reciprocal space.
+        chunk_rows (int): Real-space rows reduced at a time, which bounds the size
+                                  of the temporary masks.
 
     Returns:
-        zero_slices (list): List of tuples indicating the indices of all-zero slices.
+        invalid (numpy.ndarray): Boolean (ny, nx) mask of patterns with NaN or Inf values.
+        zero (numpy.ndarray): Boolean (ny, nx) mask of all-zero patterns.
     """
-    # Initialize an empty list to store the indices of all-zero slices
-    zero_slices: List[tuple] = []
-
-    # Get the shape of the 4D data cube
     ny, nx, _, _ = array.shape
+    invalid = np.zeros((ny, nx), dtype=bool)
+    zero = np.zeros((ny, nx), dtype=bool)
+
+    for start in range(0, ny, chunk_rows):
+        chunk = array[start : start + chunk_rows]
+        zero[start : start + chunk_rows] = ~chunk.any(axis=(2, 3))
+        if not np.issubdtype(array.dtype, np.inexact):
+            continue
+
+        # A NaN or Inf makes the sum non-finite, so only the rare flagged
+        # patterns need an element-wise look
+        with np.errstate(over="ignore", invalid="ignore"):
+            sums = chunk.sum(axis=(2, 3))
+        rows, cols = np.nonzero(~np.isfinite(sums))
+        for i, j in zip(rows, cols):
+            finite = np.isfinite(chunk[i, j])
+            invalid[start + i, j] = not finite.all()
+            zero[start + i, j] = not (finite & (chunk[i, j] != 0)).any()
+
+    return invalid, zero
+
+
+@dataclass
+class InvalidValueStats:
+    """Summary of a `repair_invalid_values` pass."""
+
+    # Number of NaN or Inf entries replaced
+    num_values: int
+    # (k, 2) real-space indices of the patterns that contained them
+    positions: np.ndarray
+
+    @property
+    def num_patterns(self) -> int:
+        return len(self.positions)
+
+
+def repair_invalid_values(
+    array: np.ndarray,
+    patterns: Optional[np.ndarray] = None,
+    chunk_rows: int = 16,
+) -> InvalidValueStats:
+    """
+    Replace NaN and Inf values with zero, in place.
 
-    # Loop through the real-space dimensions
-    for i in range(ny):
-        for j in range(nx):
-            # Extract the 2D slice in reciprocal space
-            slice_2D = array[i, j, :, :]
+    The array is processed a few scan rows at a time, so the boolean masks
+    never have the size of the whole cube.
 
-            # Check if all elements in the 2D slice are zero
-            if np.all(slice_2D == 0):
-                zero_slices.append((i, j))
+    Parameters:
+        array (numpy.ndarray): A 4D data cube.
+        patterns (numpy.ndarray): Optional boolean (ny, nx) mask of the patterns
+                                  to repair, e.g. from `find_bad_patterns`. Only
+                                  scan rows containing flagged patterns are read.
+        chunk_rows (int): Real-space rows repaired at a time.
+
+    Returns:
+        stats (InvalidValueStats): How many values were replaced, and where.
+    """
+    ny = array.shape[0]
+    num_values = 0
+    positions = []
+    if not np.issubdtype(array.dtype, np.inexact):
+        return InvalidValueStats(0, np.empty((0, 2), dtype=np.intp))
 
-    # Print a message if all-zero slices are found
-    if zero_slices:
-        print(f"{name} has all-zero slices at real-space indices: {zero_slices}")
+    for start in range(0, ny, chunk_rows):
+        if patterns is not None and not patterns[start : start + chunk_rows].any():
+            continue
 
-    return zero_slices
+        chunk = array[start : start + chunk_rows]
+        invalid = ~np.isfinite(chunk)
+        count = int(np.count_nonzero(invalid))
+        if count == 0:
+            continue
 
+        num_values += count
+        rows, cols = np.nonzero(invalid.any(axis=(2, 3)))
+        positions.append(np.stack([rows + start, cols], axis=1))
+        chunk[invalid] = 0
 
-def replace_invalid_values(
-    array: np.ndarray, invalid_indices: List[Tuple[int, int, int, int]]
-) -> np.ndarray:
-    for idx in invalid_indices:
-        array[idx] = 0
-    return array
+    return InvalidValueStats(
+        num_values,
+        np.concatenate(positions) if positions else np.empty((0, 2), dtype=np.intp),
+    )
 
 
 def replace_zero_slices(
-    array: np.ndarray, zero_slices: List[Tuple[int, int]]
+    array: np.ndarray,
+    zero_slices: Union[np.ndarray, List[Tuple[int, int]]],
+    batch_size: int = 256,
 ) -> np.ndarray:
-    ny, nx, _, _ = array.shape
+    """
+    Replace each all-zero diffraction pattern with the mean of its (up to
+    four) real-space neighbours, in place.
 
-    for i, j in zero_slices:
-        neighbors = []
+    All patterns are filled from the original neighbours, so a zero
+    pattern next to another zero one averages in zeros. Each batch is
+    written back as soon as it is computed; replaced patterns that are
+    themselves neighbours are read from a snapshot of just those patterns.
 
-        if i > 0:
-            neighbors.append(array[i - 1, j, :, :])
-        if i < ny - 1:
-            neighbors.append(array[i + 1, j, :, :])
-        if j > 0:
-            neighbors.append(array[i, j - 1, :, :])
-        if j < nx - 1:
-            neighbors.append(array[i, j + 1, :, :])
+    Parameters:
+        array (numpy.ndarray): A 4D data cube.
+        zero_slices (numpy.ndarray or list): Boolean (ny, nx) mask, or list of
+                                  (i, j) indices, of the patterns to replace.
+        batch_size (int): Patterns filled at a time.
+
+    Returns:
+        array (numpy.ndarray): The repaired data cube.
+    """
+    ny, nx, _, _ = array.shape
 
-        array[i, j, :, :] = np.mean(neighbors, axis=0)
+    if isinstance(zero_slices, np.ndarray) and zero_slices.dtype == bool:
+        rows, cols = np.nonzero(zero_slices)
+    else:
+        rows, cols = np.asarray(zero_slices, dtype=np.intp).reshape(-1, 2).T
+    offsets = ((-1, 0), (1, 0), (0, -1), (0, 1))
+
+    # Snapshot the replaced patterns that another replaced pattern reads
+    replaced = np.zeros((ny, nx), dtype=bool)
+    replaced[rows, cols] = True
+    is_neighbor = np.zeros_like(replaced)
+    for di, dj in offsets:
+        i, j = rows + di, cols + dj
+        valid = (i >= 0) & (i < ny) & (j >= 0) & (j < nx)
+        is_neighbor[i[valid], j[valid]] = True
+    shared_rows, shared_cols = np.nonzero(replaced & is_neighbor)
+    snapshot = array[shared_rows, shared_cols]
+    snapshot_index = np.full((ny, nx), -1, dtype=np.intp)
+    snapshot_index[shared_rows, shared_cols] = np.arange(shared_rows.size)
+
+    # Fill in batches so the temporaries stay small
+    dtype = np.result_type(array.dtype, np.float32)
+    for start in range(0, rows.size, batch_size):
+        r, c = rows[start : start + batch_size], cols[start : start + batch_size]
+        total = np.zeros((r.size,) + array.shape[2:], dtype=dtype)
+        count = np.zeros(r.size, dtype=np.int64)
+        for di, dj in offsets:
+            i = np.clip(r + di, 0, ny - 1)
+            j = np.clip(c + dj, 0, nx - 1)
+            valid = (r + di == i) & (c + dj == j)
+            neighbors = array[i, j]
+            index = snapshot_index[i, j]
+            from_snapshot = index >= 0
+            neighbors[from_snapshot] = snapshot[index[from_snapshot]]
+            neighbors[~valid] = 0
+            total += neighbors
+            count += valid
+
+        # A 1x1 scan has no neighbours; leave the pattern as it is
+        has_neighbors = count > 0
+        total /= np.maximum(count, 1)[:, None, None]
+        array[r[has_neighbors], c[has_neighbors]] = total[has_neighbors]
 
     return array
@@ -0,0 +1,106 @@
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+import h5py
+
+from .scan_index import parse_scan_filename
+
+
+def is_complete_scan(scan_path: Path) -> bool:
+    """Check that the writer has closed the file and the event data is there."""
+    try:
+        with h5py.File(scan_path, "r") as f:
+            return (
+                "electron_events/frames" in f and "electron_events/scan_positions" in f
+            )
+    except OSError:
+        return False
+
+
+def watch_scans(
+    base_path: Path,
+    min_scan_num: int = 0,
+    max_scan_num: Optional[int] = None,
+    poll_interval: float = 5.0,
+    settle_time: float = 10.0,
+    idle_timeout: Optional[float] = None,
+) -> Iterator[Tuple[Path, int, int]]:
+    """
+    Poll `base_path` and yield (scan_path, scan_num, distiller_id) for each
+    raw scan once it is complete, in the order the scans become complete.
+
+    A scan is complete once its size and modification time have not changed
+    for `settle_time` seconds and it opens as a valid stempy HDF5 file.
+    Scans already on disk when watching starts are yielded first. Once
+    `max_scan_num` has been yielded, the generator keeps polling until the
+    earlier scans still being written are yielded too, then returns.
+
+    With `idle_timeout`, it also returns once no scan has appeared, changed
+    or completed for that many seconds, logging any scans left incomplete.
+    Without it, and without `max_scan_num`, it runs forever.
+
+    Parameters:
+        base_path (Path): Directory the counted data lands in.
+        min_scan_num (int): Ignore scans below this number.
+        max_scan_num (int or None): Last scan of the session.
+        poll_interval (float): Seconds between directory listings.
+        settle_time (float): Seconds a file must be unchanged to be complete.
+        idle_timeout (float or None): Seconds without activity before giving up.
+    """
+    # scan_path -> (size, mtime, time first seen with that size and mtime)
+    pending: Dict[Path, Tuple[int, float, float]] = {}
+    done: Set[Path] = set()
+    last_done = False
+    last_activity = time.monotonic()
+
+    while True:
+        now = time.monotonic()
+        ready = []
+
+        with os.scandir(base_path) as entries:
+            for entry in entries:
+                parsed = parse_scan_filename(entry.name)
+                if parsed is None:
+                    continue
+
+                scan_num, distiller_id = parsed
+                scan_path = Path(entry.path)
+                if scan_path in done or scan_num < min_scan_num:
+                    continue
+                if max_scan_num is not None and scan_num > max_scan_num:
+                    continue
+
+                stat = entry.stat()
+                previous = pending.get(scan_path)
+                if previous is None or previous[:2] != (stat.st_size, stat.st_mtime):
+                    pending[scan_path] = (stat.st_size, stat.st_mtime, now)
+                    last_activity = now
+                elif now - previous[2] >= settle_time and is_complete_scan(scan_path):
+                    ready.append((scan_num, distiller_id, scan_path))
+
+        for scan_num, distiller_id, scan_path in sorted(ready):
+            done.add(scan_path)
+            del pending[scan_path]
+            last_activity = time.monotonic()
+            if max_scan_num is not None and scan_num >= max_scan_num:
+                last_done = True
+            yield scan_path, scan_num, distiller_id
+
+        # Scans below the last one may still be settling
+        if last_done and not pending:
+            return
+
+        if idle_timeout is not None and time.monotonic() - last_activity > idle_timeout:
+            if pending:
+                logging.warning(
+                    f"No activity for {idle_timeout} s, giving up on incomplete "
+                    f"scans: {sorted(p.name for p in pending)}"
+                )
+            else:
+                logging.info(f"No new scans for {idle_timeout} s, stopping")
+            return
+
+        time.sleep(poll_interval)
@@ -0,0 +1,49 @@
+import logging
+import queue
+import threading
+from typing import Any, Callable
+
+_STOP = object()
+
+
+class BackgroundWriter:
+    """
+    Run file writes in order on a background thread, so computation can
+    carry on while results go to disk.
+
+    At most `max_pending` writes are queued; `submit` blocks beyond that so
+    the arrays held by pending writes cannot pile up in memory.
+    """
+
+    def __init__(self, max_pending: int = 2):
+        self._queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(
+            target=self._run, name="background_writer", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+
+            func, args, kwargs = item
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                logging.error(f"Background write with {func.__name__} failed: {e}")
+
+    def submit(self, func: Callable[..., Any], *args, **kwargs) -> None:
+        self._queue.put((func, args, kwargs))
+
+    def close(self) -> None:
+        """Wait for all submitted writes to finish."""
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
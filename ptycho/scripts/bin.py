@@ -1,106 +1,35 @@
 import argparse
 import datetime
 import sys
-import time
-from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+from functools import partial
 from pathlib import Path
 from typing import List
 
-import emdfile as emd
-import py4DSTEM
-import stempy.io as stio
-from stempy.contrib import get_scan_path
-
-
 sys.path.append("/analysis")
 
+from ptycho.binning import (
+    get_relative_acquisition_time,
+    init_worker,
+    process_scan,
+    share_vacuum_probe,
+)
+from ptycho.cache import get_bin_key
+from ptycho.manifest import RunManifest, load_completed
+from ptycho.scan_index import find_scans
 from ptycho.schemas import Config
-from ptycho.utils import check_memory_usage, load_and_validate_config_json
-
-
-def process_scan(
-    scan_path: Path,
-    scan_id: int,
-    scan_num: int,
-    config: Config,
-    relative_acquisition_time: datetime.timedelta,
-    vacuum_probe: py4DSTEM.Array,
-) -> None:
-    while check_memory_usage():
-        print("Memory usage above 90%. Waiting...")
-        time.sleep(10)  # Wait for 10 seconds before checking again
-
-    # Load the sparse 4D Camera dataset
-    stempy_sparse_array: stio.SparseArray = stio.SparseArray.from_hdf5(scan_path)
-
-    # Remove flyback row and first column
-    stempy_sparse_array = stempy_sparse_array[:, :-1, :, :]
-    stempy_sparse_array = stempy_sparse_array[1:, :, :, :]
-
-    # Crop real space
-    x_min = config.crop_full_data.x_min
-    x_max = config.crop_full_data.x_max
-    y_min = config.crop_full_data.y_min
-    y_max = config.crop_full_data.y_max
-    stempy_sparse_array = stempy_sparse_array[y_min:y_max, x_min:x_max, :, :]
-
-    # Bin
-    stempy_sparse_array_binned: stio.SparseArray = stempy_sparse_array.bin_frames(
-        config.binning.bin_diffraction_factor
-    )
-    datacube: py4DSTEM.DataCube = py4DSTEM.DataCube(
-        stempy_sparse_array_binned.to_dense(), name=scan_path.stem
-    )
-
-    # Calibration
-    probe_radius_pixels, probe_qx0, probe_qy0 = datacube.get_probe_size(
-        vacuum_probe.data, plot=False, thresh_upper=0.95
-    )
-    r_pixel_size: float = config.microscope.r_pixel_size
-    r_pixel_units: str = config.microscope.r_pixel_units
-    convergence_semiangle: float = config.microscope.convergence_semiangle
-    q_pixel_size: float = convergence_semiangle / probe_radius_pixels
-    q_pixel_units: str = config.microscope.q_pixel_units
-
-    file_metadata = {
-        "scan_num": scan_num,
-        "distiller_id": scan_id,
-        "relative_acquisition_time": relative_acquisition_time.seconds,
-    }
-    preprocessing_metadata = {
-        "stempy_frame_bin_factor": config.binning.bin_diffraction_factor,
-        "removed_first_column": True,
-        "removed_flyback_row": True,
-        "crop_Rx_start": x_min,
-        "crop_Rx_end": x_max,
-        "crop_Ry_start": y_min,
-        "crop_Ry_end": y_max,
-        "probe_qx0": probe_qx0,
-        "probe_qy0": probe_qy0,
-        "probe_radius_pixels": probe_radius_pixels,
-    }
-
-    datacube.metadata = emd.Metadata(name="file_metadata", data=file_metadata)
-    datacube.metadata = emd.Metadata(
-        name="preprocessing_metadata", data=preprocessing_metadata
-    )
-
-    datacube.calibration.set_R_pixel_size(r_pixel_size)
-    datacube.calibration.set_R_pixel_units(r_pixel_units)
-    datacube.calibration.set_Q_pixel_size(q_pixel_size)
-    datacube.calibration.set_Q_pixel_units(q_pixel_units)
-
-    # Create emd root
-    root = emd.Root(name=scan_path.stem)
-
-    # Add node
-    node = emd.Node(name=f"bin_{config.binning.bin_diffraction_factor}")
-    root.tree(node)
-    node.tree(graft=datacube)
-    node.tree(graft=vacuum_probe)
-    output_filename: Path = scan_path.with_stem(scan_path.stem + "_binned_calibrated")
-
-    py4DSTEM.save(output_filename, root, mode="o")
+from ptycho.scheduler import (
+    MemoryBudget,
+    estimate_scan_memory,
+    get_memory_budget,
+    get_num_workers,
+)
+from ptycho.utils import get_state_dir, load_and_validate_config_json
 
 
 def main() -> None:
@@ -112,60 +41,130 @@ def main() -> None:
         default="/analysis/config/general_config.json",
         help="Path to the configuration file.",
     )
+    parser.add_argument(
+        "--profile_dir",
+        type=Path,
+        default=None,
+        help="Write per-stage timing and memory records to this directory.",
+    )
+    parser.add_argument(
+        "--manifest_dir",
+        type=Path,
+        default=None,
+        help=(
+            "Record finished scans in this directory, "
+            "<state_dir>/run_manifest by default."
+        ),
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help=(
+            "Skip scans the manifest records as binned, with unchanged output "
+            "and binning config."
+        ),
+    )
     args = parser.parse_args()
 
     # Load and validate configuration
     config: Config = load_and_validate_config_json(Path(args.config_file))
+    manifest_dir: Path = (
+        args.manifest_dir or get_state_dir(config.outputs) / "run_manifest"
+    )
+    completed = load_completed(manifest_dir, "bin") if args.resume else {}
 
     # Find scan paths/numbers
     scan_paths: List[Path] = []
     scan_ids: List[int] = []
     scan_nums: List[int] = []
     relative_acquisition_times: List[datetime.timedelta] = []
+    bin_keys: List[str] = []
 
     # Fill in the lists
     min_scan_num = config.experiment.min_scan_num
     max_scan_num = config.experiment.max_scan_num
     base_path = config.experiment.data_base_path
-    for scan_num in range(min_scan_num, max_scan_num + 1):
-        scan_path, scan_num, scan_id = get_scan_path(
-            base_path, scan_num=scan_num, version=1
+    index_dir = get_state_dir(config.outputs) / "scan_index"
+    num_skipped = 0
+    for scan in find_scans(base_path, min_scan_num, max_scan_num, index_dir):
+        relative_acquisition_time = get_relative_acquisition_time(config, scan.scan_num)
+        bin_key = get_bin_key(scan.path, config, relative_acquisition_time)
+        if completed.get(scan.path.stem, {}).get("cache_key") == bin_key:
+            num_skipped += 1
+            continue
+        scan_paths.append(scan.path)
+        scan_nums.append(scan.scan_num)
+        scan_ids.append(scan.distiller_id)
+        relative_acquisition_times.append(relative_acquisition_time)
+        bin_keys.append(bin_key)
+
+    if args.resume:
+        print(f"Resuming: {num_skipped} scans already binned with this config.")
+    manifest = RunManifest(manifest_dir, "bin")
+
+    # Record scans as they finish rather than at the end, so a killed job
+    # keeps them. Checksums run on their own thread, off the pool's.
+    recorder = ThreadPoolExecutor(max_workers=1)
+
+    def record(future: Future, stem: str, bin_key: str) -> None:
+        if future.exception() is None:
+            recorder.submit(
+                manifest.record, stem, "bin", [future.result()], cache_key=bin_key
+            )
+
+    # Get probe, measure its size once for all scans and share it with the
+    # workers instead of pickling it with every scan
+    probe_shm, init_args = share_vacuum_probe(config)
+
+    # Estimate the peak footprint of each scan and size the pool to the budget
+    estimates: List[int] = [
+        estimate_scan_memory(
+            scan_path, config.crop_full_data, config.binning.bin_diffraction_factor
         )
-        if scan_path and scan_num and scan_id:
-            scan_paths.append(scan_path)
-            scan_nums.append(scan_num)
-            scan_ids.append(scan_id)
-            seconds_offset = (
-                scan_num - min_scan_num
-            ) * config.experiment.seconds_between_scans
-            relative_acquisition_time = datetime.timedelta(seconds=seconds_offset)
-            relative_acquisition_times.append(relative_acquisition_time)
-
-    # Get probe
-    fp_probe: Path = config.calibration.vacuum_probe_emd_path
-    probe: py4DSTEM.Array = py4DSTEM.read(fp_probe)
-
-    # Run the process_scan function in parallel for each scan path and associated haadf path
+        for scan_path in scan_paths
+    ]
+    budget = MemoryBudget(get_memory_budget(config.binning))
+    max_workers = get_num_workers(
+        estimates, budget.total_bytes, config.binning.max_workers
+    )
+    print(
+        f"Binning {len(scan_paths)} scans with {max_workers} workers and a "
+        f"{budget.total_bytes / 1024**3:.1f} GB memory budget."
+    )
+
+    # Run the process_scan function in parallel for each scan path, admitting
+    # each scan only once its estimated footprint fits in the budget
     futures: List[Future] = []
-    with ProcessPoolExecutor() as executor:
-        futures = [
-            executor.submit(
-                process_scan,
-                scan_paths[i],
-                scan_ids[i],
-                scan_nums[i],
-                config,
-                relative_acquisition_times[i],
-                probe,
-            )
-            for i in range(len(scan_paths))
-        ]
-
-        for future in as_completed(futures):
-            try:
-                future.result()
-            except Exception as e:
-                print(f"An exception occurred during parallel execution: {e}")
+    try:
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=init_worker,
+            initargs=(*init_args, args.profile_dir),
+        ) as executor:
+            for i in range(len(scan_paths)):
+                reserved = budget.acquire(estimates[i])
+                future = executor.submit(
+                    process_scan,
+                    scan_paths[i],
+                    scan_ids[i],
+                    scan_nums[i],
+                    relative_acquisition_times[i],
+                )
+                future.add_done_callback(lambda _, n=reserved: budget.release(n))
+                future.add_done_callback(
+                    partial(record, stem=scan_paths[i].stem, bin_key=bin_keys[i])
+                )
+                futures.append(future)
+
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"An exception occurred during parallel execution: {e}")
+    finally:
+        recorder.shutdown()
+        probe_shm.close()
+        probe_shm.unlink()
 
 
 if __name__ == "__main__":
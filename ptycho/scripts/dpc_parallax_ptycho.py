@@ -2,26 +2,36 @@ import argparse
 import logging
 import sys
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
-import cupy as cp
-import h5py
-import py4DSTEM
 from mpi4py import MPI
-from stempy.contrib import get_scan_path
 
 sys.path.append("/analysis")
 
 
-from ptycho.schemas import DPC, AnalysisConfig, Config
+from ptycho.backend import configure_backend
+from ptycho.binning import load_vacuum_probe
+from ptycho.cache import STAGES, get_stage_keys
+from ptycho.dispatch import log_utilization, run_master, run_worker
+from ptycho.manifest import RunManifest, load_completed
+from ptycho.profiling import configure_profiling
+from ptycho.reconstruction import (
+    get_binned_path,
+    get_cache_plan,
+    load_binned_scan,
+    needs_parallax_window_only,
+    prepare_raw_scan,
+    reconstruct_datacube,
+)
+from ptycho.results import get_results_path
+from ptycho.scan_index import find_scans
+from ptycho.schemas import AnalysisConfig, Config
 from ptycho.utils import (
-    check_for_invalid_values,
-    check_for_zero_slices,
+    get_state_dir,
     load_and_validate_analysis_json,
     load_and_validate_config_json,
-    replace_invalid_values,
-    replace_zero_slices,
 )
+from ptycho.writer import BackgroundWriter
 
 # Configure logging to file
 logging.basicConfig(
@@ -38,182 +48,20 @@ console_handler.setFormatter(formatter)
 logging.getLogger("").addHandler(console_handler)
 
 
-def save_data(scan_path, config, output_filename, save_parallax_items, save_matrix):
-    try:
-        with h5py.File(output_filename, "a") as f:
-            middle_group: str = f"bin_{config.binning.bin_diffraction_factor}"
-
-            # Save items in save_matrix
-            for k, v in save_matrix.items():
-                logging.info(f"Saving {k} for {scan_path.stem}.")
-                group_path = f"{scan_path.stem}/{middle_group}/{scan_path.stem}/{k}"
-                logging.info(f"Group path: {group_path}")
-                # Check if the group already exists and delete it
-                if group_path in f:
-                    del f[group_path]
-
-                # Create the new group
-                group = f.create_group(group_path)
-
-                # Save the new dataset
-                v.to_h5(group)
-
-            # Save items in save_parallax_items
-            group_path = f"{scan_path.stem}/{middle_group}/{scan_path.stem}/parallax"
-
-            # Check if the group already exists and delete it
-            if group_path in f:
-                del f[group_path]
-
-            # Create the new group
-            group = f.create_group(group_path)
-
-            for k, v in save_parallax_items.items():
-                # Create the new dataset
-                group.create_dataset(k, data=v)
-
-            logging.info(f"Data saved successfully for {scan_path.stem}.")
-
-    except Exception as e:
-        logging.error(f"An error occurred while saving data for {scan_path}: {e}")
-
-
-def process_scan(
-    scan_path: Path,
-    config: Config,
-    analysis_config: AnalysisConfig,
-) -> None:
-    # Load the binned dataset
-    output_filename: Path = scan_path.with_stem(scan_path.stem + "_binned_calibrated")
-
-    logging.info(f"Reading datacube file: {output_filename}")
-    datacube: py4DSTEM.DataCube = py4DSTEM.read(output_filename).tree(scan_path.stem)
-    invalid_values = check_for_invalid_values(scan_path.stem, datacube.data)
-
-    # invalid values and zero slices from datacube
-    if invalid_values:
-        logging.info(f"invalid values file: {output_filename}")
-        datacube.data = replace_invalid_values(datacube.data, invalid_values)
-
-    all_zero_slices = check_for_zero_slices(scan_path.stem, datacube.data)
-    if all_zero_slices:
-        logging.info(f"all zeros file: {output_filename}")
-        datacube.data = replace_zero_slices(datacube.data, all_zero_slices)
-
-    device: str = analysis_config.compute.device
-    energy: int = config.microscope.beam_energy
-    probe_radius_pixels = datacube.metadata["preprocessing_metadata"][
-        "probe_radius_pixels"
+def get_finished_stages(
+    scan_path: Path, keys: Dict[str, str], completed: Dict[str, Dict[str, Dict]]
+) -> List[str]:
+    """
+    Stages the manifest records as finished for a scan, with unchanged
+    results and the same stage key as now.
+    """
+    return [
+        stage
+        for stage in STAGES
+        if completed.get(stage, {}).get(scan_path.stem, {}).get("cache_key")
+        == keys[stage]
     ]
 
-    # BF/DF can be done, but no need for purpose of this paper.
-    # expand_BF = analysis_config.bf_df.expand_BF
-    # probe_qx0 = datacube.metadata["preprocessing_metadata"]["probe_qx0"]
-    # probe_qy0 = datacube.metadata["preprocessing_metadata"]["probe_qy0"]
-    # center = (probe_qx0, probe_qy0)
-    # radius_BF = probe_radius_pixels + expand_BF
-    # radii_DF = (probe_radius_pixels + expand_BF, analysis_config.bf_df.extra_radius)
-
-    # datacube.get_virtual_image(
-    #     mode="circle",
-    #     geometry=(center, radius_BF),
-    #     name="bright_field",
-    #     shift_center=False,
-    # )
-    # datacube.get_virtual_image(
-    #     mode="annulus",
-    #     geometry=(center, radii_DF),
-    #     name="dark_field",
-    #     shift_center=False,
-    # )
-
-    # DPC
-    logging.info(f"Performing DPC file: {output_filename}")
-    dpc = py4DSTEM.process.phase.DPCReconstruction(
-        datacube=datacube, energy=energy, device=device
-    ).preprocess(force_com_rotation=analysis_config.dpc.preprocess.force_com_rotation)
-
-    dpc = dpc.reconstruct(
-        reset=analysis_config.dpc.reconstruct.reset,
-        q_highpass=analysis_config.dpc.reconstruct.q_highpass,
-        store_iterations=analysis_config.dpc.reconstruct.store_iterations,
-    )
-
-    # Parallax
-    logging.info(f"Performing parallax file: {output_filename}")
-    datacube_cropped = datacube.copy()
-    datacube_cropped.crop_R(
-        (
-            analysis_config.parallax.crop_R.x_min,
-            analysis_config.parallax.crop_R.x_max,
-            analysis_config.parallax.crop_R.y_min,
-            analysis_config.parallax.crop_R.y_max,
-        )
-    )
-    parallax = py4DSTEM.process.phase.ParallaxReconstruction(
-        datacube=datacube_cropped,
-        energy=energy,
-        device=device,
-        object_padding_px=analysis_config.parallax.instantiation.object_padding_px,
-    ).preprocess(
-        threshold_intensity=analysis_config.parallax.preprocess.threshold_intensity,
-        edge_blend=analysis_config.parallax.preprocess.edge_blend,
-        defocus_guess=analysis_config.parallax.preprocess.defocus_guess,
-        rotation_guess=analysis_config.parallax.preprocess.rotation_guess,
-    )
-
-    parallax = parallax.reconstruct(
-        reset=analysis_config.parallax.reconstruct.reset,
-        min_alignment_bin=analysis_config.parallax.reconstruct.min_alignment_bin,
-        max_iter_at_min_bin=analysis_config.parallax.reconstruct.max_iter_at_min_bin,
-        running_average=analysis_config.parallax.reconstruct.running_average,
-        plot_aligned_bf=False,
-        plot_convergence=False,
-    )
-
-    parallax.aberration_fit()
-    parallax.aberration_correct()
-
-    # Ptycho
-    logging.info(f"Performing ptycho file: {output_filename}")
-    defocus = -parallax.aberration_C1
-
-    ptycho = py4DSTEM.process.phase.SingleslicePtychographicReconstruction(
-        datacube=datacube,
-        device=device,
-        energy=energy,
-        semiangle_cutoff=17.1,
-        defocus=0,
-    ).preprocess(
-        force_com_transpose=analysis_config.ptycho.preprocess.force_com_transpose,
-        force_com_rotation=analysis_config.ptycho.preprocess.force_com_rotation,
-        fit_function=analysis_config.ptycho.preprocess.fit_function,
-        plot_center_of_mass=False,
-    )
-
-    ptycho = ptycho.reconstruct(
-        reset=analysis_config.ptycho.reconstruct.reset,
-        max_iter=analysis_config.ptycho.reconstruct.max_iter,
-        step_size=analysis_config.ptycho.reconstruct.step_size,
-        max_batch_size=ptycho._num_diffraction_patterns // 2,
-        q_lowpass=analysis_config.ptycho.reconstruct.q_lowpass,
-        store_iterations=analysis_config.ptycho.reconstruct.store_iterations,
-    )
-
-    save_parallax_items: dict = {
-        "recon_phase_corrected": parallax.recon_phase_corrected,
-        "_scan_sampling": parallax._scan_sampling,
-        "rotation_Q_to_R_rads": parallax.rotation_Q_to_R_rads,
-        "aberration_A1x": parallax.aberration_A1x,
-        "aberration_A1y": parallax.aberration_A1y,
-        "aberration_C1": parallax.aberration_C1,
-    }
-
-    # No need to save dpc
-    save_matrix: dict = {"ptycho": ptycho}
-
-    save_data(scan_path, config, output_filename, save_parallax_items, save_matrix)
-
 
 def main():
     # Initialize MPI
@@ -237,27 +85,115 @@ def main():
             default="/analysis/config/dpc_parallax_ptycho_params.json",
             help="Path to the analysis configuration file.",
         )
+        parser.add_argument(
+            "--fused",
+            action="store_true",
+            help=(
+                "Bin the raw scans in this process and reconstruct the binned "
+                "datacube in memory, instead of reading the output of bin.py."
+            ),
+        )
+        parser.add_argument(
+            "--schedule",
+            choices=["static", "dynamic"],
+            default="static",
+            help=(
+                "static: split the scans into contiguous blocks per rank. "
+                "dynamic: rank 0 hands out scans to every rank, itself "
+                "included, on demand."
+            ),
+        )
+        parser.add_argument(
+            "--prefetch",
+            action="store_true",
+            help=(
+                "With --schedule dynamic, load the next scan while the current "
+                "one reconstructs."
+            ),
+        )
+        parser.add_argument(
+            "--utilization_report",
+            type=Path,
+            default=None,
+            help="With --schedule dynamic, write per-rank utilization as JSON.",
+        )
+        parser.add_argument(
+            "--profile_dir",
+            type=Path,
+            default=None,
+            help="Write per-stage timing and memory records to this directory.",
+        )
+        parser.add_argument(
+            "--no_cache",
+            action="store_true",
+            help="Rerun every stage, even if its results are up to date.",
+        )
+        parser.add_argument(
+            "--manifest_dir",
+            type=Path,
+            default=None,
+            help=(
+                "Record the finished stages of each scan in this directory, "
+                "<state_dir>/run_manifest by default."
+            ),
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help=(
+                "Skip the stages the manifest records as finished, with "
+                "unchanged results and parameters, and scans with all of them."
+            ),
+        )
         args = parser.parse_args()
+        fused: bool = args.fused
+        use_cache: bool = not args.no_cache
+        profile_dir: Optional[Path] = args.profile_dir
+        schedule: str = args.schedule
+        prefetch: bool = args.prefetch
 
         # Load and validate configuration
         config: Config = load_and_validate_config_json(Path(args.config_file))
         analysis_config: AnalysisConfig = load_and_validate_analysis_json(
             Path(args.analysis_config_file)
         )
+        manifest_dir: Path = (
+            args.manifest_dir or get_state_dir(config.outputs) / "run_manifest"
+        )
+        completed: Dict[str, Dict[str, Dict]] = (
+            {stage: load_completed(manifest_dir, stage) for stage in STAGES}
+            if args.resume
+            else {}
+        )
 
-        # Find scan paths
-        scan_paths: List[Path] = []
+        def is_finished(scan_path: Path) -> bool:
+            if not completed or any(
+                scan_path.stem not in completed[stage] for stage in STAGES
+            ):
+                return False
+            input_path = scan_path if fused else get_binned_path(scan_path)
+            try:
+                keys = get_stage_keys(input_path, config, analysis_config)
+            except OSError:
+                return False
+            return len(get_finished_stages(scan_path, keys, completed)) == len(STAGES)
+
+        # Find scan paths, numbers and distiller ids
+        scan_paths: List[Tuple[Path, int, int]] = []
 
         # Fill in the lists
         min_scan_num = config.experiment.min_scan_num
         max_scan_num = config.experiment.max_scan_num
         base_path = config.experiment.data_base_path
-        for scan_num in range(min_scan_num, max_scan_num + 1):
-            scan_path, scan_num, scan_id = get_scan_path(
-                base_path, scan_num=scan_num, version=1
-            )
-            if scan_path and scan_num and scan_id:
-                scan_paths.append(scan_path)
+        index_dir = get_state_dir(config.outputs) / "scan_index"
+        num_finished = 0
+        for scan in find_scans(base_path, min_scan_num, max_scan_num, index_dir):
+            if is_finished(scan.path):
+                num_finished += 1
+                continue
+            scan_paths.append((scan.path, scan.scan_num, scan.distiller_id))
+        if args.resume:
+            logging.info(f"Resuming: {num_finished} scans already reconstructed")
 
         # Divide the scan_paths among all available ranks
         avg_num_scan_paths: int = len(scan_paths) // size
@@ -276,24 +212,117 @@ def main():
         displacements = []
         config = None  # type: ignore
         analysis_config = None  # type: ignore
+        fused = False
+        schedule = None  # type: ignore
+        prefetch = False
+        profile_dir = None
+        use_cache = True
+        manifest_dir = None  # type: ignore
+        completed = None  # type: ignore
 
     # Broadcast configurations to all ranks
     config = comm.bcast(config, root=0)
     analysis_config = comm.bcast(analysis_config, root=0)
+    fused = comm.bcast(fused, root=0)
+    schedule = comm.bcast(schedule, root=0)
+    prefetch = comm.bcast(prefetch, root=0)
+    profile_dir = comm.bcast(profile_dir, root=0)
+    use_cache = comm.bcast(use_cache, root=0)
+    manifest_dir = comm.bcast(manifest_dir, root=0)
+    completed = comm.bcast(completed, root=0)
+    configure_profiling(profile_dir, f"rank_{rank}")
+
+    # Ranks on the same node share its GPUs, or split its cores
+    local_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+    configure_backend(
+        analysis_config.compute,
+        local_comm.Get_rank(),
+        local_comm.Get_size(),
+        local_comm,
+    )
+    manifest = RunManifest(manifest_dir, f"reconstruct_rank_{rank}")
+
+    def record(scan_path: Path, keys: Dict[str, str]) -> None:
+        # The results file holds every stage, run now or kept from before
+        manifest.record_stages(
+            scan_path.stem,
+            {stage: {"cache_key": keys[stage]} for stage in STAGES},
+            [get_results_path(scan_path)],
+        )
+
+    if fused:
+        # Bin in memory, persisting binned cubes and results in the background
+        vacuum_probe, probe_size = load_vacuum_probe(config)
 
-    # Broadcast paths, counts, and displacements to all ranks
-    num_datasets = comm.bcast(num_datasets, root=0)
-    displacements = comm.bcast(displacements, root=0)
-    scan_paths = comm.bcast(scan_paths, root=0)
+        def load_datacube(scan, stages):
+            scan_path, scan_num, scan_id = scan
+            datacube = prepare_raw_scan(
+                scan_path, scan_id, scan_num, config, vacuum_probe, probe_size, writer
+            )
+            return datacube, False
 
-    # Calculate the range of scan_paths for this rank
-    start_idx = displacements[rank]
-    end_idx = start_idx + num_datasets[rank]
+    else:
+
+        def load_datacube(scan, stages):
+            # Parallax alone only needs its window of the binned file
+            datacube = load_binned_scan(scan[0], config, analysis_config, stages)
+            return datacube, needs_parallax_window_only(stages)
+
+    def load(scan):
+        # Skip loading (and binning) altogether if every stage is cached
+        scan_path = scan[0]
+        input_path = scan_path if fused else get_binned_path(scan_path)
+        keys, stages = get_cache_plan(
+            scan_path, input_path, config, analysis_config, use_cache
+        )
+        # Stages an interrupted run finished are kept, even without the cache
+        finished = get_finished_stages(scan_path, keys, completed)
+        stages = [stage for stage in stages if stage not in finished]
+        if not stages:
+            logging.info(f"All results cached for file: {scan_path.stem}")
+            record(scan_path, keys)
+            return None
+        return load_datacube(scan, stages), keys, stages
+
+    def process(scan, loaded):
+        if loaded is None:
+            return
+        (datacube, cropped), keys, stages = loaded
+        # Recorded on the writer thread, once the results file is in place
+        reconstruct_datacube(
+            scan[0],
+            datacube,
+            config,
+            analysis_config,
+            writer,
+            stages=stages,
+            cache_keys=keys,
+            on_saved=lambda: record(scan[0], keys),
+            cropped=cropped,
+        )
 
-    # Process the data
-    for scan_path in scan_paths[start_idx:end_idx]:
-        logging.info(f"Rank {rank} processing file: {scan_path.stem}")
-        process_scan(scan_path, config, analysis_config)
+    with BackgroundWriter() as writer:
+        if schedule == "dynamic":
+            if rank == 0:
+                stats = run_master(comm, scan_paths, load, process, prefetch)
+                log_utilization(stats, args.utilization_report)
+            else:
+                run_worker(comm, load, process, prefetch=prefetch)
+            return
+
+        # Broadcast paths, counts, and displacements to all ranks
+        num_datasets = comm.bcast(num_datasets, root=0)
+        displacements = comm.bcast(displacements, root=0)
+        scan_paths = comm.bcast(scan_paths, root=0)
+
+        # Calculate the range of scan_paths for this rank
+        start_idx = displacements[rank]
+        end_idx = start_idx + num_datasets[rank]
+
+        # Process the data
+        for scan in scan_paths[start_idx:end_idx]:
+            logging.info(f"Rank {rank} processing file: {scan[0].stem}")
+            process(scan, load(scan))
 
 
 if __name__ == "__main__":
@@ -2,18 +2,22 @@ import os
 import re
 import sys
 from pathlib import Path
+from typing import List, Tuple
 
 import h5py
 import matplotlib.pyplot as plt
-import ncempy
 import numpy as np
 import py4DSTEM
-from scipy import ndimage
 
 sys.path.append("/analysis/")
+from ptycho.drift import DriftTracker
+from ptycho.results import find_results_path
 from ptycho.schemas import Config
+from ptycho.stack import get_rotated_object_path, get_stack_positions, load_stack
 from ptycho.utils import load_and_validate_config_json
 
+DRIFT_CACHE_FILENAME = "drift_cache.json"
+
 # This is due to a bug in py4dstem - we can't load a dataset that was created
 # using a GPU on a CPU-based machine
 # see https://github.com/py4dstem/py4DSTEM/issues/540
@@ -26,84 +30,110 @@ except:
     print("Cupy couldn't be imported, using ptycho NPY files...")
 
 
-def load_hdf5_data(config: Config, processed_path: Path, orig_path: Path):
-    extracted_data = {}
-    middle_group = f"bin_{config.binning.bin_diffraction_factor}"
-    base_datapath = f"{orig_path.stem}/{middle_group}/{orig_path.stem}/"
+PARALLAX_SCALARS = (
+    "aberration_A1x",
+    "aberration_A1y",
+    "aberration_C1",
+    "rotation_Q_to_R_rads",
+)
+
 
-    ptycho_npy_path = config.outputs.ptycho_npy_dir / (
-        str(orig_path.stem) + "_rotated_object.npy"
+def load_parallax_data(
+    config: Config, processed_paths: List[Path], orig_paths: List[Path]
+) -> Tuple[np.ndarray, List[np.ndarray]]:
+    """
+    Read the parallax results of all scans, opening each results file once.
+
+    Returns a structured array with one record of scalar aberrations per
+    scan, with fields named after PARALLAX_SCALARS, and the corrected
+    parallax phase images.
+    """
+    middle_group = f"bin_{config.binning.bin_diffraction_factor}"
+    scalars = np.zeros(
+        len(processed_paths), dtype=[(name, np.float64) for name in PARALLAX_SCALARS]
     )
-    extracted_data["ptycho"] = np.load(ptycho_npy_path)
+    images = []
 
-    with h5py.File(processed_path, "r") as f:
+    for i, (processed_path, orig_path) in enumerate(zip(processed_paths, orig_paths)):
+        base_datapath = f"{orig_path.stem}/{middle_group}/{orig_path.stem}/parallax"
+        with h5py.File(processed_path, "r") as f:
+            group = f[base_datapath]
+            scalars[i] = tuple(group[name][()].item() for name in PARALLAX_SCALARS)
+            images.append(group["recon_phase_corrected"][()])
 
-        extracted_data["parallax_aberration_A1x"] = float(
-            f[base_datapath + "parallax/aberration_A1x"][()].item()
-        )
-        extracted_data["parallax_aberration_A1y"] = float(
-            f[base_datapath + "parallax/aberration_A1y"][()].item()
-        )
-        extracted_data["parallax_aberration_C1"] = float(
-            f[base_datapath + "parallax/aberration_C1"][()].item()
-        )
-        extracted_data["parallax_rotation_Q_to_R_rads"] = float(
-            f[base_datapath + "parallax/rotation_Q_to_R_rads"][()].item()
-        )
-        extracted_data["parallax_recon_phase_corrected"] = np.array(
-            f[base_datapath + "parallax/recon_phase_corrected"]
+    return scalars, images
+
+
+def load_ptycho_stack(config: Config, orig_paths: List[Path]) -> np.ndarray:
+    """
+    Get the rotated ptycho objects of all scans as one `[n_scans, H, W]`
+    array, memory-mapped from the stack written by `rotate_ptychos.py
+    --stack` if it has every scan, else from the per-scan NPY files.
+    """
+    npy_dir = config.outputs.ptycho_npy_dir
+    scan_names = [path.stem for path in orig_paths]
+
+    try:
+        stack, index = load_stack(npy_dir)
+        positions = get_stack_positions(index, scan_names)
+    except (OSError, KeyError):
+        return np.stack(
+            [
+                np.load(get_rotated_object_path(npy_dir, path), mmap_mode="r")
+                for path in orig_paths
+            ]
         )
 
-    return extracted_data
+    if positions == list(range(len(stack))):
+        return stack
+    return stack[positions]
 
 
 def get_paths(config: Config):
     """
-    Loads multiple datasets in a given range and returns a list of dictionaries containing the extracted data.
+    Find the scans with results, sorted by scan number. Returns the file
+    holding each scan's results, `_results.h5` or, for data processed
+    before it existed, `_binned_calibrated.h5`, and each scan's raw path.
     """
     base_path = config.experiment.data_base_path
+    bin_factor = config.binning.bin_diffraction_factor
 
     # Function to extract the sort key from the filename
-    def sort_key(filename):
-        match = re.search(r"(\d+)_binned_calibrated", filename)
+    def sort_key(stem):
+        match = re.search(r"(\d+)$", stem)
         if match:
             return int(match.group(1))
         else:
             return 0  # Default sort key
 
-    def remove_suffix(filename):
-        return filename.replace("_binned_calibrated", "")
-
-    # List the contents of the current directory
-    directory_contents = os.listdir(base_path)
-
-    # Filter the files that start with "FOURD"
-    processed_paths = [
-        f for f in directory_contents if f.endswith("_binned_calibrated.h5")
-    ]
-
-    # Sort the files based on the last number before "_binned_calibrated"
-    processed_paths = sorted(processed_paths, key=sort_key)
-
-    # The list sorted_fourd_files now contains the paths sorted as required
-    counted_paths = [base_path / Path(remove_suffix(path)) for path in processed_paths]
-    processed_paths = [base_path / Path(path) for path in processed_paths]
+    # Scans with a results file or a binned file that may hold results
+    stems = set()
+    for f in os.listdir(base_path):
+        for suffix in ("_results.h5", "_binned_calibrated.h5"):
+            if f.startswith("FOURD") and f.endswith(suffix):
+                stems.add(f[: -len(suffix)])
+
+    processed_paths = []
+    counted_paths = []
+    for stem in sorted(stems, key=sort_key):
+        counted_path = base_path / f"{stem}.h5"
+        processed_path = find_results_path(counted_path, bin_factor)
+        if processed_path is not None:
+            processed_paths.append(processed_path)
+            counted_paths.append(counted_path)
 
     return processed_paths, counted_paths
 
 
-def extract_shifts(config: Config, extracted_datas):
-    stack = [np.angle(e["ptycho"]) for e in extracted_datas]
-    image3d = np.stack(stack, axis=0)
-    image3d_smooth = np.zeros_like(image3d)
-    for ii, im in enumerate(image3d):
-        image3d_smooth[ii, :, :] = ndimage.gaussian_filter(im, 2)
-    alg, shifts = ncempy.eval.stack_align(
-        image3d_smooth[:, 20:-20, 20:-20],
-        upsample_factor=50,
-        align_type="dynamic",
-        method="cross",
-    )
+def extract_shifts(config: Config, ptycho_stack: np.ndarray):
+    # Register each frame to the previous one, reusing the shifts of frames
+    # registered by earlier runs
+    cache_path = config.outputs.ptycho_npy_dir / DRIFT_CACHE_FILENAME
+    tracker = DriftTracker(upsample_factor=50, sigma=2, border=20)
+    tracker.load(cache_path)
+    shifts = tracker.add_frames(np.angle(ptycho_stack))
+    tracker.save(cache_path)
+
     shiftx = shifts[:, 1]
     shifty = shifts[:, 0]
     return shiftx, shifty
@@ -165,7 +195,9 @@ def return_scaled_histogram_ordering(array, vmin=None, vmax=None, normalize=Fals
     return scaled_array, vmin, vmax
 
 
-def plot_threepane(config: Config, extracted_datas):
+def plot_threepane(
+    config: Config, ptycho_stack: np.ndarray, parallax_images: List[np.ndarray]
+):
     fig, axs = plt.subplots(2, 3, figsize=(6.5, 4))
 
     # Different bounds because of cropping in parallax, rotating in ptycho
@@ -176,9 +208,8 @@ def plot_threepane(config: Config, extracted_datas):
     indexes: list = [0, 33, 56]
 
     def plot_parallax_ptycho(column, index):
-        data = extracted_datas[index]
-        ptycho = data["ptycho"]
-        parallax = -data["parallax_recon_phase_corrected"]
+        ptycho = ptycho_stack[index]
+        parallax = -parallax_images[index]
         _, vmin_parallax, vmax_parallax = return_scaled_histogram_ordering(
             parallax, vmin=0.2, vmax=0.98
         )
@@ -211,17 +242,11 @@ def plot_threepane(config: Config, extracted_datas):
     )
 
 
-def plot_aberrations(config: Config, extracted_datas, shifts):
+def plot_aberrations(config: Config, parallax_scalars: np.ndarray, shifts):
     time_range = np.arange(0, 55, 55 / 60)
-    parallax_aberration_A1x = [
-        data["parallax_aberration_A1x"] for data in extracted_datas
-    ]
-    parallax_aberration_A1y = [
-        data["parallax_aberration_A1y"] for data in extracted_datas
-    ]
-    parallax_aberration_C1 = [
-        data["parallax_aberration_C1"] for data in extracted_datas
-    ]
+    parallax_aberration_A1x = parallax_scalars["aberration_A1x"]
+    parallax_aberration_A1y = parallax_scalars["aberration_A1y"]
+    parallax_aberration_C1 = parallax_scalars["aberration_C1"]
 
     # Create subplots
     fig, axs = plt.subplots(1, 3, figsize=(6.5, 2.25))
@@ -303,15 +328,16 @@ def main() -> None:
     # Find all paths
     processed_paths, orig_paths = get_paths(config)
 
-    extracted_datas = []
-    for processed_path, orig_path in zip(processed_paths, orig_paths):
-        extracted_datas.append(load_hdf5_data(config, processed_path, orig_path))
+    ptycho_stack = load_ptycho_stack(config, orig_paths)
+    parallax_scalars, parallax_images = load_parallax_data(
+        config, processed_paths, orig_paths
+    )
 
-    shiftx, shifty = extract_shifts(config, extracted_datas)
+    shiftx, shifty = extract_shifts(config, ptycho_stack)
 
     # Perform Visualizations
-    plot_threepane(config, extracted_datas)
-    plot_aberrations(config, extracted_datas, (shiftx, shifty))
+    plot_threepane(config, ptycho_stack, parallax_images)
+    plot_aberrations(config, parallax_scalars, (shiftx, shifty))
 
 
 if __name__ == "__main__":
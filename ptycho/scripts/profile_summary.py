@@ -0,0 +1,115 @@
+import argparse
+import json
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+
+def load_records(profile_dir: Path) -> List[dict]:
+    records = []
+    for path in sorted(profile_dir.glob("*.jsonl")):
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def peak_rss(r: dict) -> int:
+    """Peak RSS during the stage, its RSS at the end where that is unknown."""
+    return r["peak_rss_bytes"] or r["rss_bytes"] or 0
+
+
+def rss_growth(r: dict) -> int:
+    """How far the stage took the RSS above where it started."""
+    return peak_rss(r) - (r["rss_start_bytes"] or 0)
+
+
+def rss_delta(r: dict) -> int:
+    """How much the RSS changed from the start of the stage to its end."""
+    return (r["rss_bytes"] or 0) - (r["rss_start_bytes"] or 0)
+
+
+def summarize_stages(records: List[dict]) -> None:
+    by_stage: Dict[str, List[dict]] = defaultdict(list)
+    for r in records:
+        by_stage[r["stage"]].append(r)
+
+    total_wall = sum(r["wall_s"] for r in records)
+    print(
+        f"{'stage':<16}{'n':>5}{'total [s]':>11}{'share':>8}{'mean [s]':>10}"
+        f"{'p95 [s]':>9}{'cpu/wall':>10}{'read [GB]':>11}{'write [GB]':>12}"
+        f"{'peak +rss [GB]':>16}{'mean rss delta [GB]':>21}"
+    )
+    # Stages in order of total wall time, so the most expensive come first
+    for stage, rs in sorted(
+        by_stage.items(), key=lambda x: -sum(r["wall_s"] for r in x[1])
+    ):
+        wall = np.array([r["wall_s"] for r in rs])
+        cpu = sum(r["cpu_s"] for r in rs)
+        print(
+            f"{stage:<16}{len(rs):>5}{wall.sum():>11.1f}"
+            f"{wall.sum() / max(total_wall, 1e-9):>8.1%}{wall.mean():>10.2f}"
+            f"{np.percentile(wall, 95):>9.2f}{cpu / max(wall.sum(), 1e-9):>10.2f}"
+            f"{sum(r['read_bytes'] for r in rs) / 1e9:>11.2f}"
+            f"{sum(r['write_bytes'] for r in rs) / 1e9:>12.2f}"
+            f"{max(rss_growth(r) for r in rs) / 1e9:>16.2f}"
+            f"{np.mean([rss_delta(r) for r in rs]) / 1e9:>21.2f}"
+        )
+
+    failed = [r for r in records if not r["ok"]]
+    if failed:
+        print(f"\n{len(failed)} failed stages:")
+        for r in failed:
+            print(f"  {r['label']} {r['scan']} {r['stage']}")
+
+
+def summarize_labels(records: List[dict]) -> None:
+    by_label: Dict[str, List[dict]] = defaultdict(list)
+    for r in records:
+        by_label[r["label"]].append(r)
+
+    print(f"\n{'process':<16}{'scans':>7}{'busy [s]':>10}{'max rss [GB]':>14}")
+    for label, rs in sorted(by_label.items()):
+        print(
+            f"{label:<16}{len({r['scan'] for r in rs}):>7}"
+            f"{sum(r['wall_s'] for r in rs):>10.1f}"
+            f"{max(peak_rss(r) for r in rs) / 1e9:>14.2f}"
+        )
+
+
+def summarize_scans(records: List[dict], num_slowest: int) -> None:
+    by_scan: Dict[str, float] = defaultdict(float)
+    for r in records:
+        by_scan[r["scan"]] += r["wall_s"]
+
+    print(f"\nSlowest {num_slowest} scans:")
+    for scan, wall in sorted(by_scan.items(), key=lambda x: -x[1])[:num_slowest]:
+        print(f"  {scan}: {wall:.1f} s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Summarize the per-stage records written with --profile_dir."
+    )
+    parser.add_argument("profile_dir", type=Path)
+    parser.add_argument(
+        "--num_slowest",
+        type=int,
+        default=5,
+        help="Number of slowest scans to list.",
+    )
+    args = parser.parse_args()
+
+    records = load_records(args.profile_dir)
+    if not records:
+        print(f"No records found in {args.profile_dir}")
+        return
+
+    summarize_stages(records)
+    summarize_labels(records)
+    summarize_scans(records, args.num_slowest)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,35 @@
+import argparse
+import multiprocessing
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import List, Optional, Tuple
 
 import numpy as np
 import py4DSTEM
-from stempy.contrib import get_scan_path
 
 sys.path.append("/analysis/")
+from ptycho.results import find_results_path, get_results_group
+from ptycho.scan_index import find_scans
 from ptycho.schemas import Config
-from ptycho.utils import load_and_validate_config_json
+from ptycho.stack import get_rotated_object_path, write_stack
+from ptycho.utils import get_state_dir, load_and_validate_config_json
 
 
-def load_ptycho_and_save_rotated(base_path: Path, scan_path: Path):
+def load_ptycho_and_save_rotated(
+    base_path: Path, scan_path: Path, bin_factor: int = 16
+) -> Path:
     """
-    Loads HDF5 data given a scan path and returns a dictionary containing the extracted data.
+    Loads the ptycho reconstruction of a scan and saves its object, cropped
+    and rotated to the field of view, as an NPY file in `base_path`.
     """
-    output_filename: Path = scan_path.with_stem(scan_path.stem + "_binned_calibrated")
-    middle_group = "bin_16"
-    datapath = f"{scan_path.stem}/{middle_group}/{scan_path.stem}/ptycho/ptychographic_reconstruction"
+    output_filename: Optional[Path] = find_results_path(scan_path, bin_factor)
+    if output_filename is None:
+        raise FileNotFoundError(f"No results found for {scan_path.stem}")
+    datapath = (
+        f"{get_results_group(scan_path, bin_factor)}/ptycho/"
+        "ptychographic_reconstruction"
+    )
 
     ptycho = py4DSTEM.read(
         output_filename,
@@ -24,29 +37,90 @@ def load_ptycho_and_save_rotated(base_path: Path, scan_path: Path):
     )
     obj = ptycho.object
     rotated_object = ptycho._crop_rotate_object_fov(obj)
-    rotated_save_path = base_path / f"{scan_path.stem}_rotated_object.npy"
+    rotated_save_path = get_rotated_object_path(base_path, scan_path)
     np.save(rotated_save_path, rotated_object)
+    return rotated_save_path
+
+
+def export_scan(out_path: Path, scan_path: Path, bin_factor: int) -> Optional[Path]:
+    try:
+        return load_ptycho_and_save_rotated(out_path, scan_path, bin_factor)
+    except Exception as e:
+        print(f"Could not export {scan_path.stem}: {e}")
+        return None
 
 
 def load_multiple_datasets(
-    base_path: Path, min_scan_num: int, max_scan_num: int, out_path: Path
+    base_path: Path,
+    min_scan_num: int,
+    max_scan_num: int,
+    out_path: Path,
+    bin_factor: int = 16,
+    workers: int = 1,
+    stack: bool = False,
+    index_dir: Optional[Path] = None,
 ):
-    scan_paths = []
-    for scan_num in range(min_scan_num, max_scan_num + 1):
-        scan_path, scan_num, scan_id = get_scan_path(
-            base_path, scan_num=scan_num, version=1
-        )
-        if scan_path and scan_num and scan_id:
-            scan_paths.append(scan_path)
+    """
+    Export the rotated ptycho objects of a range of scans, `workers` at a
+    time, and optionally gather them into one memory-mappable stack.
+    """
+    scans = find_scans(base_path, min_scan_num, max_scan_num, index_dir)
+
+    if workers > 1:
+        # Spawn, so workers never inherit a CUDA context from this process
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            saved = list(
+                executor.map(
+                    export_scan,
+                    [out_path] * len(scans),
+                    [scan.path for scan in scans],
+                    [bin_factor] * len(scans),
+                )
+            )
+    else:
+        saved = [export_scan(out_path, scan.path, bin_factor) for scan in scans]
 
-    for scan_path in scan_paths:
-        load_ptycho_and_save_rotated(out_path, scan_path)
+    exported: List[Tuple[int, Path]] = [
+        (scan.scan_num, scan.path)
+        for scan, saved_path in zip(scans, saved)
+        if saved_path is not None
+    ]
+    print(f"Exported {len(exported)} of {len(scans)} scans to {out_path}")
+
+    if stack and exported:
+        stack_path = write_stack(out_path, exported)
+        print(f"Wrote stack of {len(exported)} objects to {stack_path}")
 
 
 def main() -> None:
-    config: Config = load_and_validate_config_json(
-        Path("/analysis/config/general_config.json")
+    parser = argparse.ArgumentParser(
+        description="Export rotated ptycho objects as NPY files."
+    )
+    parser.add_argument(
+        "--config_file",
+        type=Path,
+        default="/analysis/config/general_config.json",
+        help="Path to the configuration file.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes reading and rotating reconstructions.",
     )
+    parser.add_argument(
+        "--stack",
+        action="store_true",
+        help=(
+            "Also write all objects to one [n_scans, H, W] complex64 NPY file, "
+            "with a JSON index of the scans."
+        ),
+    )
+    args = parser.parse_args()
+
+    config: Config = load_and_validate_config_json(args.config_file)
 
     # Data Parameters
     processed_dir = config.experiment.data_base_path
@@ -55,7 +129,14 @@ def main() -> None:
 
     # Load Data
     load_multiple_datasets(
-        processed_dir, min_scan_num, max_scan_num, config.outputs.ptycho_npy_dir
+        processed_dir,
+        min_scan_num,
+        max_scan_num,
+        config.outputs.ptycho_npy_dir,
+        bin_factor=config.binning.bin_diffraction_factor,
+        workers=args.workers,
+        stack=args.stack,
+        index_dir=get_state_dir(config.outputs) / "scan_index",
     )
 
 
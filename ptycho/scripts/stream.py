@@ -0,0 +1,159 @@
+import argparse
+import logging
+import sys
+import threading
+from pathlib import Path
+
+sys.path.append("/analysis")
+
+from ptycho.backend import configure_backend
+from ptycho.binning import load_vacuum_probe
+from ptycho.pipeline import run_pipeline
+from ptycho.profiling import configure_profiling
+from ptycho.reconstruction import (
+    prepare_raw_scan,
+    run_dpc,
+    run_parallax,
+    run_ptycho,
+    save_results,
+)
+from ptycho.schemas import AnalysisConfig, Config
+from ptycho.utils import load_and_validate_analysis_json, load_and_validate_config_json
+from ptycho.watch import watch_scans
+from ptycho.writer import BackgroundWriter
+
+# Configure logging to file
+logging.basicConfig(
+    filename="stream.log",
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+
+# Configure logging to stdout
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+console_handler.setFormatter(formatter)
+logging.getLogger("").addHandler(console_handler)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Process 4D STEM scans as they are written to disk."
+    )
+    parser.add_argument(
+        "--config_file",
+        type=Path,
+        default="/analysis/config/general_config.json",
+        help="Path to the configuration file.",
+    )
+    parser.add_argument(
+        "--analysis_config_file",
+        type=Path,
+        default="/analysis/config/dpc_parallax_ptycho_params.json",
+        help="Path to the analysis configuration file.",
+    )
+    parser.add_argument(
+        "--poll_interval",
+        type=float,
+        default=5.0,
+        help="Seconds between listings of the data directory.",
+    )
+    parser.add_argument(
+        "--settle_time",
+        type=float,
+        default=10.0,
+        help="Seconds a scan file must be unchanged before it is processed.",
+    )
+    parser.add_argument(
+        "--idle_timeout",
+        type=float,
+        default=3600.0,
+        help=(
+            "Stop once no scan has appeared or changed for this many seconds, "
+            "e.g. if max_scan_num is never acquired."
+        ),
+    )
+    parser.add_argument(
+        "--queue_size",
+        type=int,
+        default=1,
+        help="Maximum number of scans waiting between two pipeline stages.",
+    )
+    parser.add_argument(
+        "--profile_dir",
+        type=Path,
+        default=None,
+        help="Write per-stage timing and memory records to this directory.",
+    )
+    args = parser.parse_args()
+    configure_profiling(args.profile_dir, "stream")
+
+    config: Config = load_and_validate_config_json(args.config_file)
+    analysis_config: AnalysisConfig = load_and_validate_analysis_json(
+        args.analysis_config_file
+    )
+    configure_backend(analysis_config.compute)
+
+    vacuum_probe, probe_size = load_vacuum_probe(config)
+
+    # Binned cubes and results are written in the background, so the stages
+    # hand datacubes to each other in memory without waiting on the disk
+    writer = BackgroundWriter()
+
+    def bin_stage(scan):
+        scan_path, scan_num, scan_id = scan
+        logging.info(f"Binning file: {scan_path.stem}")
+        datacube = prepare_raw_scan(
+            scan_path, scan_id, scan_num, config, vacuum_probe, probe_size, writer
+        )
+        return {"scan_path": scan_path, "datacube": datacube}
+
+    # DPC, parallax and ptycho run on their own threads but share the
+    # device, so only one of them uses it at a time. Binning still overlaps.
+    device_lock = threading.Lock()
+
+    def dpc_stage(state):
+        with device_lock:
+            run_dpc(state["datacube"], config, analysis_config)
+        return state
+
+    def parallax_stage(state):
+        with device_lock:
+            state["parallax"] = run_parallax(state["datacube"], config, analysis_config)
+        return state
+
+    def ptycho_stage(state):
+        with device_lock:
+            ptycho = run_ptycho(state["datacube"], config, analysis_config)
+        save_results(
+            state["scan_path"], config, state["parallax"], ptycho, writer=writer
+        )
+        logging.info(f"Finished file: {state['scan_path'].stem}")
+
+    scans = watch_scans(
+        config.experiment.data_base_path,
+        min_scan_num=config.experiment.min_scan_num,
+        max_scan_num=config.experiment.max_scan_num,
+        poll_interval=args.poll_interval,
+        settle_time=args.settle_time,
+        idle_timeout=args.idle_timeout,
+    )
+
+    try:
+        run_pipeline(
+            scans,
+            [
+                ("bin", bin_stage),
+                ("dpc", dpc_stage),
+                ("parallax", parallax_stage),
+                ("ptycho", ptycho_stage),
+            ],
+            queue_size=args.queue_size,
+        )
+    finally:
+        writer.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,7 @@ import sys
 
 sys.path.append("/analysis/")
 
+from ptycho.binning import bin_sparse_to_dense
 from ptycho.schemas import Config
 from ptycho.utils import load_and_validate_config_json
 
@@ -22,26 +23,15 @@ def main():
     # Import the sparse array
     stempy_sparse_array: stio.SparseArray = stio.SparseArray.from_hdf5(file_data)
 
-    # Remove flyback row and first column
-    stempy_sparse_array = stempy_sparse_array[:, :-1, :, :]
-    stempy_sparse_array = stempy_sparse_array[1:, :, :, :]
-
-    # Bin reciprocal space by some factor
-    bin_factor: int = config.binning.bin_diffraction_factor
-    stempy_sparse_array_binned: stio.SparseArray = stempy_sparse_array.bin_frames(
-        bin_factor
-    )
-    datacube = stempy_sparse_array_binned.to_dense()
-
-    # Put into datacube
-    datacube: py4DSTEM.DataCube = py4DSTEM.DataCube(datacube)
-
     # Define the x and y limits
     x_start, x_end = config.crop_vacuum_probe.x_min, config.crop_vacuum_probe.x_max
     y_start, y_end = config.crop_vacuum_probe.y_min, config.crop_vacuum_probe.y_max
 
+    # Remove flyback row and first column, crop and bin reciprocal space by
+    # some factor
+    bin_factor: int = config.binning.bin_diffraction_factor
     probe_datacube = py4DSTEM.DataCube(
-        datacube.data[y_start:y_end, x_start:x_end, :, :]
+        bin_sparse_to_dense(stempy_sparse_array, config.crop_vacuum_probe, bin_factor)
     )
     probe = probe_datacube.data.sum(axis=(0, 1))
     probe = py4DSTEM.Array(probe, name=config.calibration.vacuum_probe_emd_path.stem)